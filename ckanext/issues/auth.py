@@ -29,6 +29,11 @@ def issue_show(context, data_dict):
     return issue_auth(context, data_dict, 'package_show')
 
 
+@p.toolkit.auth_allow_anonymous_access
+def issue_similar(context, data_dict):
+    return issue_auth(context, data_dict, 'package_show')
+
+
 @p.toolkit.auth_allow_anonymous_access
 def issue_search(context, data_dict):
     try:
@@ -120,3 +125,119 @@ def issue_admin(context, data_dict):
 @p.toolkit.auth_allow_anonymous_access
 def issue_comment_search(context, data_dict):
     return {'success': True}
+
+
+@p.toolkit.auth_disallow_anonymous_access
+def issue_moderation_queue(context, data_dict):
+    '''Organization admins can moderate the issues of their organization.
+    Only sysadmins can see the queue for all organizations.'''
+    organization_id = data_dict.get('organization_id')
+    if organization_id:
+        try:
+            p.toolkit.check_access('organization_update', context,
+                                   {'id': organization_id})
+            return {'success': True}
+        except p.toolkit.NotAuthorized:
+            pass
+    return {
+        'success': False,
+        'msg': p.toolkit._(
+            'User {0} not authorized to moderate issues'.format(
+                str(context['user'])
+            )
+        )
+    }
+
+
+@p.toolkit.auth_disallow_anonymous_access
+def issue_user_dashboard(context, data_dict):
+    '''Users can see their own dashboard. Only sysadmins can see other
+    users'.'''
+    user_ref = data_dict.get('user')
+    user_obj = model.User.get(context['user'])
+    if not user_ref or (user_obj and user_ref in (user_obj.id,
+                                                  user_obj.name)):
+        return {'success': True}
+    return {
+        'success': False,
+        'msg': p.toolkit._(
+            'User {0} not authorized to see the issues of other users'.format(
+                str(context['user'])
+            )
+        )
+    }
+
+
+def issue_changes(context, data_dict):
+    '''Only sysadmins can read the change log, which includes hidden
+    issues and comments'''
+    return {
+        'success': False,
+        'msg': p.toolkit._(
+            'User {0} not authorized to read the issue changes'.format(
+                str(context['user'])
+            )
+        )
+    }
+
+
+def _issue_webhook_auth(context, data_dict):
+    '''Organization admins can manage the webhooks of their organization.
+    Only sysadmins can manage the webhooks of all organizations.'''
+    organization_id = data_dict.get('organization_id')
+    if organization_id:
+        try:
+            p.toolkit.check_access('organization_update', context,
+                                   {'id': organization_id})
+            return {'success': True}
+        except p.toolkit.NotAuthorized:
+            pass
+    return {
+        'success': False,
+        'msg': p.toolkit._(
+            'User {0} not authorized to manage webhooks'.format(
+                str(context['user'])
+            )
+        )
+    }
+
+
+@p.toolkit.auth_disallow_anonymous_access
+def issue_webhook_create(context, data_dict):
+    return _issue_webhook_auth(context, data_dict)
+
+
+@p.toolkit.auth_disallow_anonymous_access
+def issue_webhook_list(context, data_dict):
+    return _issue_webhook_auth(context, data_dict)
+
+
+@p.toolkit.auth_disallow_anonymous_access
+def issue_webhook_delete(context, data_dict):
+    return _issue_webhook_auth(context, data_dict)
+
+
+@p.toolkit.auth_disallow_anonymous_access
+def issue_notification_frequency_update(context, data_dict):
+    '''Users can set their own frequency. Organization admins can set the
+    default for their organization.'''
+    organization_id = data_dict.get('organization_id')
+    if not organization_id:
+        return {'success': True}
+    try:
+        p.toolkit.check_access('organization_update', context,
+                               {'id': organization_id})
+        return {'success': True}
+    except p.toolkit.NotAuthorized:
+        return {
+            'success': False,
+            'msg': p.toolkit._(
+                'User {0} not authorized to set the notification frequency '
+                'of the organization'.format(str(context['user']))
+            )
+        }
+
+
+@p.toolkit.auth_disallow_anonymous_access
+def issue_notification_frequency_show(context, data_dict):
+    return {'success': True}
@@ -13,10 +13,60 @@ class Issues(CkanCommand):
 
         paster issues upgrade_db
            - Does any database migrations required (idempotent)
+
+        paster issues search-index rebuild
+           - Re-indexes all the issues in the search backend chosen with
+             ckanext.issues.search_backend
+
+        paster issues similar-index rebuild
+           - Sets the similarity signatures of all the issues, used to
+             suggest similar issues on the new issue form
+
+        paster issues changes compact
+           - Deletes the entries of the issue change log that are superseded
+             by a later change to the same issue or comment
+
+        paster issues send-digests hourly|daily
+           - Emails each user one digest of the issue notifications queued
+             for them at that frequency (run by cron every hour/day)
+
+        paster issues archive
+           - Moves the issues closed more than
+             ckanext.issues.archive_after_days ago (default 365) to the
+             archive tables, with their comments and reports
+
+        paster issues purge-spam [--dry-run]
+           - Deletes the issues and comments confirmed as spam more than
+             ckanext.issues.spam_retention_days ago (default 30), in small
+             batches (or just reports how many there are, with --dry-run)
+
+        paster issues webhook-worker [--once]
+           - Posts the queued issue events to their webhooks, until stopped
+             (or just the events due now, with --once)
+
+        paster issues spam-train
+           - Trains the spam classifier on the issues and comments moderated
+             so far, and saves it to ckanext.issues.spam.model_path
+
+        paster issues spam-worker [--once]
+           - Scores the new issues and comments queued for a spam check,
+             hiding the likely spam, until stopped (or just one batch, with
+             --once)
     """
     summary = __doc__.split('\n')[0]
     usage = __doc__
 
+    def __init__(self, name):
+        super(Issues, self).__init__(name)
+        self.parser.add_option('--once', dest='once', action='store_true',
+                               default=False,
+                               help='webhook-worker, spam-worker: process '
+                                    'the work due now, then stop')
+        self.parser.add_option('--dry-run', dest='dry_run',
+                               action='store_true', default=False,
+                               help='purge-spam: report how much would be '
+                                    'deleted, without deleting it')
+
     def command(self):
         """
         Parse command line arguments and call appropriate method.
@@ -38,5 +88,100 @@ class Issues(CkanCommand):
             from ckanext.issues.model import upgrade
             upgrade()
             self.log.info('Issues tables are up to date')
+        elif cmd == 'search-index':
+            self.search_index()
+        elif cmd == 'similar-index':
+            self.similar_index()
+        elif cmd == 'changes':
+            self.changes()
+        elif cmd == 'webhook-worker':
+            self.webhook_worker()
+        elif cmd == 'send-digests':
+            self.send_digests()
+        elif cmd == 'archive':
+            self.archive()
+        elif cmd == 'purge-spam':
+            self.purge_spam()
+        elif cmd == 'spam-train':
+            self.spam_train()
+        elif cmd == 'spam-worker':
+            self.spam_worker()
         else:
             self.log.error('Command %s not recognized' % (cmd,))
+
+    def search_index(self):
+        if len(self.args) < 2 or self.args[1] != 'rebuild':
+            print self.usage
+            sys.exit(1)
+        import ckan.model as model
+        from ckanext.issues.lib import search
+        count = search.get_backend().rebuild(model.Session)
+        self.log.info('Indexed %s issues', count)
+
+    def similar_index(self):
+        if len(self.args) < 2 or self.args[1] != 'rebuild':
+            print self.usage
+            sys.exit(1)
+        import ckan.model as model
+        from ckanext.issues.lib import similar
+        count = similar.rebuild(model.Session)
+        self.log.info('Set the similarity signatures of %s issues', count)
+
+    def changes(self):
+        if len(self.args) < 2 or self.args[1] != 'compact':
+            print self.usage
+            sys.exit(1)
+        import ckan.model as model
+        from ckanext.issues.model import compact_changes
+        count = compact_changes(model.Session)
+        model.Session.commit()
+        self.log.info('Deleted %s superseded changes', count)
+
+    def webhook_worker(self):
+        import ckan.model as model
+        from ckanext.issues.lib import webhooks
+        webhooks.run_worker(model.Session, once=self.options.once)
+
+    def send_digests(self):
+        if len(self.args) < 2 or self.args[1] not in ('hourly', 'daily'):
+            print self.usage
+            sys.exit(1)
+        import ckan.model as model
+        from ckanext.issues.lib import notifications
+        count = notifications.send_digests(model.Session, self.args[1])
+        self.log.info('Sent %s %s digests', count, self.args[1])
+
+    def archive(self):
+        import ckan.model as model
+        from ckanext.issues.lib import archive
+        count = archive.archive_issues(model.Session)
+        self.log.info('Archived %s issues', count)
+
+    def purge_spam(self):
+        import ckan.model as model
+        from ckanext.issues.lib import retention
+        before = retention.spam_before()
+        counts = retention.count_spam(model.Session, before)
+        print 'Spam confirmed before {0}: {1} issues, {2} comments (including ' \
+              'those of the issues) and {3} reports'.format(
+                  before.strftime('%Y-%m-%d %H:%M'), counts['issues'],
+                  counts['comments'], counts['reports'])
+        if self.options.dry_run:
+            return
+        issue_count, comment_count = retention.purge_spam(model.Session,
+                                                          before)
+        self.log.info('Deleted %s spam issues and %s spam comments',
+                      issue_count, comment_count)
+
+    def spam_train(self):
+        import ckan.model as model
+        from ckanext.issues.lib import spam
+        classifier = spam.train(model.Session)
+        self.log.info('Trained the spam classifier on %s spam and %s other '
+                      'issues and comments, saved to %s', classifier.docs[1],
+                      classifier.docs[0], spam.model_path())
+
+    def spam_worker(self):
+        import ckan.model as model
+        from ckanext.issues.lib import spam
+        spam.run_worker(model.Session, once=self.options.once)
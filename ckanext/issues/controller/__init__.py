@@ -1,3 +1,4 @@
 from controller import IssueController
 from moderation import ModerationController
 from moderation import CommentModerationController
+from metrics import MetricsController
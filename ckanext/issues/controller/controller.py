@@ -8,7 +8,6 @@ from pylons import request, config, tmpl_context as c
 
 from ckan.lib.base import BaseController, render, abort, redirect
 import ckan.lib.helpers as h
-from ckan.lib import mailer
 import ckan.model as model
 import ckan.logic as logic
 import ckan.plugins as p
@@ -18,6 +17,8 @@ import ckanext.issues.model as issuemodel
 from ckanext.issues.controller import show
 from ckanext.issues.exception import ReportAlreadyExists
 from ckanext.issues.lib import helpers as issues_helpers
+from ckanext.issues.lib.notifications import send_notifications
+from ckanext.issues.lib.instrumentation import instrument_controller
 from ckanext.issues.logic import schema
 from ckanext.issues.lib.helpers import (Pagination, get_issues_per_page,
                                         get_issue_subject)
@@ -29,6 +30,7 @@ VALID_CATEGORY = re.compile(r"[0-9a-z\-\._]+")
 ISSUES_PER_PAGE = (15, 30, 50)
 
 
+@instrument_controller
 class IssueController(BaseController):
     def _before_dataset(self, dataset_id):
         '''Returns the dataset dict and checks issues are enabled for it.'''
@@ -298,10 +300,7 @@ class IssueController(BaseController):
                         user=assignee['display_name']))
 
                     user_obj = model.User.get(assignee_id)
-                    try:
-                        mailer.mail_user(user_obj, subject, body)
-                    except mailer.MailerException, e:
-                        log.debug(e.message)
+                    send_notifications([(user_obj, subject, body)])
 
             except toolkit.NotAuthorized:
                 msg = _('Unauthorized to assign users to issue'.format(
@@ -481,6 +480,21 @@ class IssueController(BaseController):
         template_params = all_issues(request.GET)
         return render("issues/all_issues.html", extra_vars=template_params)
 
+    def dashboard(self):
+        """
+        Display a page listing the issues assigned to, and opened by, the
+        logged in user
+        """
+        if not c.userobj:
+            abort(401, _('You must be logged in to see your issues'))
+        try:
+            template_params = user_dashboard(request.GET)
+        except toolkit.ValidationError, e:
+            msg = toolkit._("Validation error: {0}".format(e.error_summary))
+            h.flash(msg, category='alert-error')
+            return p.toolkit.redirect_to('issues_dashboard')
+        return render("issues/dashboard.html", extra_vars=template_params)
+
 
 def _dataset_handle_error(dataset_id, exc):
     msg = toolkit._("Validation error: {0}".format(exc.error_summary))
@@ -525,12 +539,48 @@ def all_issues(get_query_dict):
     return _search_issues(include_datasets=True,
                           **query)
 
+def user_dashboard(get_query_dict):
+    query, errors = toolkit.navl_validate(
+        dict(get_query_dict),
+        schema.issue_dashboard_controller_schema()
+    )
+    if errors:
+        raise toolkit.ValidationError(errors)
+    list_name = query.get('list', issuemodel.DASHBOARD_LISTS[0])
+    status = query.get('status', issuemodel.ISSUE_STATUS.open)
+    sort = query.get('sort', 'newest')
+    q = query.get('q', '')
+    page = query.get('page', 1)
+    per_page = query.get('per_page', get_issues_per_page()[0])
+
+    dashboard = toolkit.get_action('issue_user_dashboard')(data_dict={
+        'list': list_name,
+        'status': status,
+        'sort': sort,
+        'q': q,
+        'limit': per_page,
+        'offset': (page - 1) * per_page,
+    })
+    return {
+        'issues': dashboard[list_name]['results'],
+        'status': status,
+        'status_counts': dashboard[list_name]['status_counts'],
+        'list': list_name,
+        'dashboard': dashboard,
+        'sort': sort,
+        'q': q,
+        'pagination': Pagination(page, per_page,
+                                 dashboard[list_name]['count']),
+    }
+
+
 def _search_issues(dataset_id=None,
                    organization_id=None,
                    status=issuemodel.ISSUE_STATUS.open,
                    sort='newest',
                    visibility=None,
                    abuse_status=None,
+                   category=None,
                    q='',
                    page=1,
                    per_page=get_issues_per_page()[0],
@@ -558,19 +608,29 @@ def _search_issues(dataset_id=None,
     )
     issues = results_for_current_page['results']
 
-    # fetch the total count of all the search results without dictizing
-    params['include_count'] = True
-    params['include_results'] = False
+    # count the search results by status, without dictizing them, which
+    # gives both the total for the pagination and the counts for the status
+    # filters
+    params.pop('status', None)
     params.pop('limit', None)
     params.pop('offset', None)
-    all_search_results = toolkit.get_action('issue_search')(data_dict=params)
-    issue_count = all_search_results['count']
+    params.update({
+        'include_results': False,
+        'facets': ['status'],
+    })
+    facets = toolkit.get_action('issue_search')(data_dict=params)['facets']
+    status_counts = facets['status']
+    if status:
+        issue_count = status_counts.get(status, 0)
+    else:
+        issue_count = sum(status_counts.values())
 
     pagination = Pagination(page, limit, issue_count)
 
     template_variables = {
         'issues': issues,
         'status': status,
+        'status_counts': status_counts,
         'sort': sort,
         'q': q,
         'pagination': pagination,
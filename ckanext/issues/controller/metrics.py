@@ -0,0 +1,23 @@
+from ckan.plugins import toolkit
+try:
+    import ckan.authz as authz
+except ImportError:
+    import ckan.new_authz as authz
+
+from ckanext.issues.lib import metrics
+
+
+class MetricsController(toolkit.BaseController):
+    def metrics(self):
+        '''The issues metrics, in the Prometheus text format'''
+        if not metrics.enabled():
+            toolkit.abort(404, toolkit._('Issues metrics are not enabled'))
+        if not metrics.authorized(
+                toolkit.request.environ,
+                is_sysadmin=bool(toolkit.c.user) and
+                authz.is_sysadmin(toolkit.c.user)):
+            toolkit.abort(403, toolkit._('Not authorized to see the issues '
+                                         'metrics'))
+        toolkit.response.headers['Content-Type'] = \
+            'text/plain; version=0.0.4; charset=utf-8'
+        return metrics.exposition()
@@ -1,20 +1,46 @@
 from ckan.plugins import toolkit
 import ckan.lib.helpers as h
 
+from ckanext.issues.lib.helpers import Pagination, get_issues_per_page
+from ckanext.issues.lib.instrumentation import instrument_controller
 
+
+def _get_paging():
+    '''Returns the (page, per_page) requested in the query string'''
+    params = toolkit.request.params
+    try:
+        page = max(int(params.get('page', 1)), 1)
+    except ValueError:
+        page = 1
+    try:
+        per_page = int(params['per_page'])
+        if per_page < 1:
+            raise ValueError
+    except (KeyError, ValueError):
+        per_page = get_issues_per_page()[0]
+    return page, per_page
+
+
+@instrument_controller
 class ModerationController(toolkit.BaseController):
     def all_reported_issues(self, organization_id):
         '''show all issues over max_strikes and are not moderated'''
         try:
-            issues, organization = all_reported_issues(organization_id)
+            page, per_page = _get_paging()
+            issues, organization = all_reported_issues(organization_id,
+                                                       page=page,
+                                                       per_page=per_page)
             extra_vars = {
                 'issues': issues.get('results', []),
                 'organization': organization,
+                'pagination': Pagination(page, per_page, issues['count']),
             }
             return toolkit.render("issues/moderation.html",
                                   extra_vars=extra_vars)
         except toolkit.ObjectNotFound:
             toolkit.abort(404, toolkit._('Organization not found'))
+        except toolkit.NotAuthorized:
+            toolkit.abort(401, toolkit._('Unauthorized to moderate issues'))
 
     def moderate(self, organization_id):
         if toolkit.request.method == 'POST':
@@ -38,42 +64,53 @@ class ModerationController(toolkit.BaseController):
                       organization_id=organization_id)
 
 
-def all_reported_issues(organization_id, include_sub_organizations=False):
+def all_reported_issues(organization_id, include_sub_organizations=False,
+                        page=1, per_page=None):
     organization = toolkit.get_action('organization_show')(data_dict={
         'id': organization_id,
     })
 
-    issues = toolkit.get_action('issue_search')(data_dict={
+    per_page = per_page or get_issues_per_page()[0]
+    issues = toolkit.get_action('issue_moderation_queue')(data_dict={
         'organization_id': organization['id'],
-        'abuse_status': 'unmoderated',
-        'include_reports': True,
         'include_sub_organizations': include_sub_organizations,
-        'visibility': 'hidden',
+        'type': 'issue',
+        'limit': per_page,
+        'offset': (page - 1) * per_page,
     })
 
     return issues, organization
 
 
+@instrument_controller
 class CommentModerationController(toolkit.BaseController):
     def reported_comments(self, organization_id):
         try:
             organization = toolkit.get_action('organization_show')(data_dict={
                 'id': organization_id,
             })
-            comments = toolkit.get_action('issue_comment_search')(data_dict={
-                'organization_id': organization['id'],
-                'only_hidden': True,
-            })
+            page, per_page = _get_paging()
+            comments = toolkit.get_action('issue_moderation_queue')(
+                data_dict={
+                    'organization_id': organization['id'],
+                    'type': 'comment',
+                    'limit': per_page,
+                    'offset': (page - 1) * per_page,
+                })
 
             return toolkit.render(
                 'issues/comment_moderation.html',
                 extra_vars={
-                    'comments': comments,
+                    'comments': comments['results'],
                     'organization': organization,
+                    'pagination': Pagination(page, per_page,
+                                             comments['count']),
                 }
             )
         except toolkit.ObjectNotFound:
             toolkit.abort(404, toolkit._('Organization not found'))
+        except toolkit.NotAuthorized:
+            toolkit.abort(401, toolkit._('Unauthorized to moderate comments'))
 
     def moderate(self, organization_id):
         if toolkit.request.method == 'POST':
@@ -2,3 +2,12 @@ from ckan.logic import ActionError
 
 class ReportAlreadyExists(ActionError):
     pass
+
+
+class RateLimited(ActionError):
+    '''Too many requests of a kind from a user or IP address. They can try
+    again after retry_after seconds.'''
+
+    def __init__(self, message, retry_after):
+        super(RateLimited, self).__init__(message)
+        self.retry_after = retry_after
@@ -0,0 +1,353 @@
+'''Archiving old closed issues
+
+Almost all reads are of open or recently closed issues, so `paster issues
+archive` moves the issues that were closed, and have not been updated since,
+more than ckanext.issues.archive_after_days (default 365) days ago out of the
+issue tables: with their comments, reports and categories, to the archive
+tables (issue_archive etc., see ckanext.issues.model.archive_tables). It
+moves ckanext.issues.archive_batch_size (default 500) issues per
+transaction, so it can run while the site is in use.
+
+Archived issues keep their ids and numbers, and are read-only. They are not
+in the search index, dashboards or moderation queue, but issue_show and
+issue_search return them when called with include_archived=true.
+'''
+from datetime import date, datetime, timedelta
+import logging
+
+from pylons import config
+from sqlalchemy import func
+from sqlalchemy.sql.expression import and_, or_, select
+
+from ckan import model
+from ckan.lib.dictization import model_dictize
+import ckan.lib.helpers as h
+from ckan.plugins import toolkit
+
+from ckanext.issues import model as issuemodel
+from ckanext.issues.lib import search
+
+log = logging.getLogger(__name__)
+
+DEFAULT_ARCHIVE_AFTER_DAYS = 365
+DEFAULT_BATCH_SIZE = 500
+# the issue_search sorts, as (field, descending)
+SORTS = {
+    issuemodel.IssueFilter.newest: ('created', True),
+    issuemodel.IssueFilter.oldest: ('created', False),
+    issuemodel.IssueFilter.most_commented: ('comment_count', True),
+    issuemodel.IssueFilter.least_commented: ('comment_count', False),
+    issuemodel.IssueFilter.recently_updated: ('updated', True),
+    issuemodel.IssueFilter.least_recently_updated: ('updated', False),
+}
+
+
+def _archive(table_name):
+    return issuemodel.archive_tables[table_name]
+
+
+def archive_before():
+    '''Returns the time before which closed issues are archived'''
+    days = toolkit.asint(config.get('ckanext.issues.archive_after_days',
+                                    DEFAULT_ARCHIVE_AFTER_DAYS))
+    return datetime.now() - timedelta(days=days)
+
+
+# Archiving
+
+def _move(session, table, where):
+    '''Copies the rows of table matching where to its archive table, in a
+    single INSERT ... SELECT'''
+    session.execute(_archive(table.name).insert().from_select(
+        [column.name for column in table.columns],
+        select([table]).where(where)))
+
+
+def archive_issues(session, before=None, batch_size=None):
+    '''Moves the closed issues last updated before `before` (by default,
+    archive_before()) to the archive tables, a batch per transaction, and
+    returns how many were moved'''
+    if before is None:
+        before = archive_before()
+    if batch_size is None:
+        batch_size = toolkit.asint(config.get(
+            'ckanext.issues.archive_batch_size', DEFAULT_BATCH_SIZE))
+    issue_table = issuemodel.issue_table
+    comment_table = issuemodel.issue_comment_table
+    issue_report_table, comment_report_table = issuemodel.report_tables
+    categorized = issuemodel.issue_category_association_table
+    count = 0
+    while True:
+        # lock the batch, so that the issues can't be reopened or commented
+        # on (the comments' foreign key waits for the lock) until they have
+        # been moved
+        issue_ids = [row[0] for row in session.execute(
+            select([issue_table.c.id])
+            .where(issue_table.c.status == issuemodel.ISSUE_STATUS.closed)
+            .where(issue_table.c.updated < before)
+            .order_by(issue_table.c.updated).limit(batch_size)
+            .with_for_update())]
+        if not issue_ids:
+            return count
+        # and check again, where the database doesn't lock rows
+        archived = and_(
+            issue_table.c.id.in_(issue_ids),
+            issue_table.c.status == issuemodel.ISSUE_STATUS.closed,
+            issue_table.c.updated < before)
+        archived_ids = select([issue_table.c.id]).where(archived)
+        comment_ids = select([comment_table.c.id])\
+            .where(comment_table.c.issue_id.in_(archived_ids))
+        _move(session, issue_table, archived)
+        _move(session, comment_table,
+              comment_table.c.issue_id.in_(archived_ids))
+        _move(session, issue_report_table,
+              issue_report_table.c.parent_id.in_(archived_ids))
+        _move(session, comment_report_table,
+              comment_report_table.c.parent_id.in_(comment_ids))
+        _move(session, categorized, categorized.c.issue_id.in_(archived_ids))
+        issuemodel._record_deletions(
+            session, comment_table, u'comment', comment_table.c.issue_id,
+            comment_table.c.issue_id.in_(archived_ids), change=u'archived')
+        issuemodel._record_deletions(
+            session, issue_table, u'issue', issue_table.c.id, archived,
+            change=u'archived')
+        session.execute(issuemodel.issue_notification_table.delete().where(
+            issuemodel.issue_notification_table.c.issue_id.in_(
+                archived_ids)))
+        issuemodel._delete_comment_rows(session, comment_ids)
+        issuemodel._delete_issue_rows(session, archived)
+        session.commit()
+        search.delete_issues(issue_ids)
+        count += len(issue_ids)
+        log.info('Archived %s issues', count)
+
+
+def last_archived_number(session, dataset_id):
+    '''Returns the highest number of the dataset's archived issues, if any,
+    so that it isn't given to a new issue'''
+    issues = _archive('issue')
+    return session.execute(
+        select([func.max(issues.c.number)])
+        .where(issues.c.dataset_id == dataset_id)).scalar()
+
+
+# Reading
+
+def _row_dict(row):
+    '''Returns a row as a dict, like DomainObject.as_dict'''
+    out = dict(row)
+    out.pop('similarity_signature', None)
+    for key, value in out.items():
+        if isinstance(value, date):
+            out[key] = str(value)
+    try:
+        out['abuse_status'] = \
+            issuemodel.AbuseStatus(out['abuse_status']).name
+    except (KeyError, ValueError):
+        pass
+    return out
+
+
+def _categories(session, issue_ids):
+    '''Returns {issue id: [category names]}'''
+    return issuemodel.category_names(
+        session, issue_ids, _archive('issue_category_association'))
+
+
+def _reports(session, table_name, parent_ids):
+    '''Returns {parent id: [user ids of its reports]}'''
+    return issuemodel.report_user_ids(session, _archive(table_name),
+                                      parent_ids)
+
+
+def archived_issue_exists(session, dataset_id, issue_number):
+    issues = _archive('issue')
+    return session.execute(
+        select([issues.c.id])
+        .where(issues.c.dataset_id == dataset_id)
+        .where(issues.c.number == issue_number)).first() is not None
+
+
+def archived_issue_dict(session, dataset_id, issue_number,
+                        include_reports=False):
+    '''Returns an archived issue like Issue.as_dict, with its comments, or
+    None. Reports are the user ids of all of them.'''
+    issues = _archive('issue')
+    comments = _archive('issue_comment')
+    row = session.execute(
+        select([issues])
+        .where(issues.c.dataset_id == dataset_id)
+        .where(issues.c.number == issue_number)).first()
+    if row is None:
+        return None
+
+    user_dicts = {}
+    out = _row_dict(row)
+    out['archived'] = True
+    out['categories'] = _categories(session, [row.id])[row.id]
+    out['user'] = issuemodel._user_dict(model.User.get(row.user_id),
+                                        user_dicts)
+    dataset = model.Package.get(row.dataset_id)
+    if dataset:
+        out['ckan_url'] = h.url_for('issues_show', dataset_id=dataset.name,
+                                    issue_number=row.number)
+    comment_rows = session.execute(
+        select([comments]).where(comments.c.issue_id == row.id)
+        .order_by(comments.c.id)).fetchall()
+    if include_reports:
+        out['abuse_reports'] = _reports(session, 'issue_report',
+                                        [row.id])[row.id]
+        comment_reports = _reports(session, 'issue_comment_report',
+                                   [comment.id for comment in comment_rows])
+    out['comments'] = []
+    for comment in comment_rows:
+        comment_dict = _row_dict(comment)
+        comment_dict['user'] = issuemodel._user_dict(
+            model.User.get(comment.user_id), user_dicts)
+        if include_reports:
+            comment_dict['abuse_reports'] = comment_reports[comment.id]
+        out['comments'].append(comment_dict)
+    return out
+
+
+def _where(filters):
+    '''Returns the conditions on the archived issues for the issue_search
+    filters, as Issue.apply_filters_to_an_issue_query'''
+    issues = _archive('issue')
+    clauses = []
+    if filters.get('dataset_id'):
+        clauses.append(issues.c.dataset_id == filters['dataset_id'])
+    if filters.get('organization_id'):
+        org = model.Group.get(filters['organization_id'])
+        if filters.get('include_sub_organizations'):
+            org_ids = [org_.id for org_
+                       in org.get_children_groups(type='organization')]
+        else:
+            org_ids = [org.id]
+        clauses.append(issues.c.dataset_id.in_(
+            select([model.package_table.c.id])
+            .where(model.package_table.c.owner_org.in_(org_ids))))
+    if filters.get('q'):
+        search_expr = u'%{0}%'.format(filters['q'])
+        clauses.append(or_(issues.c.title.ilike(search_expr),
+                           issues.c.description.ilike(search_expr)))
+    for field in ('status', 'visibility', 'assignee_id', 'user_id'):
+        if filters.get(field):
+            clauses.append(issues.c[field] == filters[field])
+    if filters.get('abuse_status'):
+        clauses.append(issues.c.abuse_status == filters['abuse_status'].value)
+    if filters.get('category_id'):
+        categorized = _archive('issue_category_association')
+        clauses.append(issues.c.id.in_(
+            select([categorized.c.issue_id])
+            .where(categorized.c.category_id == filters['category_id'])))
+    return and_(*clauses)
+
+
+def search_archived(session, filters, include_count=True,
+                    include_results=True, include_datasets=False,
+                    include_reports=False):
+    '''Returns (count, results) for the archived issues matching the
+    issue_search filters, with the results like Issue.as_plain_dict. As
+    they are merged with the other issues, the first offset + limit are
+    returned.'''
+    issues = _archive('issue')
+    comments = _archive('issue_comment')
+    where = _where(filters)
+    count = None
+    if include_count:
+        count = session.execute(
+            select([func.count()]).select_from(issues).where(where)).scalar()
+    if not include_results:
+        return count, []
+
+    comment_counts = select([comments.c.issue_id,
+                             func.count().label('comment_count')])\
+        .group_by(comments.c.issue_id).alias('comment_counts')
+    comment_count = func.coalesce(comment_counts.c.comment_count, 0)\
+        .label('comment_count')
+    query = select([issues, model.user_table.c.name.label('user_name'),
+                    comment_count])\
+        .select_from(issues.outerjoin(
+            comment_counts, comment_counts.c.issue_id == issues.c.id)
+            .join(model.user_table,
+                  model.user_table.c.id == issues.c.user_id))\
+        .where(where)
+    field, descending = SORTS.get(filters.get('sort'), ('id', False))
+    order_by = comment_count if field == 'comment_count' else issues.c[field]
+    query = query.order_by(order_by.desc() if descending else order_by,
+                           issues.c.id)
+    if filters.get('limit'):
+        query = query.limit((filters.get('offset') or 0) + filters['limit'])
+    rows = session.execute(query).fetchall()
+
+    issue_ids = [row.id for row in rows]
+    categories = _categories(session, issue_ids)
+    if include_reports:
+        reports = _reports(session, 'issue_report', issue_ids)
+    results = []
+    for row in rows:
+        out = _row_dict(row)
+        del out['user_name']
+        out.update({
+            'user': row.user_name,
+            'comment_count': row.comment_count,
+            'categories': categories[row.id],
+            'updated': row.updated.isoformat(),
+            'archived': True,
+        })
+        if include_datasets:
+            out['dataset'] = model_dictize.package_dictize(
+                model.Package.get(row.dataset_id),
+                {'model': model, 'session': model.Session})
+        if include_reports:
+            out['abuse_reports'] = reports[row.id]
+        results.append(out)
+    return count, results
+
+
+def merge(filters, results, archived_results):
+    '''Merges search results with archived ones, in the order of
+    filters['sort'], and returns the page given by the offset and limit'''
+    field, descending = SORTS.get(filters.get('sort'), ('id', False))
+
+    def key(result):
+        value = result[field]
+        if isinstance(value, basestring):
+            # created is formatted by str(), updated by isoformat()
+            value = value.replace('T', ' ')
+        return value, result['id']
+    merged = sorted(results + archived_results, key=key, reverse=descending)
+    offset = filters.get('offset') or 0
+    if filters.get('limit'):
+        return merged[offset:offset + filters['limit']]
+    return merged[offset:]
+
+
+def facet_counts(session, filters, fields):
+    '''Returns {field: {value: number of archived issues}} for each of
+    fields, over the archived issues matching filters'''
+    issues = _archive('issue')
+    where = _where(filters)
+    facets = {}
+    for field in fields:
+        if field == 'category_id':
+            categorized = _archive('issue_category_association')
+            query = select([categorized.c.category_id, func.count()])\
+                .where(categorized.c.issue_id.in_(
+                    select([issues.c.id]).where(where)))\
+                .group_by(categorized.c.category_id)
+        else:
+            query = select([issues.c[field], func.count()])\
+                .where(where).group_by(issues.c[field])
+        facets[field] = dict(session.execute(query).fetchall())
+    return facets
+
+
+def add_facet_counts(facets, more_facets):
+    '''Adds the counts of more_facets to facets'''
+    for field, counts in more_facets.items():
+        field_counts = facets.setdefault(field, {})
+        for value, count in counts.items():
+            field_counts[value] = field_counts.get(value, 0) + count
+    return facets
@@ -0,0 +1,130 @@
+'''In-memory prefix index of the editors and admins of each organization
+
+organization_users_autocomplete is called on every keystroke of the assign
+widget. Rather than running an ILIKE over the user table each time, the
+editors and admins of an organization are loaded once into a sorted list of
+(token, name, user_id) keys, where the tokens are the lower-cased user name,
+full name and each word of the full name. A prefix lookup is then a bisect
+into that list.
+
+An organization's entry is dropped when this process flushes a change to
+its memberships or to any user, and otherwise expires after
+ckanext.issues.autocomplete_cache_ttl seconds, which bounds how stale other
+worker processes can be.
+'''
+import bisect
+import threading
+import time
+
+from pylons import config
+from sqlalchemy import event
+
+import ckan.model as model
+from ckan.plugins import toolkit
+
+from ckanext.issues.lib import metrics
+
+DEFAULT_CACHE_TTL = 300
+MEMBER_CAPACITIES = ('editor', 'admin')
+
+_organizations = {}
+_lock = threading.Lock()
+
+
+class OrganizationMembers(object):
+    '''The editors and admins of one organization, indexed by prefix'''
+
+    def __init__(self, users):
+        self.created = time.time()
+        self.users = {}
+        keys = []
+        for user_id, name, fullname in users:
+            self.users[user_id] = {
+                'id': user_id,
+                'name': name,
+                'fullname': fullname,
+            }
+            for token in _tokens(name, fullname):
+                keys.append((token, name, user_id))
+        keys.sort()
+        self.keys = keys
+
+    def search(self, q, limit):
+        '''Returns user dicts whose name, full name or a word of their full
+        name starts with q (case insensitive)'''
+        q = q.lower()
+        results = []
+        seen = set()
+        i = bisect.bisect_left(self.keys, (q,))
+        while i < len(self.keys) and len(results) < limit:
+            token, name, user_id = self.keys[i]
+            if not token.startswith(q):
+                break
+            if user_id not in seen:
+                seen.add(user_id)
+                results.append(dict(self.users[user_id]))
+            i += 1
+        return results
+
+
+def _tokens(name, fullname):
+    tokens = set([name.lower()])
+    if fullname:
+        fullname = fullname.lower()
+        tokens.add(fullname)
+        tokens.update(fullname.split())
+    return tokens
+
+
+def _load(session, organization_id):
+    query = session.query(model.User.id, model.User.name,
+                          model.User.fullname)\
+        .filter(model.Member.group_id == organization_id)\
+        .filter(model.Member.table_name == 'user')\
+        .filter(model.Member.capacity.in_(MEMBER_CAPACITIES))\
+        .filter(model.Member.state == 'active')\
+        .filter(model.User.state != model.State.DELETED)\
+        .filter(model.User.id == model.Member.table_id)\
+        .distinct()
+    return OrganizationMembers(query.all())
+
+
+def get_organization_members(session, organization_id):
+    ttl = toolkit.asint(config.get('ckanext.issues.autocomplete_cache_ttl',
+                                   DEFAULT_CACHE_TTL))
+    members = _organizations.get(organization_id)
+    if members is None or time.time() - members.created > ttl:
+        metrics.inc('issues_cache_requests_total', cache='autocomplete',
+                    result='miss')
+        members = _load(session, organization_id)
+        with _lock:
+            _organizations[organization_id] = members
+    else:
+        metrics.inc('issues_cache_requests_total', cache='autocomplete',
+                    result='hit')
+    return members
+
+
+def search(session, organization_id, q, limit):
+    return get_organization_members(session, organization_id)\
+        .search(q, limit)
+
+
+def invalidate(organization_id=None):
+    '''Forget the members of organization_id, or of all organizations'''
+    with _lock:
+        if organization_id is None:
+            _organizations.clear()
+        else:
+            _organizations.pop(organization_id, None)
+
+
+def _invalidate_on_flush(session, flush_context):
+    for obj in session.new | session.dirty | session.deleted:
+        if isinstance(obj, model.Member) and obj.table_name == 'user':
+            invalidate(obj.group_id)
+        elif isinstance(obj, model.User):
+            invalidate()
+            return
+
+event.listen(model.Session, 'after_flush', _invalidate_on_flush)
@@ -0,0 +1,92 @@
+'''Process-level registry of the issue categories
+
+The categories hardly ever change, but are needed to validate and display
+the categories of every issue created, updated or searched for. They are
+loaded into memory on first use, reloaded when this process flushes a
+change to a category, and otherwise after
+ckanext.issues.category_cache_ttl seconds, which bounds how long other
+worker processes can take to see a change.
+
+Categories are returned as dicts with id, name and description.
+'''
+import threading
+import time
+
+from pylons import config
+from sqlalchemy import event
+
+import ckan.model as model
+from ckan.plugins import toolkit
+
+from ckanext.issues import model as issuemodel
+
+DEFAULT_CACHE_TTL = 300
+
+_registry = []
+_lock = threading.Lock()
+
+
+class Categories(object):
+    '''All the categories, by id and by name'''
+
+    def __init__(self, rows):
+        self.created = time.time()
+        self.by_id = {}
+        self.by_name = {}
+        for category_id, name, description in rows:
+            category = {
+                'id': category_id,
+                'name': name,
+                'description': description,
+            }
+            self.by_id[category_id] = category
+            self.by_name[name] = category
+
+
+def _categories():
+    ttl = toolkit.asint(config.get('ckanext.issues.category_cache_ttl',
+                                   DEFAULT_CACHE_TTL))
+    categories = _registry[0] if _registry else None
+    if categories is None or time.time() - categories.created > ttl:
+        IssueCategory = issuemodel.IssueCategory
+        categories = Categories(
+            model.Session.query(IssueCategory.id, IssueCategory.name,
+                                IssueCategory.description).all())
+        with _lock:
+            _registry[:] = [categories]
+    return categories
+
+
+def get(reference):
+    '''Returns the category with the given id or name, or None'''
+    categories = _categories()
+    if isinstance(reference, (int, long)):
+        return categories.by_id.get(reference)
+    return categories.by_name.get(reference)
+
+
+def all_categories():
+    '''Returns all the categories, ordered by name'''
+    return sorted(_categories().by_id.values(),
+                  key=lambda category: category['name'])
+
+
+def names(category_ids):
+    '''Returns the names of the categories with the given ids'''
+    by_id = _categories().by_id
+    return [by_id[category_id]['name'] for category_id in category_ids
+            if category_id in by_id]
+
+
+def invalidate():
+    with _lock:
+        del _registry[:]
+
+
+def _invalidate_on_flush(session, flush_context):
+    for obj in session.new | session.dirty | session.deleted:
+        if isinstance(obj, issuemodel.IssueCategory):
+            invalidate()
+            return
+
+event.listen(model.Session, 'after_flush', _invalidate_on_flush)
@@ -0,0 +1,165 @@
+'''SQL query counting and timing for the issues actions and controllers
+
+When ckanext.issues.instrumentation is true, every issues action and
+controller method records the number of SQL statements it ran, the total
+time spent in them and the slowest statements. The figures are logged as a
+JSON object on the 'ckanext.issues.lib.instrumentation' logger and, if
+ckanext.issues.instrumentation.debug_header is also true, returned to the
+browser in an X-Issues-Queries response header.
+
+The same recording is used by the tests (see assert_max_queries in
+ckanext.issues.tests.helpers) whether or not it is switched on in the
+config.
+'''
+import functools
+import json
+import logging
+import threading
+import time
+
+from decorator import decorator
+from pylons import config, response
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from ckan.plugins import toolkit
+
+log = logging.getLogger(__name__)
+
+SLOWEST_STATEMENTS = 3
+STATEMENT_MAX_LENGTH = 500
+
+_local = threading.local()
+
+
+class QueryStats(object):
+    '''The SQL statements run while recording a named block of code'''
+
+    def __init__(self, name):
+        self.name = name
+        self.count = 0
+        self.sql_time = 0.0
+        self.slowest = []  # (duration, statement), slowest first
+        self.started = time.time()
+        self.duration = None
+
+    def add(self, statement, duration):
+        self.count += 1
+        self.sql_time += duration
+        if len(self.slowest) < SLOWEST_STATEMENTS or \
+                duration > self.slowest[-1][0]:
+            self.slowest.append((duration, statement[:STATEMENT_MAX_LENGTH]))
+            self.slowest.sort(key=lambda item: item[0], reverse=True)
+            del self.slowest[SLOWEST_STATEMENTS:]
+
+    def as_dict(self):
+        return {
+            'name': self.name,
+            'queries': self.count,
+            'sql_ms': round(self.sql_time * 1000, 3),
+            'total_ms': round((self.duration or 0) * 1000, 3),
+            'slowest': [{'ms': round(duration * 1000, 3),
+                         'statement': statement}
+                        for duration, statement in self.slowest],
+        }
+
+    def header_value(self):
+        return 'count={0}; sql_ms={1:.1f}'.format(self.count,
+                                                  self.sql_time * 1000)
+
+
+def _active_stats():
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    return _local.stack
+
+
+class record(object):
+    '''Context manager recording the SQL run inside it into a QueryStats
+
+    Recordings can be nested; a statement counts towards every recording
+    that is active at the time.
+    '''
+    def __init__(self, name):
+        self.stats = QueryStats(name)
+
+    def __enter__(self):
+        _active_stats().append(self.stats)
+        return self.stats
+
+    def __exit__(self, *exc_info):
+        self.stats.duration = time.time() - self.stats.started
+        _active_stats().remove(self.stats)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    if _active_stats():
+        conn.info.setdefault('issues_query_start', []).append(time.time())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    stack = _active_stats()
+    starts = conn.info.get('issues_query_start')
+    if not stack or not starts:
+        return
+    duration = time.time() - starts.pop()
+    for stats in stack:
+        stats.add(statement, duration)
+
+event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+
+
+def enabled():
+    return toolkit.asbool(config.get('ckanext.issues.instrumentation'))
+
+
+def _log(stats):
+    log.info('issues.queries %s', json.dumps(stats.as_dict()))
+
+
+def instrument_action(name, action):
+    '''Wraps an action function so its queries are recorded and logged'''
+    @functools.wraps(action)
+    def wrapper(context, data_dict=None):
+        with record('action.{0}'.format(name)) as stats:
+            try:
+                return action(context, data_dict)
+            finally:
+                stats.duration = time.time() - stats.started
+                _log(stats)
+    return wrapper
+
+
+def instrument_controller(controller_class):
+    '''Class decorator recording the queries of each public controller
+    method, when instrumentation is enabled in the config'''
+    for attr, method in controller_class.__dict__.items():
+        if attr.startswith('_') or not callable(method):
+            continue
+        setattr(controller_class, attr,
+                _instrument_controller_method(controller_class, attr, method))
+    return controller_class
+
+
+def _instrument_controller_method(controller_class, attr, method):
+    name = 'controller.{0}.{1}'.format(controller_class.__name__, attr)
+
+    def instrumented(method, *args, **kwargs):
+        if not enabled():
+            return method(*args, **kwargs)
+        with record(name) as stats:
+            try:
+                return method(*args, **kwargs)
+            finally:
+                stats.duration = time.time() - stats.started
+                _log(stats)
+                if toolkit.asbool(config.get(
+                        'ckanext.issues.instrumentation.debug_header')):
+                    response.headers['X-Issues-Queries'] = \
+                        stats.header_value()
+    # decorator keeps the method's signature, so that Pylons passes it the
+    # same routing variables (and sets them on c) as the method itself
+    return decorator(instrumented, method)
@@ -0,0 +1,205 @@
+'''Sending notification emails over a pool of SMTP connections
+
+ckan.lib.mailer opens a new SMTP connection (and TLS session and login) for
+each email, so emailing every member of a big organization about an issue
+takes a connection per member, one after another. With
+ckanext.issues.smtp_pool_size set (e.g. to 4), the issues notifications are
+instead sent by up to that many threads at once, each over a connection
+taken from a pool that stays open between emails (and requests). The
+connection settings are CKAN's own: smtp.server, smtp.starttls, smtp.user,
+smtp.password and smtp.mail_from (or smtp.test_server, as for CKAN's
+mailer).
+
+Each message body is encoded once and shared by all its recipients, and
+send_messages returns the outcome of each message.
+'''
+import contextlib
+from email.header import Header
+from email.mime.text import MIMEText
+from email import utils as email_utils
+import logging
+from multiprocessing.pool import ThreadPool
+import Queue
+import smtplib
+import socket
+import threading
+import time
+
+from pylons import config
+
+import ckan
+from ckan.plugins import toolkit
+
+from ckanext.issues.lib import metrics
+from ckanext.issues.lib.helpers import get_site_title
+
+log = logging.getLogger(__name__)
+
+DEFAULT_TIMEOUT = 30
+
+_pool_lock = threading.Lock()
+_pool = [None, None]  # [settings, SMTPConnectionPool]
+
+
+def pool_size():
+    return toolkit.asint(config.get('ckanext.issues.smtp_pool_size', 0))
+
+
+def _settings():
+    '''Returns the SMTP settings, like ckan.lib.mailer'''
+    if config.get('smtp.test_server'):
+        # running tests
+        return config['smtp.test_server'], False, None, None
+    return (config.get('smtp.server', 'localhost'),
+            toolkit.asbool(config.get('smtp.starttls')),
+            config.get('smtp.user'), config.get('smtp.password'))
+
+
+def _close(conn):
+    try:
+        conn.quit()
+    except (smtplib.SMTPException, socket.error):
+        conn.close()
+
+
+class SMTPConnectionPool(object):
+    '''Up to size connections to an SMTP server, kept open to be reused'''
+
+    def __init__(self, size, server, starttls=False, user=None,
+                 password=None, timeout=DEFAULT_TIMEOUT):
+        self.size = size
+        self.server = server
+        self.starttls = starttls
+        self.user = user
+        self.password = password
+        self.timeout = timeout
+        self._idle = Queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+
+    def connect(self):
+        conn = smtplib.SMTP(self.server, timeout=self.timeout)
+        if self.starttls:
+            conn.ehlo()
+            conn.starttls()
+            conn.ehlo()
+        if self.user:
+            conn.login(self.user, self.password)
+        return conn
+
+    @contextlib.contextmanager
+    def connection(self):
+        '''Yields a connection, waiting while all size are in use. The
+        connection is closed rather than reused if the block fails.'''
+        with self._slots:
+            try:
+                conn = self._idle.get_nowait()
+            except Queue.Empty:
+                conn = self.connect()
+            try:
+                yield conn
+            except Exception:
+                _close(conn)
+                raise
+            self._idle.put(conn)
+
+    def close(self):
+        '''Closes the idle connections'''
+        while True:
+            try:
+                _close(self._idle.get_nowait())
+            except Queue.Empty:
+                return
+
+
+def get_pool():
+    '''Returns this process's pool, replacing it if the settings have
+    changed'''
+    settings = (pool_size(),) + _settings()
+    with _pool_lock:
+        if _pool[0] != settings:
+            if _pool[1] is not None:
+                _pool[1].close()
+            _pool[:] = [settings, SMTPConnectionPool(*settings)]
+        return _pool[1]
+
+
+def _address(name, email):
+    return email_utils.formataddr((Header(name, 'utf-8').encode(), email))
+
+
+def _shared_part(subject, body):
+    '''Returns the headers and encoded body that all recipients of a
+    message have in common'''
+    mail_from = config.get('smtp.mail_from')
+    part = MIMEText(body.encode('utf-8'), 'plain', 'utf-8')
+    part['From'] = _address(get_site_title(), mail_from)
+    part['Subject'] = Header(subject, 'utf-8')
+    part['X-Mailer'] = 'CKAN {0}'.format(ckan.__version__)
+    return part.as_string()
+
+
+def _message(shared_part, recipient_name, recipient_email):
+    return 'To: {0}\nDate: {1}\n{2}'.format(
+        _address(recipient_name, recipient_email),
+        email_utils.formatdate(time.time()), shared_part)
+
+
+def _send(args):
+    '''Sends one message, returning None or the error. Runs in a worker
+    thread, so it doesn't touch the database.'''
+    pool, recipient_email, message = args
+    mail_from = config.get('smtp.mail_from')
+    with metrics.timer('issues_notification_duration_seconds'):
+        for attempt in (1, 2):
+            try:
+                with pool.connection() as conn:
+                    conn.sendmail(mail_from, [recipient_email], message)
+                return None
+            except (smtplib.SMTPServerDisconnected, socket.error), e:
+                # the server may have closed idle connections, so try
+                # again over a new one
+                pool.close()
+                error = e
+            except smtplib.SMTPException, e:
+                return unicode(e) or e.__class__.__name__
+        return unicode(error) or error.__class__.__name__
+
+
+def send_messages(messages):
+    '''Emails each of messages, a list of (user_obj, subject, body), and
+    returns the outcome of each, in order: a dict with the user_id, email,
+    status ('sent' or 'failed') and any error'''
+    pool = get_pool()
+    shared_parts = {}
+    outcomes = []
+    jobs = []
+    for user_obj, subject, body in messages:
+        outcome = {'user_id': user_obj.id, 'email': user_obj.email,
+                   'status': 'failed', 'error': None}
+        outcomes.append(outcome)
+        if not user_obj.email:
+            outcome['error'] = u'No recipient email address available!'
+            continue
+        key = (subject, body)
+        if key not in shared_parts:
+            shared_parts[key] = _shared_part(subject, body)
+        jobs.append((outcome, (pool, user_obj.email, _message(
+            shared_parts[key], user_obj.display_name, user_obj.email))))
+
+    if jobs:
+        workers = ThreadPool(min(len(jobs), pool.size))
+        try:
+            errors = workers.map(_send, [job for outcome, job in jobs])
+        finally:
+            workers.close()
+        for (outcome, job), error in zip(jobs, errors):
+            outcome['error'] = error
+            if error is None:
+                outcome['status'] = 'sent'
+
+    for outcome in outcomes:
+        metrics.inc('issues_notifications_total', status=outcome['status'])
+        if outcome['error']:
+            log.debug('Failed to email %s: %s', outcome['email'],
+                      outcome['error'])
+    return outcomes
@@ -0,0 +1,272 @@
+'''In-process metrics for the issues extension, exposed for Prometheus
+
+Switched on with ckanext.issues.metrics = true. Counters and latency
+histograms are kept in memory by each process. When several worker
+processes serve the site (e.g. uWSGI), set ckanext.issues.metrics_dir to a
+directory shared by them: each process then periodically writes its totals
+to its own file there (every ckanext.issues.metrics_flush_interval seconds,
+default 5) and the metrics page adds up the files of all processes. Empty
+the directory when the site is (re)deployed.
+
+The metrics page is only served to sysadmins, to requests with the header
+`Authorization: Bearer <ckanext.issues.metrics_token>` (as Prometheus sends
+with bearer_token) and to the addresses in ckanext.issues.metrics_allowed_ips
+(separated by spaces).
+'''
+import atexit
+import functools
+import glob
+import hmac
+import json
+import os
+import threading
+import time
+import uuid
+
+from pylons import config
+
+from ckan.plugins import toolkit
+
+# seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0)
+DEFAULT_FLUSH_INTERVAL = 5
+
+HELP = {
+    'issues_action_requests_total':
+        'Calls of each issues action, by outcome',
+    'issues_action_duration_seconds':
+        'Time taken by each issues action',
+    'issues_notifications_total':
+        'Issue notification emails, by outcome',
+    'issues_notification_duration_seconds':
+        'Time taken to send an issue notification email',
+    'issues_cache_requests_total':
+        'Lookups in the issues caches, by result',
+}
+
+_lock = threading.Lock()
+_flush_lock = threading.Lock()
+_counters = {}    # (name, labels) -> value
+_histograms = {}  # (name, labels) -> [bucket counts..., +Inf count, sum]
+_process_file = None
+_last_flush = [0]
+
+
+def enabled():
+    return toolkit.asbool(config.get('ckanext.issues.metrics'))
+
+
+def authorized(environ, is_sysadmin=False):
+    '''Returns whether the request with environ may read the metrics'''
+    if is_sysadmin:
+        return True
+    token = config.get('ckanext.issues.metrics_token')
+    if token:
+        header = environ.get('HTTP_AUTHORIZATION', '')
+        if header.startswith('Bearer ') and \
+                hmac.compare_digest(header[len('Bearer '):].strip(),
+                                    str(token)):
+            return True
+    allowed_ips = config.get('ckanext.issues.metrics_allowed_ips', '').split()
+    return environ.get('REMOTE_ADDR') in allowed_ips
+
+
+def _labels(labels):
+    return tuple(sorted(labels.items()))
+
+
+def inc(name, amount=1, **labels):
+    '''Adds amount to the counter name'''
+    if not enabled():
+        return
+    key = (name, _labels(labels))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + amount
+    _maybe_flush()
+
+
+def observe(name, value, **labels):
+    '''Records value (in seconds) in the histogram name'''
+    if not enabled():
+        return
+    key = (name, _labels(labels))
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = [0] * (len(DEFAULT_BUCKETS) + 2)
+        for i, bound in enumerate(DEFAULT_BUCKETS):
+            if value <= bound:
+                histogram[i] += 1
+        histogram[-2] += 1
+        histogram[-1] += value
+    _maybe_flush()
+
+
+class timer(object):
+    '''Context manager observing the time its block takes in a histogram'''
+    def __init__(self, name, **labels):
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        observe(self.name, time.time() - self.start, **self.labels)
+
+
+def instrument_action(name, action):
+    '''Wraps an action function to count its calls and time them'''
+    @functools.wraps(action)
+    def wrapper(context, data_dict=None):
+        start = time.time()
+        status = 'error'
+        try:
+            result = action(context, data_dict)
+            status = 'ok'
+            return result
+        finally:
+            inc('issues_action_requests_total', action=name, status=status)
+            observe('issues_action_duration_seconds', time.time() - start,
+                    action=name)
+    return wrapper
+
+
+# Aggregation across processes
+
+def _metrics_dir():
+    return config.get('ckanext.issues.metrics_dir')
+
+
+def _snapshot():
+    with _lock:
+        return {
+            'counters': [[name, list(labels), value]
+                         for (name, labels), value in _counters.items()],
+            'histograms': [[name, list(labels), list(values)]
+                           for (name, labels), values
+                           in _histograms.items()],
+        }
+
+
+def flush():
+    '''Writes this process's totals to its file in the metrics dir'''
+    global _process_file
+    metrics_dir = _metrics_dir()
+    if not metrics_dir:
+        return
+    if _process_file is None:
+        _process_file = os.path.join(
+            metrics_dir, 'issues-metrics-{0}-{1}.json'.format(
+                os.getpid(), uuid.uuid4().hex))
+    with _flush_lock:
+        _last_flush[0] = time.time()
+        tmp_file = _process_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(_snapshot(), f)
+        # rename is atomic, so readers never see a partly written file
+        os.rename(tmp_file, _process_file)
+
+
+def _maybe_flush():
+    interval = toolkit.asint(config.get(
+        'ckanext.issues.metrics_flush_interval', DEFAULT_FLUSH_INTERVAL))
+    if _metrics_dir() and time.time() - _last_flush[0] > interval:
+        flush()
+
+
+def _flush_at_exit():
+    if _counters or _histograms:
+        try:
+            flush()
+        except (IOError, OSError, TypeError):
+            # TypeError: the pylons config has already gone
+            pass
+
+atexit.register(_flush_at_exit)
+
+
+def _collect():
+    '''Returns the counters and histograms of all processes, summed'''
+    metrics_dir = _metrics_dir()
+    if not metrics_dir:
+        snapshots = [_snapshot()]
+    else:
+        flush()
+        snapshots = []
+        for path in glob.glob(os.path.join(metrics_dir,
+                                           'issues-metrics-*.json')):
+            try:
+                with open(path) as f:
+                    snapshots.append(json.load(f))
+            except (IOError, ValueError):
+                continue
+    counters = {}
+    histograms = {}
+    for snapshot in snapshots:
+        for name, labels, value in snapshot['counters']:
+            key = (name, tuple(tuple(label) for label in labels))
+            counters[key] = counters.get(key, 0) + value
+        for name, labels, values in snapshot['histograms']:
+            key = (name, tuple(tuple(label) for label in labels))
+            totals = histograms.setdefault(key, [0] * len(values))
+            for i, value in enumerate(values):
+                totals[i] += value
+    return counters, histograms
+
+
+def _format_labels(labels, extra=()):
+    labels = list(labels) + list(extra)
+    if not labels:
+        return ''
+    return '{' + ','.join('{0}="{1}"'.format(
+        key, unicode(value).replace('\\', '\\\\').replace('"', '\\"'))
+        for key, value in labels) + '}'
+
+
+def _format_number(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def exposition():
+    '''Returns all the metrics in the Prometheus text exposition format'''
+    counters, histograms = _collect()
+    lines = []
+    for metric_name in sorted(set(name for name, _ in counters)):
+        lines.append('# HELP {0} {1}'.format(metric_name,
+                                             HELP.get(metric_name, '')))
+        lines.append('# TYPE {0} counter'.format(metric_name))
+        for (name, labels), value in sorted(counters.items()):
+            if name == metric_name:
+                lines.append('{0}{1} {2}'.format(
+                    name, _format_labels(labels), _format_number(value)))
+    for metric_name in sorted(set(name for name, _ in histograms)):
+        lines.append('# HELP {0} {1}'.format(metric_name,
+                                             HELP.get(metric_name, '')))
+        lines.append('# TYPE {0} histogram'.format(metric_name))
+        for (name, labels), values in sorted(histograms.items()):
+            if name != metric_name:
+                continue
+            for bound, count in zip(DEFAULT_BUCKETS, values):
+                lines.append('{0}_bucket{1} {2}'.format(
+                    name, _format_labels(labels, [('le', repr(bound))]),
+                    count))
+            lines.append('{0}_bucket{1} {2}'.format(
+                name, _format_labels(labels, [('le', '+Inf')]),
+                values[-2]))
+            lines.append('{0}_count{1} {2}'.format(
+                name, _format_labels(labels), values[-2]))
+            lines.append('{0}_sum{1} {2}'.format(
+                name, _format_labels(labels), _format_number(values[-1])))
+    return '\n'.join(lines) + '\n'
+
+
+def reset():
+    '''Clears this process's metrics (for tests)'''
+    with _lock:
+        _counters.clear()
+        _histograms.clear()
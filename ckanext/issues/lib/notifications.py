@@ -0,0 +1,190 @@
+'''Email notifications of new issues and comments
+
+Each recipient is emailed about each event straight away ('immediate'), or
+in an hourly or daily digest, as set for them or by default for their
+organization (issue_notification_frequency_update), else by
+ckanext.issues.notification_frequency (default 'immediate'). The events for
+digests are queued in the issue_notification table, and `paster issues
+send-digests hourly` and `paster issues send-digests daily` (run by cron)
+email each recipient one digest of theirs.
+
+The emails are sent with ckan.lib.mailer, or over pooled SMTP connections
+when ckanext.issues.smtp_pool_size is set (see ckanext.issues.lib.mail).
+'''
+import collections
+import logging
+
+from pylons import config
+
+from ckan import model
+from ckan.lib import mailer
+from ckan.lib.base import render_jinja2
+import ckan.lib.helpers as h
+
+from ckanext.issues import model as issuemodel
+from ckanext.issues.lib import mail, metrics
+from ckanext.issues.lib.helpers import get_site_title
+
+log = logging.getLogger(__name__)
+
+DEFAULT_FREQUENCY = 'immediate'
+DIGEST_BATCH_SIZE = 50
+
+
+def send_notification(user_obj, subject, body):
+    '''Emails a notification to a user, logging any failure, and returns
+    the outcome (as for send_notifications)'''
+    outcome = {'user_id': user_obj.id, 'email': user_obj.email,
+               'status': 'sent', 'error': None}
+    with metrics.timer('issues_notification_duration_seconds'):
+        try:
+            mailer.mail_user(user_obj, subject, body)
+        except (mailer.MailerException, TypeError), e:
+            # TypeError occurs when we're running command from ckanapi
+            outcome['status'] = 'failed'
+            outcome['error'] = unicode(e)
+            log.debug(e.message)
+    metrics.inc('issues_notifications_total', status=outcome['status'])
+    return outcome
+
+
+def send_notifications(messages):
+    '''Emails each of messages, a list of (user_obj, subject, body), and
+    returns the outcome of each: a dict with the user_id, email, status
+    ('sent' or 'failed') and any error'''
+    if mail.pool_size() > 0:
+        return mail.send_messages(messages)
+    return [send_notification(user_obj, subject, body)
+            for user_obj, subject, body in messages]
+
+
+def send_to_users(session, user_ids, subject, body):
+    '''Emails the same notification to each of user_ids'''
+    if not user_ids:
+        return []
+    users = session.query(model.User)\
+        .filter(model.User.id.in_(user_ids)).all()
+    return send_notifications([(user_obj, subject, body)
+                               for user_obj in users])
+
+
+def default_frequency():
+    return config.get('ckanext.issues.notification_frequency',
+                      DEFAULT_FREQUENCY)
+
+
+def queue_for_digests(session, recipients, organization_id, event, issue,
+                      actor_id, comment=None):
+    '''Queues the event for the recipients who get digests, and returns the
+    recipients to email straight away. The caller commits.'''
+    frequencies = issuemodel.IssueNotificationFrequency.frequencies(
+        session, recipients, organization_id, default_frequency())
+    immediate = []
+    for recipient in recipients:
+        frequency = frequencies[recipient]
+        if frequency == 'immediate':
+            immediate.append(recipient)
+            continue
+        session.add(issuemodel.IssueNotification(
+            user_id=recipient,
+            frequency=frequency,
+            event=event,
+            issue_id=issue.id,
+            actor_id=actor_id,
+            comment_id=comment.id if comment is not None else None,
+        ))
+    return immediate
+
+
+def _digest_subject(count):
+    return u'[{0}] {1} new issue {2}'.format(
+        get_site_title(), count, 'update' if count == 1 else 'updates')
+
+
+def send_digests(session, frequency):
+    '''Emails each recipient one digest of their queued notifications of
+    frequency, and returns the number of emails sent'''
+    Notification = issuemodel.IssueNotification
+    notifications = session.query(Notification)\
+        .filter(Notification.frequency == frequency)\
+        .order_by(Notification.user_id, Notification.id).all()
+    if not notifications:
+        return 0
+
+    # load everything the digests refer to up front, rather than per email
+    issues = dict(
+        (issue.id, issue) for issue in session.query(issuemodel.Issue)
+        .filter(issuemodel.Issue.id.in_(
+            set(n.issue_id for n in notifications))))
+    comment_ids = set(n.comment_id for n in notifications if n.comment_id)
+    comments = {}
+    if comment_ids:
+        comments = dict(
+            (comment.id, comment) for comment
+            in session.query(issuemodel.IssueComment)
+            .filter(issuemodel.IssueComment.id.in_(comment_ids)))
+    user_ids = set(n.user_id for n in notifications) | \
+        set(n.actor_id for n in notifications)
+    users = dict((user.id, user) for user in session.query(model.User)
+                 .filter(model.User.id.in_(user_ids)))
+    datasets = dict(
+        (dataset.id, dataset) for dataset in session.query(model.Package)
+        .filter(model.Package.id.in_(
+            set(issue.dataset_id for issue in issues.values()))))
+
+    by_user = collections.OrderedDict()
+    for notification in notifications:
+        by_user.setdefault(notification.user_id, []).append(notification)
+
+    sent = 0
+    messages = []
+    done = []
+    for user_id, user_notifications in by_user.items():
+        # group the events by issue, in the order they happened
+        events = collections.OrderedDict()
+        for notification in user_notifications:
+            issue = issues.get(notification.issue_id)
+            if issue is None or issue.visibility != u'visible':
+                # the issue has since been deleted or hidden by moderation
+                continue
+            comment = None
+            if notification.event != 'issue.created':
+                # only new issues and comments are in the digest
+                comment = comments.get(notification.comment_id)
+                if comment is None or comment.visibility != u'visible':
+                    continue
+            events.setdefault(issue, []).append({
+                'event': notification.event,
+                'actor': users.get(notification.actor_id),
+                'comment': comment,
+            })
+        user_obj = users.get(user_id)
+        if events and user_obj is not None:
+            body = render_jinja2('issues/email/digest.html', extra_vars={
+                'user': user_obj,
+                'frequency': frequency,
+                'issues': [(issue, datasets.get(issue.dataset_id),
+                            issue_events)
+                           for issue, issue_events in events.items()],
+                'site_title': get_site_title(),
+                'h': h,
+            })
+            messages.append((user_obj, _digest_subject(
+                sum(len(issue_events) for issue_events in events.values())),
+                body))
+        done.extend(user_notifications)
+        if len(messages) >= DIGEST_BATCH_SIZE:
+            sent += _send_digest_batch(session, messages, done)
+            messages, done = [], []
+    sent += _send_digest_batch(session, messages, done)
+    return sent
+
+
+def _send_digest_batch(session, messages, notifications):
+    outcomes = send_notifications(messages)
+    for notification in notifications:
+        session.delete(notification)
+    # so that a failure part way can only send the one batch twice
+    session.commit()
+    return len([outcome for outcome in outcomes
+                if outcome['status'] == 'sent'])
@@ -0,0 +1,266 @@
+'''Rate limits on creating issues, comments and reports
+
+Each user and each IP address has a token bucket per kind of write (issue,
+comment and report), set as `<requests>/<seconds>`:
+
+    ckanext.issues.rate_limit.issue.user = 10/3600
+    ckanext.issues.rate_limit.issue.ip = 30/3600
+    ckanext.issues.rate_limit.comment.user = 30/600
+    ckanext.issues.rate_limit.comment.ip = 100/600
+    ckanext.issues.rate_limit.report.user = 20/3600
+    ckanext.issues.rate_limit.report.ip = 50/3600
+
+A bucket holds up to <requests> tokens, a write takes one and they are
+replaced at <requests> per <seconds>, so that short bursts are allowed.
+Limits that are not set are not applied, and sysadmins are not limited.
+
+The buckets are kept, with ckanext.issues.rate_limit.backend:
+
+* memory (the default) in each process, so with several worker processes
+  the effective limit is that many times higher
+* database in the issue_rate_limit table, shared by all the processes
+
+The client's IP address is REMOTE_ADDR or, behind a proxy, the last address
+in the header named by ckanext.issues.rate_limit.ip_header (e.g.
+X-Forwarded-For).
+
+Writes over a limit raise RateLimited, which RateLimitMiddleware turns into
+a 429 Too Many Requests response, with a Retry-After header.
+'''
+import json
+import logging
+import math
+import threading
+import time
+
+from pylons import config, request
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.sql.expression import select
+
+from ckan.model import meta
+from ckan.plugins import toolkit
+try:
+    import ckan.authz as authz
+except ImportError:
+    import ckan.new_authz as authz
+
+from ckanext.issues import model as issuemodel
+from ckanext.issues.exception import RateLimited
+
+log = logging.getLogger(__name__)
+
+SCOPES = ('user', 'ip')
+DEFAULT_BACKEND = 'memory'
+
+_backends = {}
+_backends_lock = threading.Lock()
+
+
+def parse_limit(value):
+    '''Returns (requests, seconds) for a limit set as "requests/seconds"'''
+    try:
+        requests, seconds = [float(part) for part in value.split('/')]
+    except ValueError:
+        raise ValueError('Rate limits are set as <requests>/<seconds>, not '
+                         '{0!r}'.format(value))
+    if requests < 1 or seconds <= 0:
+        raise ValueError('Invalid rate limit {0!r}'.format(value))
+    return requests, seconds
+
+
+def limits(kind):
+    '''Returns {scope: (requests, seconds)} for the limits set on kind'''
+    kind_limits = {}
+    for scope in SCOPES:
+        value = config.get('ckanext.issues.rate_limit.{0}.{1}'.format(
+            kind, scope))
+        if value:
+            kind_limits[scope] = parse_limit(value)
+    return kind_limits
+
+
+def _refill(bucket, limit, now):
+    '''Returns the tokens in bucket, a (tokens, updated) pair or None for a
+    new bucket, at time now'''
+    requests, seconds = limit
+    if bucket is None:
+        return requests
+    tokens, updated = bucket
+    return min(requests,
+               tokens + max(now - updated, 0) * float(requests) / seconds)
+
+
+def _wait(tokens, limit):
+    '''Returns the seconds until a bucket with tokens has a whole one'''
+    requests, seconds = limit
+    return max(1 - tokens, 0) * float(seconds) / requests
+
+
+class MemoryBackend(object):
+    '''Token buckets in a dict, for this process only'''
+    max_buckets = 100000
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._buckets = {}
+
+    def take(self, key_limits, now):
+        '''Takes a token from each of the buckets, given as {key: limit},
+        unless any is empty. Returns the seconds to wait until they all
+        have a token, or 0 if they were taken.'''
+        with self._lock:
+            tokens = {}
+            for key, limit in key_limits.items():
+                bucket = self._buckets.get(key)
+                tokens[key] = _refill(bucket and bucket[:2], limit, now)
+            wait = max(_wait(tokens[key], limit)
+                       for key, limit in key_limits.items())
+            if wait:
+                return wait
+            if len(self._buckets) >= self.max_buckets:
+                self._evict_full(now)
+            for key, limit in key_limits.items():
+                self._buckets[key] = (tokens[key] - 1, now, limit)
+            return 0
+
+    def _evict_full(self, now):
+        # a bucket that has refilled is the same as no bucket at all
+        for key, (tokens, updated, limit) in self._buckets.items():
+            if _refill((tokens, updated), limit, now) >= limit[0]:
+                del self._buckets[key]
+
+
+class DatabaseBackend(object):
+    '''Token buckets in the issue_rate_limit table, shared by all processes
+
+    Each take is its own short transaction, apart from the request's, so that
+    tokens are taken even if the request then fails.
+    '''
+
+    def take(self, key_limits, now):
+        try:
+            return self._take(key_limits, now)
+        except IntegrityError:
+            # another process created one of the buckets first
+            return self._take(key_limits, now)
+
+    def _take(self, key_limits, now):
+        table = issuemodel.issue_rate_limit_table
+        keys = sorted(key_limits)
+        with meta.engine.begin() as connection:
+            # lock the rows in key order, so that concurrent takes don't
+            # deadlock
+            buckets = dict(
+                (row.key, (row.tokens, row.updated))
+                for row in connection.execute(
+                    select([table]).where(table.c.key.in_(keys))
+                    .order_by(table.c.key).with_for_update()))
+            tokens = dict((key, _refill(buckets.get(key), limit, now))
+                          for key, limit in key_limits.items())
+            wait = max(_wait(tokens[key], limit)
+                       for key, limit in key_limits.items())
+            if wait:
+                return wait
+            for key in keys:
+                values = {'tokens': tokens[key] - 1, 'updated': now}
+                if key in buckets:
+                    connection.execute(table.update()
+                                       .where(table.c.key == key)
+                                       .values(**values))
+                else:
+                    connection.execute(table.insert().values(key=key,
+                                                             **values))
+            return 0
+
+
+BACKENDS = {
+    'memory': MemoryBackend,
+    'database': DatabaseBackend,
+}
+
+
+def get_backend():
+    '''Returns the rate limit backend chosen in the config'''
+    name = config.get('ckanext.issues.rate_limit.backend', DEFAULT_BACKEND)
+    with _backends_lock:
+        backend = _backends.get(name)
+        if backend is None:
+            if name not in BACKENDS:
+                raise ValueError(
+                    'Unknown ckanext.issues.rate_limit.backend: {0}'
+                    .format(name))
+            backend = _backends[name] = BACKENDS[name]()
+    return backend
+
+
+def client_ip():
+    '''Returns the IP address of the client of the current request, or None
+    outside a request'''
+    try:
+        environ = request.environ
+    except TypeError:
+        # no request (e.g. paster commands and tests calling actions)
+        return None
+    header = config.get('ckanext.issues.rate_limit.ip_header')
+    if header:
+        forwarded = environ.get('HTTP_' + header.upper().replace('-', '_'))
+        if forwarded:
+            return forwarded.split(',')[-1].strip()
+    return environ.get('REMOTE_ADDR')
+
+
+def check(context, kind):
+    '''Takes a token for a write of kind (issue, comment or report) from the
+    buckets of the user of context and the client's IP address
+
+    :raises RateLimited: if either bucket is empty
+    '''
+    kind_limits = limits(kind)
+    if not kind_limits:
+        return
+    user = context.get('user')
+    if user and authz.is_sysadmin(user):
+        return
+    identities = {'user': user, 'ip': client_ip()}
+    key_limits = dict(
+        (u'{0}:{1}:{2}'.format(kind, scope, identities[scope]), limit)
+        for scope, limit in kind_limits.items() if identities[scope])
+    if not key_limits:
+        return
+    wait = get_backend().take(key_limits, time.time())
+    if wait:
+        log.info('Rate limited %s by %s from %s', kind, user,
+                 identities['ip'])
+        raise RateLimited(
+            toolkit._('Too many requests. Please try again in {0} seconds.')
+            .format(int(math.ceil(wait))), int(math.ceil(wait)))
+
+
+class RateLimitMiddleware(object):
+    '''Responds to requests that raised RateLimited with a 429 Too Many
+    Requests, as JSON for the action API'''
+
+    def __init__(self, app):
+        self.app = app
+
+    def __call__(self, environ, start_response):
+        try:
+            return self.app(environ, start_response)
+        except RateLimited, e:
+            if environ.get('PATH_INFO', '').startswith('/api/'):
+                content_type = 'application/json;charset=utf-8'
+                body = json.dumps({
+                    'help': None,
+                    'success': False,
+                    'error': {'__type': 'Rate Limited',
+                              'message': e.message},
+                })
+            else:
+                content_type = 'text/plain;charset=utf-8'
+                body = e.message.encode('utf8')
+            start_response('429 Too Many Requests', [
+                ('Content-Type', content_type),
+                ('Content-Length', str(len(body))),
+                ('Retry-After', str(e.retry_after)),
+            ])
+            return [body]
@@ -0,0 +1,147 @@
+'''Routing of the read-only issues actions to a database read replica
+
+When ckanext.issues.read_replica_url is set, the side-effect-free issues
+actions (and so the issue listing pages, which call them) are given a
+session bound to that database instead of the primary one. Other
+ckanext.issues.read_replica_* options are passed on to the engine, as for
+sqlalchemy.engine_from_config, e.g. ckanext.issues.read_replica_pool_size.
+
+Replicas lag behind the primary, so a user who has just changed something
+keeps reading from the primary for ckanext.issues.read_your_writes_seconds
+(default 10). A write is remembered by the process that handled it and, for
+browsers, in a cookie, so that the page they are redirected to is read from
+the primary whichever process serves it.
+'''
+import functools
+import threading
+import time
+
+from pylons import config, request, response
+from sqlalchemy import engine_from_config
+from sqlalchemy.orm import scoped_session, sessionmaker
+
+import ckan.model as model
+from ckan.plugins import toolkit
+
+CONFIG_PREFIX = 'ckanext.issues.read_replica_'
+COOKIE_NAME = 'ckanext_issues_wrote'
+DEFAULT_READ_YOUR_WRITES_SECONDS = 10
+
+READ_ACTIONS = (
+    'issue_search',
+    'issue_show',
+    'issue_report_show',
+    'issue_comment_search',
+    'issue_moderation_queue',
+    'issue_user_dashboard',
+    # not issue_changes: its feed position must be read from the primary,
+    # where the change log lock is held and the rows are written
+    'organization_users_autocomplete',
+)
+
+_lock = threading.Lock()
+_session = []
+_writes = {}  # user name -> time of their last write
+
+
+def enabled():
+    return bool(config.get(CONFIG_PREFIX + 'url'))
+
+
+def get_session():
+    '''Returns the scoped session bound to the read replica'''
+    if not _session:
+        with _lock:
+            if not _session:
+                engine = engine_from_config(config, CONFIG_PREFIX)
+                _session.append(scoped_session(sessionmaker(
+                    bind=engine, autoflush=False, autocommit=False)))
+    return _session[0]
+
+
+def _window():
+    return toolkit.asint(config.get('ckanext.issues.read_your_writes_seconds',
+                                    DEFAULT_READ_YOUR_WRITES_SECONDS))
+
+
+def _request_cookie():
+    try:
+        return request.cookies.get(COOKIE_NAME)
+    except TypeError:
+        # not in a web request, e.g. a paster command
+        return None
+
+
+def record_write(user):
+    '''Notes that user has just changed something'''
+    now = time.time()
+    with _lock:
+        _writes[user] = now
+        window = _window()
+        for name, written in _writes.items():
+            if now - written > window:
+                del _writes[name]
+    try:
+        response.set_cookie(COOKIE_NAME, str(int(now)), max_age=_window(),
+                            httponly=True)
+    except TypeError:
+        pass
+
+
+def recently_wrote(user):
+    '''Returns True if user changed something within the read-your-writes
+    window, so should read from the primary'''
+    now = time.time()
+    written = _writes.get(user)
+    if written is not None and now - written <= _window():
+        return True
+    cookie = _request_cookie()
+    if cookie:
+        try:
+            return now - int(cookie) <= _window()
+        except ValueError:
+            pass
+    return False
+
+
+def route_read_action(action):
+    '''Wraps a side-effect-free action to read from the replica, unless the
+    user has just made a change'''
+    @functools.wraps(action)
+    def wrapper(context, data_dict=None):
+        if context.get('session', model.Session) is not model.Session or \
+                recently_wrote(context.get('user')):
+            # a session chosen by the caller (or an outer action) is kept
+            return action(context, data_dict)
+        replica_session = get_session()
+        context['session'] = replica_session
+        try:
+            return action(context, data_dict)
+        finally:
+            context['session'] = model.Session
+            replica_session.remove()
+    return wrapper
+
+
+def record_write_action(action):
+    '''Wraps an action that makes changes, to note who made them'''
+    @functools.wraps(action)
+    def wrapper(context, data_dict=None):
+        result = action(context, data_dict)
+        if context.get('user'):
+            record_write(context['user'])
+        return result
+    return wrapper
+
+
+def route_actions(actions):
+    '''Returns the actions wrapped for read replica routing'''
+    routed = {}
+    for name, action in actions.items():
+        if name in READ_ACTIONS:
+            routed[name] = route_read_action(action)
+        elif not getattr(action, 'side_effect_free', False):
+            routed[name] = record_write_action(action)
+        else:
+            routed[name] = action
+    return routed
@@ -0,0 +1,139 @@
+'''Deleting confirmed spam
+
+Issues and comments that moderators have confirmed as spam (abuse_status
+abuse) are kept for ckanext.issues.spam_retention_days (default 30) after
+they were confirmed, in case of appeals, and then deleted by `paster issues
+purge-spam`: issues that many days after they were last updated (which
+confirming them does), and comments that many days after they were
+moderated. Their comments and reports go with them. Each batch is locked
+and checked again before it is deleted, so that spam found not to be after
+all is kept.
+
+They are deleted ckanext.issues.purge_batch_size (default 200) at a time,
+each batch in its own short transaction, with a pause of
+ckanext.issues.purge_pause (default 0.1) seconds between batches, so the
+purge can run while the site is in use.
+'''
+from datetime import datetime, timedelta
+import logging
+import time
+
+from pylons import config
+from sqlalchemy import func
+from sqlalchemy.sql.expression import and_, or_, select
+
+from ckan.plugins import toolkit
+
+from ckanext.issues import model as issuemodel
+from ckanext.issues.lib import search
+
+log = logging.getLogger(__name__)
+
+DEFAULT_RETENTION_DAYS = 30
+DEFAULT_BATCH_SIZE = 200
+DEFAULT_PAUSE = 0.1
+
+
+def spam_before():
+    '''Returns the time before which confirmed spam is deleted'''
+    days = toolkit.asint(config.get('ckanext.issues.spam_retention_days',
+                                    DEFAULT_RETENTION_DAYS))
+    return datetime.now() - timedelta(days=days)
+
+
+def _spam_issues(before):
+    issues = issuemodel.issue_table
+    return and_(issues.c.abuse_status == issuemodel.AbuseStatus.abuse.value,
+                issues.c.updated < before)
+
+
+def _spam_comments(before):
+    comments = issuemodel.issue_comment_table
+    return and_(comments.c.abuse_status ==
+                issuemodel.AbuseStatus.abuse.value,
+                comments.c.moderated < before)
+
+
+def _lock(session, table, ids, where):
+    '''Locks the rows of table with ids that still match where, until the
+    transaction ends, and returns their ids'''
+    return [row[0] for row in session.execute(
+        select([table.c.id]).where(table.c.id.in_(ids)).where(where)
+        .with_for_update())]
+
+
+def count_spam(session, before=None):
+    '''Returns the numbers of rows purge_spam would delete, as a dict of
+    issues, comments (including those of the issues) and reports'''
+    if before is None:
+        before = spam_before()
+    issues = issuemodel.issue_table
+    comments = issuemodel.issue_comment_table
+    issue_reports, comment_reports = issuemodel.report_tables
+    issue_ids = select([issues.c.id]).where(_spam_issues(before))
+    comment_ids = select([comments.c.id]).where(or_(
+        comments.c.issue_id.in_(issue_ids), _spam_comments(before)))
+
+    def count(table, where):
+        return session.execute(select([func.count()]).select_from(table)
+                               .where(where)).scalar()
+    return {
+        'issues': count(issues, _spam_issues(before)),
+        'comments': count(comments, comments.c.id.in_(comment_ids)),
+        'reports': count(issue_reports,
+                         issue_reports.c.parent_id.in_(issue_ids)) +
+        count(comment_reports, comment_reports.c.parent_id.in_(comment_ids)),
+    }
+
+
+def _batches(session, table, where, batch_size):
+    '''Yields the ids of the rows of table matching where, batch_size at a
+    time, walking the primary key so that each batch is a short scan'''
+    last_id = 0
+    while True:
+        ids = [row[0] for row in session.execute(
+            select([table.c.id]).where(where).where(table.c.id > last_id)
+            .order_by(table.c.id).limit(batch_size))]
+        if not ids:
+            return
+        yield ids
+        last_id = ids[-1]
+
+
+def purge_spam(session, before=None, batch_size=None, pause=None):
+    '''Deletes the confirmed spam older than `before` (by default,
+    spam_before()), a batch per transaction, and returns the numbers of
+    (issues, comments) deleted, not counting the comments of the issues'''
+    if before is None:
+        before = spam_before()
+    if batch_size is None:
+        batch_size = toolkit.asint(config.get(
+            'ckanext.issues.purge_batch_size', DEFAULT_BATCH_SIZE))
+    if pause is None:
+        pause = float(config.get('ckanext.issues.purge_pause',
+                                 DEFAULT_PAUSE))
+
+    issue_count = 0
+    for issue_ids in _batches(session, issuemodel.issue_table,
+                              _spam_issues(before), batch_size):
+        issue_ids = _lock(session, issuemodel.issue_table, issue_ids,
+                          _spam_issues(before))
+        issuemodel.delete_issues(session, issue_ids)
+        session.commit()
+        search.delete_issues(issue_ids)
+        issue_count += len(issue_ids)
+        log.info('Deleted %s spam issues', issue_count)
+        time.sleep(pause)
+
+    comment_count = 0
+    for comment_ids in _batches(session, issuemodel.issue_comment_table,
+                                _spam_comments(before), batch_size):
+        comment_ids = _lock(session, issuemodel.issue_comment_table,
+                            comment_ids, _spam_comments(before))
+        issue_ids = issuemodel.delete_comments(session, comment_ids)
+        session.commit()
+        search.index_issues(session, issue_ids)
+        comment_count += len(comment_ids)
+        log.info('Deleted %s spam comments', comment_count)
+        time.sleep(pause)
+    return issue_count, comment_count
@@ -0,0 +1,283 @@
+'''Issue search backends
+
+issue_search finds issues through a search backend, chosen with
+ckanext.issues.search_backend:
+
+* sql (the default) queries the issue tables of the CKAN database
+* sqlite_fts keeps an SQLite FTS5 index of the issues in a local file, so
+  that text searches and facet counts don't touch the CKAN database (see
+  ckanext.issues.lib.sqlite_search)
+
+or 'module:Class' for a class implementing IssueSearchBackend.
+
+The issue and comment actions tell the backend about each change with
+index_issue and delete_issue, and `paster issues search-index rebuild`
+re-indexes everything. The issues deleted along with a dataset, resource or
+user (see ckanext.issues.model.delete_issues) are taken out of the index in
+batches once the deletion is committed.
+'''
+import importlib
+import logging
+
+from ckan.model import Session
+
+from pylons import config
+from sqlalchemy import event, func, orm, types
+from sqlalchemy.sql.expression import cast, literal, literal_column
+
+from ckanext.issues import model as issuemodel
+
+log = logging.getLogger(__name__)
+
+DEFAULT_BACKEND = 'sql'
+BACKENDS = {
+    'sql': 'ckanext.issues.lib.search:SqlSearchBackend',
+    'sqlite_fts': 'ckanext.issues.lib.sqlite_search:SqliteFtsSearchBackend',
+}
+FACET_FIELDS = ('status', 'visibility', 'abuse_status', 'assignee_id',
+                'category_id', 'dataset_id')
+# the issue_search parameters that select issues (as opposed to paging,
+# sorting and what to include in the results)
+FILTERS = ('organization_id', 'dataset_id', 'status', 'q', 'visibility',
+           'abuse_status', 'category_id', 'assignee_id', 'user_id',
+           'include_sub_organizations')
+
+_backends = {}
+
+
+class SearchIndexError(Exception):
+    pass
+
+
+class IssueSearchBackend(object):
+    '''The operations issue_search needs from a search backend
+
+    filters are the validated issue_search parameters: organization_id,
+    dataset_id, status, q, visibility, abuse_status (an AbuseStatus),
+    category_id, assignee_id, user_id, include_sub_organizations, sort (an
+    IssueFilter), offset and limit.
+    '''
+
+    def search(self, session, filters, include_count=True,
+               include_results=True, include_reports=False, fields=None):
+        '''Returns (count, rows) for the issues matching filters
+
+        rows are (issue, user name, comment count, last comment time)
+        tuples, as from Issue.get_issues, or with fields (the issue_search
+        fields wanted) the named tuples of Issue.get_issue_rows. count is
+        None unless include_count, and rows are empty unless
+        include_results.
+        '''
+        raise NotImplementedError
+
+    def facet_counts(self, session, filters, fields=FACET_FIELDS):
+        '''Returns {field: {value: number of issues}} for each of fields,
+        over the issues matching filters'''
+        raise NotImplementedError
+
+    def index_issue(self, session, issue):
+        '''Adds issue to the index, or updates it there'''
+        raise NotImplementedError
+
+    def delete_issue(self, issue_id):
+        '''Removes an issue from the index'''
+        raise NotImplementedError
+
+    def index_issues(self, session, issue_ids):
+        '''Adds the issues to the index, or updates them there'''
+        for issue in session.query(issuemodel.Issue)\
+                .filter(issuemodel.Issue.id.in_(issue_ids)):
+            self.index_issue(session, issue)
+
+    def delete_issues(self, issue_ids):
+        '''Removes the issues from the index'''
+        for issue_id in issue_ids:
+            self.delete_issue(issue_id)
+
+    def rebuild(self, session):
+        '''Re-indexes every issue and returns how many there are'''
+        raise NotImplementedError
+
+
+def filter_args(filters):
+    return dict((key, value) for key, value in filters.items()
+                if key in FILTERS)
+
+
+class SqlSearchBackend(IssueSearchBackend):
+    '''Searches the issue tables directly, so there is no index to keep'''
+
+    def search(self, session, filters, include_count=True,
+               include_results=True, include_reports=False, fields=None):
+        if fields is not None:
+            query = issuemodel.Issue.get_issue_rows(fields, session=session,
+                                                    **filters)
+        else:
+            query = issuemodel.Issue.get_issues(
+                session=session, include_reports=include_reports, **filters)
+        count = query.count() if include_count else None
+        rows = query.all() if include_results else []
+        return count, rows
+
+    def facet_counts(self, session, filters, fields=FACET_FIELDS):
+        '''Counts the issues by all of their columns in fields in a single
+        query: with GROUPING SETS where the database has them (PostgreSQL
+        9.5+), otherwise with a UNION ALL of a GROUP BY for each field. An
+        issue can have several categories, so those are counted separately.
+        '''
+        column_fields = [field for field in fields if field != 'category_id']
+        facets = {}
+        if column_fields:
+            dialect = session.get_bind().dialect
+            if dialect.name == 'postgresql' and \
+                    dialect.server_version_info >= (9, 5):
+                facets = self._grouping_sets_facet_counts(
+                    session, filters, column_fields)
+            else:
+                facets = self._union_facet_counts(session, filters,
+                                                  column_fields)
+        if 'category_id' in fields:
+            facets['category_id'] = self._category_facet_counts(session,
+                                                                filters)
+        return facets
+
+    def _filtered(self, query, filters):
+        return issuemodel.Issue.apply_filters_to_an_issue_query(
+            query.select_from(issuemodel.Issue), **filter_args(filters))
+
+    def _grouping_sets_facet_counts(self, session, filters, fields):
+        columns = [issuemodel.issue_table.c[field] for field in fields]
+        # GROUPING(column) is 0 in the rows grouped by that column
+        query = session.query(*(columns +
+                                [func.count(issuemodel.Issue.id)] +
+                                [func.grouping(column)
+                                 for column in columns]))
+        query = self._filtered(query, filters).group_by(literal_column(
+            'GROUPING SETS ({0})'.format(', '.join(
+                '({0})'.format(column) for column in columns))))
+        facets = dict((field, {}) for field in fields)
+        for row in query:
+            values = row[:len(fields)]
+            count = row[len(fields)]
+            i = list(row[len(fields) + 1:]).index(0)
+            facets[fields[i]][values[i]] = count
+        return facets
+
+    def _union_facet_counts(self, session, filters, fields):
+        queries = []
+        for field in fields:
+            column = issuemodel.issue_table.c[field]
+            query = session.query(
+                literal(field).label('field'),
+                cast(column, types.UnicodeText).label('value'),
+                func.count(issuemodel.Issue.id).label('count'))
+            queries.append(self._filtered(query, filters).group_by(column))
+        facets = dict((field, {}) for field in fields)
+        for field, value, count in queries[0].union_all(*queries[1:]):
+            if field == 'abuse_status' and value is not None:
+                value = int(value)
+            facets[field][value] = count
+        return facets
+
+    def _category_facet_counts(self, session, filters):
+        categorized = issuemodel.issue_category_association_table
+        query = session.query(categorized.c.category_id,
+                              func.count(categorized.c.issue_id))\
+            .select_from(categorized)\
+            .join(issuemodel.Issue,
+                  issuemodel.Issue.id == categorized.c.issue_id)
+        query = issuemodel.Issue.apply_filters_to_an_issue_query(
+            query, **filter_args(filters))
+        return dict(query.group_by(categorized.c.category_id).all())
+
+    def index_issue(self, session, issue):
+        pass
+
+    def delete_issue(self, issue_id):
+        pass
+
+    def index_issues(self, session, issue_ids):
+        pass
+
+    def delete_issues(self, issue_ids):
+        pass
+
+    def rebuild(self, session):
+        return 0
+
+
+def get_backend():
+    '''Returns the search backend chosen in the config'''
+    name = config.get('ckanext.issues.search_backend', DEFAULT_BACKEND)
+    backend = _backends.get(name)
+    if backend is None:
+        try:
+            module_name, class_name = BACKENDS.get(name, name).split(':')
+            backend_class = getattr(importlib.import_module(module_name),
+                                    class_name)
+        except (ValueError, ImportError, AttributeError):
+            raise SearchIndexError(
+                'Unknown ckanext.issues.search_backend: {0}'.format(name))
+        backend = _backends[name] = backend_class()
+    return backend
+
+
+def index_issue(session, issue):
+    '''Updates the search index after a change to issue or its comments
+
+    A failure is logged rather than raised, as the change itself has already
+    been committed; `paster issues search-index rebuild` catches the index
+    up.
+    '''
+    try:
+        get_backend().index_issue(session, issue)
+    except SearchIndexError:
+        log.exception('Could not index issue %s', issue.id)
+
+
+def delete_issue(issue_id):
+    '''Updates the search index after an issue is deleted'''
+    try:
+        get_backend().delete_issue(issue_id)
+    except SearchIndexError:
+        log.exception('Could not remove issue %s from the index', issue_id)
+
+
+def index_issues(session, issue_ids):
+    '''Updates the search index after changes to the comments of issues'''
+    try:
+        get_backend().index_issues(session, issue_ids)
+    except SearchIndexError:
+        log.exception('Could not index issues %s', issue_ids)
+
+
+def delete_issues(issue_ids):
+    '''Updates the search index after issues are deleted'''
+    try:
+        get_backend().delete_issues(issue_ids)
+    except SearchIndexError:
+        log.exception('Could not remove issues %s from the index', issue_ids)
+
+
+def _update_index(session):
+    '''Updates the index for the issues deleted with a dataset, resource or
+    user, once the deletion is committed'''
+    deleted = session.info.pop(issuemodel.DELETED_ISSUE_IDS, None)
+    changed = session.info.pop(issuemodel.CHANGED_ISSUE_IDS, None)
+    if deleted:
+        delete_issues(sorted(deleted))
+    if changed:
+        # the committed session can't be queried, so use another
+        index_session = orm.Session(bind=session.get_bind())
+        try:
+            index_issues(index_session, sorted(changed))
+        finally:
+            index_session.close()
+
+
+def _forget_index_updates(session):
+    session.info.pop(issuemodel.DELETED_ISSUE_IDS, None)
+    session.info.pop(issuemodel.CHANGED_ISSUE_IDS, None)
+
+event.listen(Session, 'after_commit', _update_index)
+event.listen(Session, 'after_rollback', _forget_index_updates)
@@ -0,0 +1,120 @@
+'''Finding the existing issues like a new one
+
+Each issue keeps a MinHash signature of the words and pairs of words of its
+title and description in issue.similarity_signature, set by issue_create and
+issue_update. issue_similar works out the signature of the text typed into
+the new issue form and compares it with those of the dataset's open issues:
+the share of the signatures' values that are equal estimates the Jaccard
+similarity of the issues' words, without reading or tokenising their text.
+
+Issues created before the signatures were added get them with
+`paster issues similar-index rebuild`.
+'''
+import logging
+import random
+import re
+import zlib
+
+from sqlalchemy.sql.expression import select
+
+from ckanext.issues import model as issuemodel
+
+log = logging.getLogger(__name__)
+
+NUM_HASHES = 64
+# the largest prime below 2**32, so each value is 8 hex digits
+PRIME = 4294967291
+DEFAULT_THRESHOLD = 0.3
+DEFAULT_LIMIT = 5
+REBUILD_BATCH_SIZE = 500
+WORD = re.compile(r'\w+', re.UNICODE)
+STOP_WORDS = frozenset(
+    u'a an and are as at be but by for from has have i if in is it its of '
+    u'on or that the this to was were will with'.split())
+
+# the hash functions, (a * x + b) % PRIME, fixed so that signatures stay
+# comparable
+_random = random.Random(20160101)
+HASHES = [(_random.randint(1, PRIME - 1), _random.randint(0, PRIME - 1))
+          for i in range(NUM_HASHES)]
+del _random
+
+
+def shingles(text):
+    '''Returns the set of the words of text, other than stop words, and the
+    pairs of consecutive words, hashed'''
+    words = [word for word in WORD.findall(text.lower())
+             if word not in STOP_WORDS]
+    tokens = set(words)
+    tokens.update(u'{0} {1}'.format(a, b) for a, b in zip(words, words[1:]))
+    return set(zlib.crc32(token.encode('utf8')) & 0xffffffff
+               for token in tokens)
+
+
+def signature(title, description=None):
+    '''Returns the MinHash signature of an issue's text, as a string of
+    NUM_HASHES 8-digit hex values, or None if it has no words'''
+    hashed = shingles(u'{0}\n{1}'.format(title or u'', description or u''))
+    if not hashed:
+        return None
+    return ''.join('{0:08x}'.format(min((a * x + b) % PRIME for x in hashed))
+                   for a, b in HASHES)
+
+
+def similarity(signature_a, signature_b):
+    '''Returns the estimated Jaccard similarity of two signatures'''
+    matches = sum(1 for i in xrange(0, NUM_HASHES * 8, 8)
+                  if signature_a[i:i + 8] == signature_b[i:i + 8])
+    return float(matches) / NUM_HASHES
+
+
+def update_signature(issue):
+    issue.similarity_signature = signature(issue.title, issue.description)
+
+
+def find_similar(session, dataset_id, text, threshold=DEFAULT_THRESHOLD,
+                 limit=DEFAULT_LIMIT):
+    '''Returns the dataset's visible open issues most like text, as
+    (similarity, number, title) tuples, most similar first'''
+    query_signature = signature(text)
+    if query_signature is None:
+        return []
+    issues = issuemodel.issue_table
+    rows = session.execute(
+        select([issues.c.number, issues.c.title,
+                issues.c.similarity_signature])
+        .where(issues.c.dataset_id == dataset_id)
+        .where(issues.c.status == issuemodel.ISSUE_STATUS.open)
+        .where(issues.c.visibility == u'visible')
+        .where(issues.c.similarity_signature != None))
+    matches = []
+    for number, title, issue_signature in rows:
+        score = similarity(query_signature, issue_signature)
+        if score >= threshold:
+            matches.append((score, number, title))
+    matches.sort(key=lambda match: (-match[0], -match[1]))
+    return matches[:limit]
+
+
+def rebuild(session, batch_size=REBUILD_BATCH_SIZE):
+    '''Sets the signatures of all the issues, a batch per transaction, and
+    returns how many there were'''
+    issues = issuemodel.issue_table
+    count = 0
+    last_id = 0
+    while True:
+        rows = session.execute(
+            select([issues.c.id, issues.c.title, issues.c.description])
+            .where(issues.c.id > last_id).order_by(issues.c.id)
+            .limit(batch_size)).fetchall()
+        if not rows:
+            return count
+        for row in rows:
+            session.execute(
+                issues.update().where(issues.c.id == row.id)
+                .values(similarity_signature=signature(row.title,
+                                                       row.description)))
+        session.commit()
+        count += len(rows)
+        last_id = rows[-1].id
+        log.info('Set the signatures of %s issues', count)
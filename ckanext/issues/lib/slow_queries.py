@@ -0,0 +1,162 @@
+'''Logging of slow issues queries, with their query plan
+
+The SQL generated by Issue.get_issue_rows varies with every combination of
+search filters, so a slow search is hard to reproduce after the event. When
+ckanext.issues.slow_query.threshold_ms is set, any statement run inside
+watch() that takes longer than that is logged on the
+'ckanext.issues.lib.slow_queries' logger as a JSON object, with the SQL, its
+bound parameters, the search filters it came from and its query plan:
+EXPLAIN (ANALYZE, BUFFERS) on PostgreSQL, EXPLAIN QUERY PLAN on SQLite.
+
+So that it can be left on in production:
+
+* only ckanext.issues.slow_query.sample_rate (default 1.0) of the slow
+  statements are logged
+* at most ckanext.issues.slow_query.max_per_minute (default 6) are logged by
+  each process per minute
+* EXPLAIN ANALYZE runs the statement again, which can be switched off with
+  ckanext.issues.slow_query.explain = false
+'''
+import collections
+import json
+import logging
+import random
+import threading
+import time
+
+from pylons import config
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from ckan.plugins import toolkit
+
+log = logging.getLogger(__name__)
+
+DEFAULT_SAMPLE_RATE = 1.0
+DEFAULT_MAX_PER_MINUTE = 6
+
+_local = threading.local()
+_lock = threading.Lock()
+_logged = collections.deque()  # times of the recent log entries
+
+
+def threshold():
+    '''Returns the slow query threshold in seconds, or None if it is off'''
+    threshold_ms = config.get('ckanext.issues.slow_query.threshold_ms')
+    if not threshold_ms:
+        return None
+    return float(threshold_ms) / 1000
+
+
+class watch(object):
+    '''Context manager logging the slow statements run inside it
+
+    name and details (e.g. the search filters) are included in the log.
+    '''
+    def __init__(self, name, details=None):
+        self.name = name
+        self.details = details
+
+    def __enter__(self):
+        self.previous = getattr(_local, 'watch', None)
+        _local.watch = self if threshold() is not None else None
+        return self
+
+    def __exit__(self, *exc_info):
+        _local.watch = self.previous
+
+
+def _sampled():
+    sample_rate = float(config.get('ckanext.issues.slow_query.sample_rate',
+                                   DEFAULT_SAMPLE_RATE))
+    return random.random() < sample_rate
+
+
+def _within_rate_limit():
+    max_per_minute = toolkit.asint(config.get(
+        'ckanext.issues.slow_query.max_per_minute', DEFAULT_MAX_PER_MINUTE))
+    now = time.time()
+    with _lock:
+        while _logged and now - _logged[0] > 60:
+            _logged.popleft()
+        if len(_logged) >= max_per_minute:
+            return False
+        _logged.append(now)
+        return True
+
+
+def explain(conn, cursor, statement, parameters):
+    '''Returns the lines of the query plan of statement
+
+    The raw DBAPI cursor is used, so the EXPLAIN is not itself seen by the
+    SQLAlchemy event listeners.
+    '''
+    dialect = conn.dialect.name
+    if dialect == 'postgresql':
+        sql = 'EXPLAIN (ANALYZE, BUFFERS) ' + statement
+    elif dialect == 'sqlite':
+        sql = 'EXPLAIN QUERY PLAN ' + statement
+    else:
+        sql = 'EXPLAIN ' + statement
+    explain_cursor = cursor.connection.cursor()
+    try:
+        if dialect == 'postgresql':
+            # don't let a failed EXPLAIN abort the request's transaction
+            explain_cursor.execute('SAVEPOINT issues_explain')
+        try:
+            explain_cursor.execute(sql, parameters)
+            rows = explain_cursor.fetchall()
+        except Exception:
+            if dialect == 'postgresql':
+                explain_cursor.execute('ROLLBACK TO SAVEPOINT issues_explain')
+            raise
+        if dialect == 'postgresql':
+            explain_cursor.execute('RELEASE SAVEPOINT issues_explain')
+    finally:
+        explain_cursor.close()
+    return [' '.join(unicode(value) for value in row) for row in rows]
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    if getattr(_local, 'watch', None) is not None:
+        conn.info.setdefault('issues_slow_query_start', []).append(
+            time.time())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    current = getattr(_local, 'watch', None)
+    starts = conn.info.get('issues_slow_query_start')
+    if current is None or not starts:
+        return
+    duration = time.time() - starts.pop()
+    slow_threshold = threshold()
+    if slow_threshold is None or duration < slow_threshold:
+        return
+    if not _sampled() or not _within_rate_limit():
+        return
+    entry = {
+        'name': current.name,
+        'details': current.details,
+        'ms': round(duration * 1000, 3),
+        'statement': statement,
+        'parameters': repr(parameters),
+    }
+    if statement.lstrip().upper().startswith('SELECT') and \
+            toolkit.asbool(config.get('ckanext.issues.slow_query.explain',
+                                      True)):
+        try:
+            entry['plan'] = explain(conn, cursor, statement, parameters)
+        except Exception, e:
+            entry['plan_error'] = unicode(e)
+    log.warning('issues.slow_query %s', json.dumps(entry, default=unicode))
+
+event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+
+
+def reset():
+    '''Clears the rate limit (for tests)'''
+    with _lock:
+        _logged.clear()
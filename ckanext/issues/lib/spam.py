@@ -0,0 +1,298 @@
+'''Scoring new issues and comments as spam
+
+A naive Bayes classifier over hashed word features learns from the
+moderators' decisions: `paster issues spam-train` trains it on the issues
+and comments marked as abuse (spam) and not abuse, plus the most recent
+unreported ones (up to ckanext.issues.spam.max_ham, default 10000, as
+moderators rarely mark anything as not abuse), and saves it to
+ckanext.issues.spam.model_path (default issues_spam_model.json in the CKAN
+cache_dir).
+
+With ckanext.issues.spam.enabled = true, new issues and comments are queued
+to be checked, and `paster issues spam-worker` scores them in batches of
+ckanext.issues.spam.batch_size (default 100), off the request path. Those
+scoring at least ckanext.issues.spam.threshold (default 0.95) are hidden,
+which puts them in the moderation queue. The worker loads the model when it
+first needs it, and again when the file changes. Several workers can run at
+once on PostgreSQL, as each takes its batch off the queue with
+FOR UPDATE SKIP LOCKED.
+'''
+from datetime import datetime
+import json
+import logging
+import math
+import os
+import re
+import tempfile
+import threading
+import time
+import zlib
+
+from pylons import config
+from sqlalchemy import desc
+from sqlalchemy.sql.expression import text
+
+from ckan.plugins import toolkit
+
+from ckanext.issues import model as issuemodel
+from ckanext.issues.lib import search, webhooks
+
+log = logging.getLogger(__name__)
+
+N_FEATURES = 2 ** 18
+DEFAULT_MAX_HAM = 10000
+DEFAULT_THRESHOLD = 0.95
+DEFAULT_BATCH_SIZE = 100
+DEFAULT_POLL_INTERVAL = 5
+WORD = re.compile(r'\w+', re.UNICODE)
+URL = re.compile(r'https?://', re.IGNORECASE)
+
+_model_lock = threading.Lock()
+_model = [None, None]  # [path and mtime, SpamClassifier]
+
+
+def enabled():
+    return toolkit.asbool(config.get('ckanext.issues.spam.enabled'))
+
+
+def model_path():
+    return config.get('ckanext.issues.spam.model_path') or os.path.join(
+        config.get('cache_dir') or tempfile.gettempdir(),
+        'issues_spam_model.json')
+
+
+def threshold():
+    return float(config.get('ckanext.issues.spam.threshold',
+                            DEFAULT_THRESHOLD))
+
+
+def features(text, n_features=N_FEATURES):
+    '''Returns the hashed features of text: its lower-cased words and their
+    pairs, and a feature for each link'''
+    words = WORD.findall(text.lower())
+    tokens = words + [u'{0} {1}'.format(a, b)
+                      for a, b in zip(words, words[1:])]
+    tokens += [u'__link__'] * len(URL.findall(text))
+    return [(zlib.crc32(token.encode('utf8')) & 0xffffffff) % n_features
+            for token in tokens]
+
+
+class SpamClassifier(object):
+    '''Multinomial naive Bayes over hashed features, with add-one
+    smoothing. Class 0 is ham, class 1 spam.'''
+
+    def __init__(self, n_features=N_FEATURES):
+        self.n_features = n_features
+        self.docs = [0, 0]
+        self.totals = [0, 0]
+        self.counts = [{}, {}]
+        self._denominators = None
+
+    def train(self, examples):
+        '''Learns from (text, is_spam) pairs'''
+        for text, is_spam in examples:
+            label = 1 if is_spam else 0
+            self.docs[label] += 1
+            counts = self.counts[label]
+            for feature in features(text, self.n_features):
+                counts[feature] = counts.get(feature, 0) + 1
+                self.totals[label] += 1
+        self._denominators = None
+
+    def _log_denominators(self):
+        if self._denominators is None:
+            vocabulary = len(set(self.counts[0]) | set(self.counts[1])) or 1
+            self._denominators = [math.log(total + vocabulary)
+                                  for total in self.totals]
+        return self._denominators
+
+    def score(self, text):
+        '''Returns the probability that text is spam'''
+        if not all(self.docs):
+            return 0.0
+        denominators = self._log_denominators()
+        log_probs = []
+        for label in (0, 1):
+            counts = self.counts[label]
+            denominator = denominators[label]
+            log_prob = math.log(float(self.docs[label]) / sum(self.docs))
+            for feature in features(text, self.n_features):
+                log_prob += math.log(counts.get(feature, 0) + 1) - denominator
+            log_probs.append(log_prob)
+        difference = log_probs[0] - log_probs[1]
+        if difference > 700:
+            return 0.0
+        return 1.0 / (1.0 + math.exp(difference))
+
+    def save(self, path):
+        '''Writes the model to path, replacing it in one step so that
+        readers never see a partial file'''
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        fd, tmp_path = tempfile.mkstemp(dir=directory or None)
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'n_features': self.n_features, 'docs': self.docs,
+                       'totals': self.totals, 'counts': self.counts}, f)
+        os.rename(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            data = json.load(f)
+        classifier = cls(data['n_features'])
+        classifier.docs = data['docs']
+        classifier.totals = data['totals']
+        classifier.counts = [dict((int(feature), count)
+                                  for feature, count in counts.items())
+                             for counts in data['counts']]
+        return classifier
+
+
+def get_classifier():
+    '''Returns the saved classifier, loading it the first time and whenever
+    the file changes, or None if there isn't one'''
+    path = model_path()
+    try:
+        version = (path, os.path.getmtime(path))
+    except OSError:
+        return None
+    with _model_lock:
+        if _model[0] != version:
+            _model[:] = [version, SpamClassifier.load(path)]
+        return _model[1]
+
+
+def _text(obj):
+    if isinstance(obj, issuemodel.Issue):
+        return u'{0}\n{1}'.format(obj.title, obj.description or u'')
+    return obj.comment
+
+
+# Training
+
+def training_examples(session):
+    '''Yields (text, is_spam) for the moderated issues and comments, and
+    the most recent unreported ones'''
+    max_ham = toolkit.asint(config.get('ckanext.issues.spam.max_ham',
+                                       DEFAULT_MAX_HAM))
+    AbuseStatus = issuemodel.AbuseStatus
+    for cls in (issuemodel.Issue, issuemodel.IssueComment):
+        for obj in session.query(cls).filter(cls.abuse_status.in_(
+                [AbuseStatus.abuse.value, AbuseStatus.not_abuse.value]))\
+                .yield_per(1000):
+            yield _text(obj), obj.abuse_status == AbuseStatus.abuse.value
+        for obj in session.query(cls)\
+                .filter(cls.abuse_status == AbuseStatus.unmoderated.value)\
+                .filter(cls.visibility == u'visible')\
+                .filter(cls.report_count == 0)\
+                .order_by(desc(cls.id)).limit(max_ham):
+            yield _text(obj), False
+
+
+def train(session):
+    '''Trains a classifier on the moderators' decisions, saves it and
+    returns it'''
+    classifier = SpamClassifier()
+    classifier.train(training_examples(session))
+    classifier.save(model_path())
+    return classifier
+
+
+# Scoring
+
+def queue_check(session, obj):
+    '''Queues a new issue or comment to be scored, in the current
+    transaction'''
+    if not enabled():
+        return
+    object_type = u'issue' if isinstance(obj, issuemodel.Issue) \
+        else u'comment'
+    session.execute(issuemodel.issue_spam_check_table.insert().values(
+        object_type=object_type, object_id=obj.id, created=datetime.now()))
+
+
+def _claim(session, batch_size):
+    '''Takes a batch of the queued checks off the queue, in the current
+    transaction, and returns them. On PostgreSQL, other workers skip the
+    rows this one has deleted but not yet committed, rather than scoring
+    them too.'''
+    checks = issuemodel.issue_spam_check_table
+    if session.get_bind().dialect.name == 'postgresql':
+        return session.execute(text(
+            'DELETE FROM issue_spam_check WHERE id IN ('
+            'SELECT id FROM issue_spam_check ORDER BY id LIMIT :limit '
+            'FOR UPDATE SKIP LOCKED) '
+            'RETURNING id, object_type, object_id'),
+            {'limit': batch_size}).fetchall()
+    rows = session.execute(checks.select().order_by(checks.c.id)
+                           .limit(batch_size)).fetchall()
+    if rows:
+        session.execute(checks.delete().where(
+            checks.c.id.in_([row.id for row in rows])))
+    return rows
+
+
+def score_pending(session, classifier, batch_size=None):
+    '''Scores a batch of the queued issues and comments, hiding those at
+    or above the threshold, and returns the numbers (scored, hidden)'''
+    if batch_size is None:
+        batch_size = toolkit.asint(config.get(
+            'ckanext.issues.spam.batch_size', DEFAULT_BATCH_SIZE))
+    rows = _claim(session, batch_size)
+    if not rows:
+        return 0, 0
+
+    objects = []
+    for object_type, cls in (('issue', issuemodel.Issue),
+                             ('comment', issuemodel.IssueComment)):
+        ids = [row.object_id for row in rows if row.object_type == object_type]
+        if ids:
+            objects.extend(session.query(cls).filter(cls.id.in_(ids)))
+    limit = threshold()
+    hidden_issues = []
+    hidden = 0
+    for obj in objects:
+        score = classifier.score(_text(obj))
+        if score < limit or obj.visibility != u'visible' or \
+                obj.abuse_status != issuemodel.AbuseStatus.unmoderated.value:
+            continue
+        log.info('Hiding %s %s, with a spam score of %.3f',
+                 obj.__class__.__name__, obj.id, score)
+        obj.change_visibility(session, u'hidden')
+        if isinstance(obj, issuemodel.Issue):
+            webhooks.queue_event(session, 'issue.hidden', obj)
+            hidden_issues.append(obj.id)
+        hidden += 1
+    session.commit()
+    if hidden_issues:
+        search.index_issues(session, hidden_issues)
+    return len(rows), hidden
+
+
+def run_worker(session, once=False):
+    '''Scores the queued issues and comments until stopped, polling every
+    ckanext.issues.spam.poll_interval seconds when there are none'''
+    poll_interval = toolkit.asint(config.get(
+        'ckanext.issues.spam.poll_interval', DEFAULT_POLL_INTERVAL))
+    while True:
+        scored = 0
+        try:
+            classifier = get_classifier()
+            if classifier is None:
+                log.warning('No spam model at %s. Run "paster issues '
+                            'spam-train"', model_path())
+            else:
+                scored, hidden = score_pending(session, classifier)
+                if scored:
+                    log.info('Scored %s issues and comments, hid %s',
+                             scored, hidden)
+        except Exception:
+            log.exception('Spam scoring failed')
+            session.rollback()
+        finally:
+            session.remove()
+        if once:
+            return
+        if not scored:
+            time.sleep(poll_interval)
@@ -0,0 +1,369 @@
+'''Issue search backend keeping an SQLite FTS5 index on local disk
+
+Enabled with ckanext.issues.search_backend = sqlite_fts. The index is kept
+in ckanext.issues.search_index_path (default issues_search.sqlite in the
+CKAN cache_dir). Every process on a host shares the file, so the backend
+only suits sites whose web processes all run on the one host (or share the
+disk).
+
+The index holds each issue's filterable and sortable fields and comment
+count in a plain table, its categories in another, and its title and
+description in an FTS5 table with the same rowid. Searches and facet counts
+are answered from the index; only the page of issues being shown is then
+loaded from the CKAN database, by primary key.
+
+Text search matches words starting with each word of q (all of them), where
+the sql backend matches q anywhere in the title or description.
+'''
+import contextlib
+import logging
+import os
+import re
+import sqlite3
+import tempfile
+import threading
+
+from pylons import config
+from sqlalchemy import func
+
+import ckan.model as model
+
+from ckanext.issues import model as issuemodel
+from ckanext.issues.lib.search import (IssueSearchBackend, SearchIndexError,
+                                       FACET_FIELDS)
+
+log = logging.getLogger(__name__)
+
+# bump when SCHEMA changes, so that existing indexes are recreated
+SCHEMA_VERSION = 3
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS issue (
+    id INTEGER PRIMARY KEY,
+    dataset_id TEXT NOT NULL,
+    organization_id TEXT,
+    status TEXT,
+    visibility TEXT,
+    abuse_status INTEGER,
+    assignee_id TEXT,
+    user_id TEXT,
+    created TEXT,
+    updated TEXT,
+    comment_count INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS issue_dataset ON issue (dataset_id, created);
+CREATE INDEX IF NOT EXISTS issue_organization
+    ON issue (organization_id, created);
+CREATE INDEX IF NOT EXISTS issue_assignee
+    ON issue (assignee_id, status, created);
+CREATE INDEX IF NOT EXISTS issue_user ON issue (user_id, created);
+CREATE INDEX IF NOT EXISTS issue_updated ON issue (updated);
+CREATE VIRTUAL TABLE IF NOT EXISTS issue_text
+    USING fts5(title, description, tokenize='unicode61');
+CREATE TABLE IF NOT EXISTS issue_category (
+    category_id INTEGER NOT NULL,
+    issue_id INTEGER NOT NULL,
+    PRIMARY KEY (category_id, issue_id)
+);
+CREATE INDEX IF NOT EXISTS issue_category_issue
+    ON issue_category (issue_id);
+'''
+DROP_SCHEMA = '''
+DROP TABLE IF EXISTS issue;
+DROP TABLE IF EXISTS issue_text;
+DROP TABLE IF EXISTS issue_category;
+'''
+COLUMNS = ('id', 'dataset_id', 'organization_id', 'status', 'visibility',
+           'abuse_status', 'assignee_id', 'user_id', 'created', 'updated',
+           'comment_count')
+SORTS = {
+    issuemodel.IssueFilter.newest: 'created DESC',
+    issuemodel.IssueFilter.oldest: 'created ASC',
+    issuemodel.IssueFilter.least_commented: 'comment_count ASC',
+    issuemodel.IssueFilter.most_commented: 'comment_count DESC',
+    issuemodel.IssueFilter.recently_updated: 'updated DESC',
+    issuemodel.IssueFilter.least_recently_updated: 'updated ASC',
+}
+REBUILD_BATCH_SIZE = 1000
+# issues updated by one statement, under SQLite's default limit of 999
+# parameters
+BATCH_SIZE = 500
+
+
+def index_path():
+    return config.get('ckanext.issues.search_index_path') or os.path.join(
+        config.get('cache_dir') or tempfile.gettempdir(),
+        'issues_search.sqlite')
+
+
+def match_expression(q):
+    '''Returns the FTS5 query matching words starting with each word of q'''
+    words = re.findall(r'\w+', q, re.UNICODE)
+    return ' '.join(u'"{0}"*'.format(word) for word in words)
+
+
+@contextlib.contextmanager
+def _sqlite_errors():
+    try:
+        yield
+    except sqlite3.Error, e:
+        raise SearchIndexError(unicode(e))
+
+
+def _open(path):
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    conn = sqlite3.connect(path, timeout=30)
+    conn.execute('PRAGMA journal_mode=WAL')
+    version = conn.execute('PRAGMA user_version').fetchone()[0]
+    if version != SCHEMA_VERSION:
+        if conn.execute("SELECT count(*) FROM sqlite_master "
+                        "WHERE name = 'issue'").fetchone()[0]:
+            log.warning('The issues search index at %s is out of date and '
+                        'has been emptied. Run '
+                        '"paster issues search-index rebuild"', path)
+            conn.executescript(DROP_SCHEMA)
+        conn.executescript(SCHEMA)
+        conn.execute('PRAGMA user_version = {0}'.format(SCHEMA_VERSION))
+    return conn
+
+
+def _isoformat(value):
+    return value.isoformat() if value is not None else None
+
+
+class SqliteFtsSearchBackend(IssueSearchBackend):
+
+    def __init__(self):
+        self._local = threading.local()
+
+    def _connection(self):
+        '''Returns this thread's connection to the index'''
+        path = index_path()
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and self._local.path != path:
+            conn.close()
+            conn = None
+        if conn is None:
+            conn = self._local.conn = _open(path)
+            self._local.path = path
+        return conn
+
+    # Searching
+
+    def _where(self, filters):
+        clauses = []
+        params = []
+        if filters.get('dataset_id'):
+            clauses.append('dataset_id = ?')
+            params.append(filters['dataset_id'])
+        if filters.get('organization_id'):
+            org = model.Group.get(filters['organization_id'])
+            if filters.get('include_sub_organizations'):
+                org_ids = [org_.id for org_
+                           in org.get_children_groups(type='organization')]
+            else:
+                org_ids = [org.id]
+            clauses.append('organization_id IN ({0})'.format(
+                ', '.join('?' * len(org_ids)) or 'NULL'))
+            params.extend(org_ids)
+        if filters.get('q'):
+            expression = match_expression(filters['q'])
+            if expression:
+                clauses.append('id IN (SELECT rowid FROM issue_text '
+                               'WHERE issue_text MATCH ?)')
+                params.append(expression)
+            else:
+                clauses.append('0')
+        for field in ('status', 'visibility', 'assignee_id', 'user_id'):
+            if filters.get(field):
+                clauses.append('{0} = ?'.format(field))
+                params.append(filters[field])
+        if filters.get('abuse_status'):
+            clauses.append('abuse_status = ?')
+            params.append(filters['abuse_status'].value)
+        if filters.get('category_id'):
+            clauses.append('id IN (SELECT issue_id FROM issue_category '
+                           'WHERE category_id = ?)')
+            params.append(filters['category_id'])
+        where = ' WHERE ' + ' AND '.join(clauses) if clauses else ''
+        return where, params
+
+    def search(self, session, filters, include_count=True,
+               include_results=True, include_reports=False, fields=None):
+        where, params = self._where(filters)
+        with _sqlite_errors():
+            conn = self._connection()
+            count = None
+            if include_count:
+                count = conn.execute('SELECT count(*) FROM issue' + where,
+                                     params).fetchone()[0]
+            if not include_results:
+                return count, []
+            order_by = SORTS.get(filters.get('sort'))
+            order_by = order_by + ', id' if order_by else 'id'
+            issue_ids = [row[0] for row in conn.execute(
+                'SELECT id FROM issue{0} ORDER BY {1} LIMIT ? OFFSET ?'
+                .format(where, order_by),
+                params + [filters.get('limit') or -1,
+                          filters.get('offset') or 0])]
+        if not issue_ids:
+            return count, []
+        if fields is not None:
+            rows = issuemodel.Issue.get_issue_rows(
+                fields, session=session, issue_ids=issue_ids).all()
+            row_id = lambda row: row.id
+        else:
+            rows = issuemodel.Issue.get_issues(
+                session=session, issue_ids=issue_ids,
+                include_reports=include_reports).all()
+            row_id = lambda row: row[0].id
+        position = dict((issue_id, i) for i, issue_id in enumerate(issue_ids))
+        rows.sort(key=lambda row: position[row_id(row)])
+        return count, rows
+
+    def facet_counts(self, session, filters, fields=FACET_FIELDS):
+        where, params = self._where(filters)
+        facets = {}
+        with _sqlite_errors():
+            conn = self._connection()
+            for field in fields:
+                if field == 'category_id':
+                    sql = 'SELECT category_id, count(*) FROM issue_category '\
+                        'JOIN issue ON issue.id = issue_category.issue_id' \
+                        '{0} GROUP BY category_id'.format(where)
+                elif field in COLUMNS:
+                    sql = 'SELECT {0}, count(*) FROM issue{1} GROUP BY {0}'\
+                        .format(field, where)
+                else:
+                    raise SearchIndexError(
+                        'Cannot facet on {0}'.format(field))
+                facets[field] = dict(conn.execute(sql, params).fetchall())
+        return facets
+
+    # Indexing
+
+    def _issue_rows(self, session):
+        '''Query for the rows of the index, with the issue title and
+        description on the end'''
+        Issue = issuemodel.Issue
+        IssueComment = issuemodel.IssueComment
+        comments = session.query(
+            IssueComment.issue_id,
+            func.count(IssueComment.id).label('comment_count'),
+        ).group_by(IssueComment.issue_id).subquery()
+        return session.query(
+            Issue.id, Issue.dataset_id, model.Package.owner_org,
+            Issue.status, Issue.visibility, Issue.abuse_status,
+            Issue.assignee_id, Issue.user_id, Issue.created, Issue.updated,
+            comments.c.comment_count,
+            Issue.title, Issue.description,
+        ).outerjoin(model.Package, model.Package.id == Issue.dataset_id)\
+            .outerjoin(comments, comments.c.issue_id == Issue.id)
+
+    def _categories(self, session, issue_ids):
+        '''Returns {issue id: [category ids]}'''
+        categorized = issuemodel.issue_category_association_table
+        categories = dict((issue_id, []) for issue_id in issue_ids)
+        if issue_ids:
+            for issue_id, category_id in session.query(
+                    categorized.c.issue_id, categorized.c.category_id)\
+                    .filter(categorized.c.issue_id.in_(issue_ids)):
+                categories[issue_id].append(category_id)
+        return categories
+
+    def _write(self, session, conn, rows):
+        categories = self._categories(session, [row.id for row in rows])
+        for row in rows:
+            values = list(row[:len(COLUMNS)])
+            values[COLUMNS.index('created')] = _isoformat(row.created)
+            values[COLUMNS.index('updated')] = _isoformat(row.updated)
+            values[COLUMNS.index('comment_count')] = row.comment_count or 0
+            conn.execute(
+                'INSERT OR REPLACE INTO issue ({0}) VALUES ({1})'.format(
+                    ', '.join(COLUMNS), ', '.join('?' * len(COLUMNS))),
+                values)
+            conn.execute('DELETE FROM issue_text WHERE rowid = ?', [row.id])
+            conn.execute('INSERT INTO issue_text (rowid, title, description) '
+                         'VALUES (?, ?, ?)',
+                         [row.id, row.title, row.description or u''])
+            conn.execute('DELETE FROM issue_category WHERE issue_id = ?',
+                         [row.id])
+            conn.executemany('INSERT INTO issue_category (category_id, '
+                             'issue_id) VALUES (?, ?)',
+                             [(category_id, row.id)
+                              for category_id in categories[row.id]])
+
+    def index_issue(self, session, issue):
+        rows = self._issue_rows(session)\
+            .filter(issuemodel.Issue.id == issue.id).all()
+        with _sqlite_errors():
+            conn = self._connection()
+            with conn:
+                if rows:
+                    self._write(session, conn, rows)
+                else:
+                    self._delete(conn, issue.id)
+
+    def index_issues(self, session, issue_ids):
+        issue_ids = list(issue_ids)
+        with _sqlite_errors():
+            conn = self._connection()
+            with conn:
+                for start in range(0, len(issue_ids), BATCH_SIZE):
+                    batch = issue_ids[start:start + BATCH_SIZE]
+                    rows = self._issue_rows(session)\
+                        .filter(issuemodel.Issue.id.in_(batch)).all()
+                    self._write(session, conn, rows)
+                    for issue_id in set(batch) - set(row.id for row in rows):
+                        self._delete(conn, issue_id)
+
+    def _delete(self, conn, issue_id):
+        conn.execute('DELETE FROM issue WHERE id = ?', [issue_id])
+        conn.execute('DELETE FROM issue_text WHERE rowid = ?', [issue_id])
+        conn.execute('DELETE FROM issue_category WHERE issue_id = ?',
+                     [issue_id])
+
+    def delete_issue(self, issue_id):
+        with _sqlite_errors():
+            conn = self._connection()
+            with conn:
+                self._delete(conn, issue_id)
+
+    def delete_issues(self, issue_ids):
+        issue_ids = list(issue_ids)
+        with _sqlite_errors():
+            conn = self._connection()
+            with conn:
+                for start in range(0, len(issue_ids), BATCH_SIZE):
+                    batch = issue_ids[start:start + BATCH_SIZE]
+                    placeholders = ', '.join('?' * len(batch))
+                    conn.execute('DELETE FROM issue WHERE id IN ({0})'
+                                 .format(placeholders), batch)
+                    conn.execute('DELETE FROM issue_text WHERE rowid IN ({0})'
+                                 .format(placeholders), batch)
+                    conn.execute('DELETE FROM issue_category '
+                                 'WHERE issue_id IN ({0})'
+                                 .format(placeholders), batch)
+
+    def rebuild(self, session):
+        '''Re-indexes every issue in a single transaction, so searches
+        are answered from the old index until the new one is complete'''
+        count = 0
+        with _sqlite_errors():
+            conn = self._connection()
+            with conn:
+                conn.execute('DELETE FROM issue')
+                conn.execute('DELETE FROM issue_text')
+                conn.execute('DELETE FROM issue_category')
+                rows = []
+                for row in self._issue_rows(session)\
+                        .yield_per(REBUILD_BATCH_SIZE):
+                    rows.append(row)
+                    if len(rows) == REBUILD_BATCH_SIZE:
+                        self._write(session, conn, rows)
+                        count += len(rows)
+                        rows = []
+                self._write(session, conn, rows)
+                count += len(rows)
+        return count
@@ -0,0 +1,384 @@
+'''Outbound webhooks for issue events
+
+Organization admins (and, for all organizations, sysadmins) register
+endpoints with issue_webhook_create, for any of the WEBHOOK_EVENTS. The
+actions queue each event for each subscribed webhook in the same
+transaction as the change itself (queue_event), and `paster issues
+webhook-worker` posts them (deliver_pending):
+
+* the pending events of a webhook are posted in order, up to
+  ckanext.issues.webhooks.batch_size (default 50) in each request
+* up to ckanext.issues.webhooks.concurrency (default 4) webhooks are posted
+  to at once
+* after a failure, a webhook is retried with exponential backoff, and an
+  event is given up on after ckanext.issues.webhooks.max_attempts
+  (default 8)
+* a worker leases the webhooks it posts to, by setting their retry_at to
+  when it will have timed out, and commits that before posting, so that
+  several workers (e.g. while a deploy overlaps) don't post the same
+  events. The results are recorded in a new transaction.
+
+Each request is a JSON object with the webhook id and a list of events. It
+is signed with the webhook's secret: the X-Issues-Signature header is
+'sha256=' and the hex HMAC-SHA256 of the X-Issues-Timestamp header, a '.'
+and the body.
+
+So that webhooks can't be used to reach the servers' own network, the
+hosts of organization admins' webhooks must be on
+ckanext.issues.webhooks.allowed_hosts (e.g. `hooks.example.com
+.example.org`, where a leading dot allows the subdomains), and no webhook
+is posted to a host that resolves to a loopback, private, link-local or
+other non-public address, unless
+ckanext.issues.webhooks.allow_private_addresses is true. The host is
+resolved once for each request, and the address checked is the one
+connected to. Redirects are not followed.
+'''
+from datetime import datetime, timedelta
+import hashlib
+import hmac
+import json
+import logging
+from multiprocessing.pool import ThreadPool
+import random
+import socket
+import struct
+import time
+import urlparse
+import uuid
+
+from pylons import config
+import requests
+from requests.adapters import HTTPAdapter
+from sqlalchemy import distinct, or_
+
+from ckan.plugins import toolkit
+
+from ckanext.issues import model as issuemodel
+
+log = logging.getLogger(__name__)
+
+DEFAULT_BATCH_SIZE = 50
+DEFAULT_CONCURRENCY = 4
+DEFAULT_MAX_ATTEMPTS = 8
+DEFAULT_TIMEOUT = 10
+DEFAULT_POLL_INTERVAL = 5
+BACKOFF_SECONDS = 10
+MAX_BACKOFF_SECONDS = 3600
+# added to the time a webhook is leased for while it is posted to
+LEASE_MARGIN_SECONDS = 60
+# the IPv4 networks that are not posted to, as (address, prefix length)
+PRIVATE_IPV4_NETWORKS = [
+    ('0.0.0.0', 8), ('10.0.0.0', 8), ('100.64.0.0', 10), ('127.0.0.0', 8),
+    ('169.254.0.0', 16), ('172.16.0.0', 12), ('192.0.0.0', 24),
+    ('192.168.0.0', 16), ('198.18.0.0', 15), ('224.0.0.0', 4),
+    ('240.0.0.0', 4),
+]
+
+
+def _config_int(name, default):
+    return toolkit.asint(config.get('ckanext.issues.webhooks.' + name,
+                                    default))
+
+
+def allowed_hosts():
+    return config.get('ckanext.issues.webhooks.allowed_hosts', '')\
+        .lower().split()
+
+
+def _host_allowed(host):
+    return any(host == allowed or
+               (allowed.startswith('.') and host.endswith(allowed))
+               for allowed in allowed_hosts())
+
+
+def _in_network(address, network):
+    address_int = struct.unpack('!I', socket.inet_aton(address))[0]
+    network_int = struct.unpack('!I', socket.inet_aton(network[0]))[0]
+    mask = (0xffffffff << (32 - network[1])) & 0xffffffff
+    return address_int & mask == network_int & mask
+
+
+def is_public_address(address):
+    '''Returns whether an IPv4 or IPv6 address is a public one'''
+    if ':' in address:
+        packed = socket.inet_pton(socket.AF_INET6, address.split('%')[0])
+        if packed[:12] == '\0' * 10 + '\xff' * 2:
+            # IPv4-mapped
+            return is_public_address(socket.inet_ntoa(packed[12:]))
+        first = ord(packed[0])
+        return not (packed[:15] == '\0' * 15 or  # :: and ::1
+                    first & 0xfe == 0xfc or  # unique local, fc00::/7
+                    (first == 0xfe and ord(packed[1]) & 0xc0 == 0x80) or
+                    first == 0xff)  # multicast
+    return not any(_in_network(address, network)
+                   for network in PRIVATE_IPV4_NETWORKS)
+
+
+def check_url(url, check_host=True):
+    '''Raises ValueError unless events may be posted to url: an http or
+    https url, with its host on allowed_hosts (if check_host, i.e. for
+    organization admins) and only resolving to public addresses'''
+    parsed = urlparse.urlparse(url)
+    if parsed.scheme not in ('http', 'https') or not parsed.hostname:
+        raise ValueError('{0} is not a valid webhook url'.format(url))
+    host = parsed.hostname.lower()
+    if check_host and not _host_allowed(host):
+        raise ValueError('Webhooks cannot be posted to {0}'.format(host))
+    if not _allow_private_addresses():
+        resolve(url)
+
+
+def _allow_private_addresses():
+    return toolkit.asbool(config.get(
+        'ckanext.issues.webhooks.allow_private_addresses', False))
+
+
+def resolve(url):
+    '''Returns the address to post to url at, raising ValueError if the host
+    can't be resolved, or resolves to a non-public address. The request is
+    made to this address, rather than resolving the host again, which could
+    give a different one.'''
+    parsed = urlparse.urlparse(url)
+    if not parsed.hostname:
+        raise ValueError('{0} is not a valid webhook url'.format(url))
+    host = parsed.hostname.lower()
+    try:
+        port = parsed.port or (443 if parsed.scheme == 'https' else 80)
+        addresses = [info[4][0] for info in socket.getaddrinfo(
+            host, port, 0, socket.SOCK_STREAM)]
+    except (socket.error, ValueError):
+        raise ValueError('{0} cannot be resolved'.format(host))
+    if not addresses:
+        raise ValueError('{0} cannot be resolved'.format(host))
+    if not _allow_private_addresses() and \
+            not all(is_public_address(address) for address in addresses):
+        raise ValueError('Webhooks cannot be posted to the private address '
+                         'of {0}'.format(host))
+    return addresses[0]
+
+
+class HostnameAdapter(HTTPAdapter):
+    '''Sends SNI for, and verifies the certificate against, hostname, for
+    https requests made to its address'''
+
+    def __init__(self, hostname, *args, **kwargs):
+        self.hostname = hostname
+        super(HostnameAdapter, self).__init__(*args, **kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs['server_hostname'] = self.hostname
+        kwargs['assert_hostname'] = self.hostname
+        super(HostnameAdapter, self).init_poolmanager(*args, **kwargs)
+
+
+def _at_address(url, address):
+    '''Returns url with its host replaced by address, and the Host header
+    for it'''
+    parsed = urlparse.urlparse(url)
+    host = parsed.hostname
+    userinfo = parsed.netloc.rpartition('@')[:2]
+    netloc = ''.join(userinfo) + \
+        ('[{0}]'.format(address) if ':' in address else address)
+    if parsed.port:
+        host += ':{0}'.format(parsed.port)
+        netloc += ':{0}'.format(parsed.port)
+    return urlparse.urlunparse(parsed._replace(netloc=netloc)), host
+
+
+def new_secret():
+    return unicode(uuid.uuid4().hex)
+
+
+def sign(secret, timestamp, body):
+    return 'sha256=' + hmac.new(secret.encode('utf8'),
+                                '{0}.{1}'.format(timestamp, body),
+                                hashlib.sha256).hexdigest()
+
+
+def queue_event(session, event, issue, comment=None):
+    '''Queues event for each webhook subscribed to it, in the current
+    transaction, so it is only delivered if the change is committed'''
+    organization_id = issue.dataset.owner_org if issue.dataset else None
+    webhooks = issuemodel.IssueWebhook.for_event(session, event,
+                                                 organization_id)
+    if not webhooks:
+        return
+    data = {'issue': issue.as_dict()}
+    if comment is not None:
+        data['comment'] = comment.as_dict()
+    payload = unicode(json.dumps(data, default=unicode))
+    for webhook in webhooks:
+        session.add(issuemodel.IssueWebhookDelivery(webhook.id, event,
+                                                    payload))
+
+
+def backoff(failures):
+    '''Returns the seconds to wait after failures consecutive failures,
+    with some jitter so that webhooks that failed together spread out'''
+    seconds = min(BACKOFF_SECONDS * 2 ** (failures - 1), MAX_BACKOFF_SECONDS)
+    return seconds * random.uniform(0.8, 1.2)
+
+
+def _body(webhook, deliveries):
+    return json.dumps({
+        'webhook_id': webhook.id,
+        'events': [{
+            'id': delivery.id,
+            'event': delivery.event,
+            'created': delivery.created.isoformat(),
+            'data': json.loads(delivery.payload),
+        } for delivery in deliveries],
+    })
+
+
+def _post(request_args):
+    '''Posts a batch, returning None or the error. Runs in a worker thread,
+    so it doesn't touch the database.'''
+    url, secret, body, timeout = request_args
+    timestamp = str(int(time.time()))
+    try:
+        # again, as the host's addresses may have changed
+        address = resolve(url)
+    except ValueError, e:
+        return unicode(e)
+    hostname = urlparse.urlparse(url).hostname
+    url, host = _at_address(url, address)
+    http = requests.Session()
+    http.mount('https://', HostnameAdapter(hostname))
+    try:
+        response = http.post(url, data=body, timeout=timeout,
+                             allow_redirects=False, headers={
+            'Content-Type': 'application/json',
+            'Host': host,
+            'User-Agent': 'ckanext-issues',
+            'X-Issues-Timestamp': timestamp,
+            'X-Issues-Signature': sign(secret, timestamp, body),
+        })
+    except requests.RequestException, e:
+        return unicode(e)
+    finally:
+        http.close()
+    if not 200 <= response.status_code < 300:
+        return u'HTTP {0}'.format(response.status_code)
+    return None
+
+
+def _claim(session, webhook_id, now, lease_until):
+    '''Leases the webhook until lease_until, if it is still due, and returns
+    whether it was. The lease is a retry_at that other workers wait for.'''
+    webhook_table = issuemodel.issue_webhook_table
+    return session.execute(
+        webhook_table.update()
+        .where(webhook_table.c.id == webhook_id)
+        .where(or_(webhook_table.c.retry_at == None,
+                   webhook_table.c.retry_at <= now))
+        .values(retry_at=lease_until)).rowcount == 1
+
+
+def _release(session, webhook_id):
+    webhook_table = issuemodel.issue_webhook_table
+    session.execute(webhook_table.update()
+                    .where(webhook_table.c.id == webhook_id)
+                    .values(retry_at=None))
+
+
+def deliver_pending(session):
+    '''Posts a batch of pending events to each webhook that is due, and
+    returns the numbers of events (delivered, failed)'''
+    Delivery = issuemodel.IssueWebhookDelivery
+    Webhook = issuemodel.IssueWebhook
+    batch_size = _config_int('batch_size', DEFAULT_BATCH_SIZE)
+    max_attempts = _config_int('max_attempts', DEFAULT_MAX_ATTEMPTS)
+    concurrency = _config_int('concurrency', DEFAULT_CONCURRENCY)
+    timeout = _config_int('timeout', DEFAULT_TIMEOUT)
+    now = datetime.now()
+
+    # claim the batches, and commit that before posting them, so that no
+    # transaction is kept open while waiting for the webhooks
+    pending = session.query(distinct(Delivery.webhook_id))\
+        .filter(Delivery.state == u'pending')
+    webhooks = session.query(Webhook)\
+        .filter(Webhook.id.in_(pending))\
+        .filter(or_(Webhook.retry_at == None, Webhook.retry_at <= now))\
+        .all()
+    # long enough for each round of posts to connect and read the response,
+    # with a margin
+    rounds = -(-len(webhooks) // concurrency)
+    lease_until = now + timedelta(
+        seconds=rounds * 2 * timeout + LEASE_MARGIN_SECONDS)
+    batches = []
+    for webhook in webhooks:
+        if not _claim(session, webhook.id, now, lease_until):
+            # another worker has it
+            continue
+        deliveries = session.query(Delivery)\
+            .filter(Delivery.webhook_id == webhook.id)\
+            .filter(Delivery.state == u'pending')\
+            .order_by(Delivery.id).limit(batch_size).all()
+        if deliveries:
+            batches.append((
+                webhook.id, [delivery.id for delivery in deliveries],
+                (webhook.url, webhook.secret, _body(webhook, deliveries),
+                 timeout)))
+        else:
+            _release(session, webhook.id)
+    session.commit()
+    if not batches:
+        return 0, 0
+
+    pool = ThreadPool(min(len(batches), concurrency))
+    try:
+        errors = pool.map(_post, [request_args
+                                  for _, _, request_args in batches])
+    finally:
+        pool.close()
+
+    now = datetime.now()
+    delivered = failed = 0
+    for (webhook_id, delivery_ids, _), error in zip(batches, errors):
+        webhook = Webhook.get(webhook_id, session=session)
+        deliveries = session.query(Delivery)\
+            .filter(Delivery.id.in_(delivery_ids)).all()
+        if error is None:
+            for delivery in deliveries:
+                session.delete(delivery)
+            if webhook is not None:
+                webhook.failures = 0
+                webhook.retry_at = None
+            delivered += len(deliveries)
+            continue
+        log.warning('Webhook %s failed: %s', webhook_id, error)
+        if webhook is not None:
+            webhook.failures += 1
+            webhook.retry_at = now + timedelta(
+                seconds=backoff(webhook.failures))
+        for delivery in deliveries:
+            delivery.attempts += 1
+            delivery.last_error = error
+            if delivery.attempts >= max_attempts:
+                delivery.state = u'failed'
+                failed += 1
+    session.commit()
+    return delivered, failed
+
+
+def run_worker(session, once=False):
+    '''Delivers events until stopped, polling every
+    ckanext.issues.webhooks.poll_interval seconds when there are none'''
+    poll_interval = _config_int('poll_interval', DEFAULT_POLL_INTERVAL)
+    while True:
+        delivered = failed = 0
+        try:
+            delivered, failed = deliver_pending(session)
+        except Exception:
+            log.exception('Webhook delivery failed')
+            session.rollback()
+        finally:
+            session.remove()
+        if delivered or failed:
+            log.info('Delivered %s webhook events, gave up on %s',
+                     delivered, failed)
+        if once:
+            return
+        if not delivered:
+            time.sleep(poll_interval)
@@ -1,15 +1,24 @@
 from action import (
+    issue_changes,
     issue_comment_create,
     issue_create,
     issue_delete,
     issue_search,
     issue_show,
+    issue_similar,
     issue_report,
     issue_report_show,
     issue_report_clear,
     issue_comment_report,
     issue_comment_report_clear,
     issue_comment_search,
+    issue_moderation_queue,
+    issue_notification_frequency_show,
+    issue_notification_frequency_update,
     issue_update,
+    issue_user_dashboard,
+    issue_webhook_create,
+    issue_webhook_delete,
+    issue_webhook_list,
     organization_users_autocomplete,
 )
@@ -1,16 +1,22 @@
+import hashlib
 import logging
-from datetime import datetime
+from datetime import datetime, timedelta
 
 import ckan.logic as logic
 import ckan.plugins as p
 import ckan.model as model
-from ckan.lib import mailer
 from ckan.lib.base import render_jinja2
 from ckan.logic import validate
 import ckan.lib.helpers as h
 import ckanext.issues.model as issuemodel
 from ckanext.issues.logic import schema
 from ckanext.issues.exception import ReportAlreadyExists
+from ckanext.issues.lib import (archive, autocomplete, categories,
+                                 rate_limit, search, similar, slow_queries,
+                                 spam, webhooks)
+from ckanext.issues.lib.notifications import (send_to_users,
+                                               queue_for_digests,
+                                               default_frequency)
 from ckanext.issues.lib.helpers import get_issue_subject, get_site_title
 try:
     import ckan.authz as authz
@@ -19,14 +25,21 @@ except ImportError:
 
 from pylons import config
 from sqlalchemy.exc import IntegrityError
-from sqlalchemy import desc
+from sqlalchemy import desc, func
 
 _get_or_bust = logic.get_or_bust
 
+DEFAULT_CHANGES_LIMIT = 100
+MAX_CHANGES_LIMIT = 1000
+DEFAULT_CHANGES_SETTLE_SECONDS = 0
+MAX_SIMILAR_LIMIT = 20
+
 log = logging.getLogger(__name__)
 
 
 def _add_reports(obj, can_edit, current_user):
+    if not obj.report_count:
+        return []
     reports = [r.user_id for r in obj.abuse_reports]
     if can_edit:
         return reports
@@ -49,6 +62,13 @@ def issue_show(context, data_dict):
     :type issue_number: string
     :param include_reports: whether to include abuse reports in the output
     :type include_reports: bool
+    :param include_archived: whether to return the issue if it has been
+        archived (see `paster issues archive`)
+    :type include_archived: bool
+    :param fields: the keys wanted in the result (optional, default all of
+        them), as a list or comma separated string, e.g. 'number,title'.
+        Those left out, such as user and comments, are not loaded.
+    :type fields: list of strings
 
     :rtype: dictionary
     '''
@@ -60,51 +80,84 @@ def issue_show(context, data_dict):
         issue_number=issue_number,
         session=session)
     if not issue:
+        if data_dict.get('include_archived'):
+            return _archived_issue_show(context, data_dict)
         raise p.toolkit.ObjectNotFound(p.toolkit._('Issue does not exist'))
 
     context['issue'] = issue
-    issue_dict = issue.as_dict()
-
-    user = context.get('user')
-    if user:
-        try:
-            can_edit = p.toolkit.check_access(
-                'package_update',
-                context,
-                data_dict={'id': issue.dataset_id}
-            )
-        except p.toolkit.NotAuthorized:
-            can_edit = False
-    else:
-        can_edit = False
+    fields = data_dict.get('fields')
+    issue_dict = issue.as_dict(fields)
 
+    can_edit = _can_edit_dataset(context, issue.dataset_id)
     if issue.visibility != 'visible' and not can_edit:
         raise p.toolkit.ObjectNotFound(
             p.toolkit._('Issue marked as spam/abuse'))
 
     include_reports = data_dict.get('include_reports')
 
-    comments = []
-    for comment in issue.comments:
-        comment_dict = comment.as_dict()
-        if include_reports:
-            comment_dict['abuse_reports'] = _add_reports(comment, can_edit,
-                                                         context['user'])
-        comments.append(comment_dict)
+    if fields is None or 'comments' in fields:
+        comments = []
+        user_dicts = {}
+        for comment in issue.comments:
+            comment_dict = comment.as_dict(user_dicts)
+            if include_reports:
+                comment_dict['abuse_reports'] = _add_reports(
+                    comment, can_edit, context['user'])
+            comments.append(comment_dict)
+        issue_dict['comments'] = comments
+
+    p.toolkit.check_access('issue_show', context,
+                           {'dataset_id': issue.dataset_id})
+    return issue_dict
+
 
-    issue_dict['comments'] = comments
+def _can_edit_dataset(context, dataset_id):
+    if not context.get('user'):
+        return False
+    try:
+        return p.toolkit.check_access('package_update', context,
+                                      data_dict={'id': dataset_id})
+    except p.toolkit.NotAuthorized:
+        return False
+
+
+def _archived_issue_show(context, data_dict):
+    include_reports = data_dict.get('include_reports')
+    issue_dict = archive.archived_issue_dict(
+        context['session'], data_dict['dataset_id'],
+        data_dict['issue_number'], include_reports=include_reports)
+    if issue_dict is None:
+        raise p.toolkit.ObjectNotFound(p.toolkit._('Issue does not exist'))
+
+    can_edit = _can_edit_dataset(context, issue_dict['dataset_id'])
+    if issue_dict['visibility'] != 'visible' and not can_edit:
+        raise p.toolkit.ObjectNotFound(
+            p.toolkit._('Issue marked as spam/abuse'))
+    if include_reports and not can_edit:
+        user_obj = model.User.get(context['user'])
+        user_id = user_obj.id if user_obj else None
+        _filter_reports_for_user(user_id, [issue_dict])
+        _filter_reports_for_user(user_id, issue_dict['comments'])
 
     p.toolkit.check_access('issue_show', context, issue_dict)
-    return issue_dict
+    return _select_fields(issue_dict, data_dict.get('fields'))
+
+
+def _select_fields(issue_dict, fields):
+    '''Returns just the fields of issue_dict wanted, if any are given'''
+    if fields is None:
+        return issue_dict
+    return dict((field, issue_dict[field]) for field in fields
+                if field in issue_dict)
 
 
 def _get_next_issue_number(session, dataset_id):
     q = session.query(issuemodel.Issue)\
         .filter(issuemodel.Issue.dataset_id == dataset_id)\
         .order_by(desc('number')).first()
-    if not q:
-        return 1
-    return q.number + 1
+    # the latest issues may have been archived
+    archived = archive.last_archived_number(session, dataset_id)
+    return max(q.number if q else 0, archived or 0) + 1
 
 
 def _get_recipients(context, dataset):
@@ -163,11 +216,14 @@ def issue_create(context, data_dict):
     :param dataset_id: the name or id of the dataset that the issue item
         belongs to (optional)
     :type dataset_id: string
+    :param categories: the names of the categories of the issue (optional)
+    :type categories: list of strings
 
     :returns: the newly created issue item
     :rtype: dictionary
     '''
     p.toolkit.check_access('issue_create', context, data_dict)
+    rate_limit.check(context, 'issue')
 
     user = context['user']
     user_obj = model.User.get(user)
@@ -175,31 +231,35 @@ def issue_create(context, data_dict):
 
     dataset = model.Package.get(data_dict['dataset_id'])
     del data_dict['dataset_id']
+    category_ids = data_dict.pop('categories', None)
 
     issue = issuemodel.Issue(**data_dict)
     issue.dataset_id = dataset.id
     session = context['session']
     issue.number = _get_next_issue_number(session, dataset.id)
+    issue.set_categories(session, category_ids)
+    similar.update_signature(issue)
 
     session.add(issue)
+    session.flush()
+    webhooks.queue_event(session, 'issue.created', issue)
+    spam.queue_check(session, issue)
     session.commit()
+    search.index_issue(session, issue)
 
     notifications = p.toolkit.asbool(
         config.get('ckanext.issues.send_email_notifications')
     )
 
     if notifications:
-        recipients = _get_recipients(context, dataset)
-        subject = get_issue_subject(issue.as_dict())
-        body = _get_issue_email_body(issue, subject, user_obj)
-
-        for recipient in recipients:
-            user_obj = model.User.get(recipient)
-            try:
-                mailer.mail_user(user_obj, subject, body)
-            except (mailer.MailerException, TypeError), e:
-                # TypeError occurs when we're running command from ckanapi
-                log.debug(e.message)
+        recipients = queue_for_digests(
+            session, _get_recipients(context, dataset), dataset.owner_org,
+            'issue.created', issue, user_obj.id)
+        session.commit()
+        if recipients:
+            subject = get_issue_subject(issue.as_dict())
+            body = _get_issue_email_body(issue, subject, user_obj)
+            send_to_users(session, recipients, subject, body)
 
     log.debug('Created issue %s (%s)' % (issue.title, issue.id))
     return issue.as_dict()
@@ -220,6 +280,9 @@ def issue_update(context, data_dict):
     :type dataset_id: string
     :param issue_number: the number of the issue.
     :type issue_number: int
+    :param categories: the names of the categories of the issue, replacing
+        its current ones (optional)
+    :type categories: list of strings
 
     :returns: the newly updated issue item
     :rtype: dictionary
@@ -237,11 +300,15 @@ def issue_update(context, data_dict):
 
     # TODO: move to validation?
     ignored_keys = ['id', 'created', 'user', 'dataset_id', 'visibility',
-                    'issue_number', '__extras']
+                    'issue_number', 'categories', '__extras']
 
     for k, v in data_dict.items():
         if k not in ignored_keys:
             setattr(issue, k, v)
+    if 'categories' in data_dict:
+        issue.set_categories(session, data_dict['categories'])
+    if 'title' in data_dict or 'description' in data_dict:
+        similar.update_signature(issue)
 
     if status_change:
         if data_dict['status'] == issuemodel.ISSUE_STATUS.closed:
@@ -253,8 +320,12 @@ def issue_update(context, data_dict):
         elif data_dict['status'] == issuemodel.ISSUE_STATUS.open:
             issue.resolved = None
 
+    issue.touch()
     session.add(issue)
+    if status_change and issue.status == issuemodel.ISSUE_STATUS.closed:
+        webhooks.queue_event(session, 'issue.closed', issue)
     session.commit()
+    search.index_issue(session, issue)
     return issue.as_dict()
 
 
@@ -285,8 +356,11 @@ def issue_delete(context, data_dict):
                 dataset_id=dataset_id,
             )
         )
-    session.delete(issue)
+    issue_id = issue.id
+    # deletes its comments and reports without loading them
+    issuemodel.delete_issues(session, [issue_id])
     session.commit()
+    search.delete_issue(issue_id)
 
 
 @p.toolkit.side_effect_free
@@ -307,6 +381,12 @@ def issue_search(context, data_dict):
     :param q: a query string, currently on searches for titles that match
         this query
     :type q: string
+    :param category: the name of a category to filter the issues by
+    :type category: string
+    :param assignee_id: the name or id of the user the issues are assigned to
+    :type assignee_id: string
+    :param user_id: the name or id of the user who opened the issues
+    :type user_id: string
     :param sort: sorting method for the results returned
     :type sort: string, must be 'newest', 'oldest', 'most_commented',
         'least_commented', 'recently_update', 'least_recently_updated'
@@ -326,6 +406,20 @@ def issue_search(context, data_dict):
         only want to do this if you're just looking to get a count of the
         number of datasets without fetching and dictizing the issue objects
     :type include_results: bool
+    :param facets: also return the number of matching issues by status,
+        visibility, abuse_status, assignee_id, category and (unless searching
+        a single dataset) dataset_id, as e.g.
+        {'status': {'open': 3, 'closed': 1}}. Either true for all of them,
+        or a list of the ones wanted.
+    :type facets: bool or list of strings
+    :param include_archived: also search the issues that have been archived
+        (see `paster issues archive`), which are marked 'archived'
+    :type include_archived: bool
+    :param fields: the keys wanted in each result (optional, default all of
+        them), as a list or comma separated string, e.g.
+        'number,title,status,comment_count'. Only the columns needed are
+        queried, and what is left out (e.g. categories) is not loaded.
+    :type fields: list of strings
 
     :returns: list of issues
     :rtype: list of dictionaries
@@ -359,38 +453,102 @@ def issue_search(context, data_dict):
 
     data_dict['visibility'] = visibility
     data_dict.pop('__extras', None)
-    include_datasets = p.toolkit.asbool(data_dict.get('include_datasets'))
-    include_reports = p.toolkit.asbool(data_dict.get('include_reports'))
+    include_datasets = p.toolkit.asbool(data_dict.pop('include_datasets',
+                                                      False))
+    include_reports = p.toolkit.asbool(data_dict.pop('include_reports', False))
     include_count = p.toolkit.asbool(data_dict.pop('include_count', True))
     include_results = p.toolkit.asbool(data_dict.pop('include_results', True))
-    data_dict['include_datasets'] = include_datasets
-
-    query = issuemodel.Issue.get_issues(
-        session=context['session'],
-        **data_dict)
-
-    if include_count:
-        count = query.count()
-    else:
-        count = None
-
-    if include_results:
-        results = [issue.as_plain_dict(u, comment_count_, updated,
-                                       include_dataset=include_datasets,
-                                       include_reports=include_reports)
-                   for (issue, u, comment_count_, updated) in query.all()]
-    else:
-        results = []
+    include_archived = p.toolkit.asbool(data_dict.pop('include_archived',
+                                                      False))
+    facet_fields = data_dict.pop('facets', [])
+    fields = data_dict.pop('fields', None)
+    # the results are made from just the columns they need, rather than
+    # Issue objects (see Issue.get_issue_rows)
+    search_fields = issuemodel.ISSUE_SEARCH_FIELDS
+    if fields is not None:
+        search_fields = fields
+        if include_archived:
+            # and what archive.merge sorts by
+            search_fields = list(fields) + ['id', 'created', 'updated',
+                                            'comment_count']
+    include_facets = bool(facet_fields)
+    if dataset_id:
+        facet_fields = [field for field in facet_fields
+                        if field != 'dataset_id']
+    if 'category' in data_dict:
+        data_dict['category_id'] = data_dict.pop('category')
+
+    backend = search.get_backend()
+    search_filters = data_dict
+    if include_archived:
+        # the first offset + limit of each, to be merged
+        search_filters = dict(data_dict, offset=0)
+        if data_dict.get('limit'):
+            search_filters['limit'] = (data_dict.get('offset') or 0) + \
+                data_dict['limit']
+    with slow_queries.watch('issue_search', details=data_dict):
+        count, rows = backend.search(
+            context['session'], search_filters,
+            include_count=include_count,
+            include_results=include_results,
+            include_reports=include_reports,
+            fields=search_fields)
+        results = issuemodel.issue_rows_as_dicts(
+            context['session'], rows, search_fields,
+            include_datasets=include_datasets,
+            include_reports=include_reports)
+        if include_archived:
+            archived_count, archived_results = archive.search_archived(
+                context['session'], data_dict,
+                include_count=include_count,
+                include_results=include_results,
+                include_datasets=include_datasets,
+                include_reports=include_reports)
+            if include_count:
+                count += archived_count
+            results = archive.merge(data_dict, results, archived_results)
+            if fields is not None:
+                results = [_select_fields(result, fields)
+                           for result in results]
+        if include_facets:
+            facet_counts = backend.facet_counts(
+                context['session'], data_dict, facet_fields)
+            if include_archived:
+                archive.add_facet_counts(facet_counts, archive.facet_counts(
+                    context['session'], data_dict, facet_fields))
+            facets = _facets_dict(facet_counts)
 
     if include_reports and not can_update:
         user_obj = model.User.get(user)
         if user_obj:
             results = _filter_reports_for_user(user_obj.id, results)
 
-    return {
+    result = {
         'count': count,
         'results': results,
     }
+    if include_facets:
+        result['facets'] = facets
+    return result
+
+
+def _facets_dict(facet_counts):
+    '''Makes the facet counts JSON friendly: abuse statuses are given by
+    name, and issues without a value (e.g. unassigned) are left out'''
+    facets = {}
+    for field, counts in facet_counts.items():
+        if field == 'abuse_status':
+            counts = dict((issuemodel.AbuseStatus(value).name, count)
+                          for value, count in counts.items()
+                          if value is not None)
+        elif field == 'category_id':
+            field = 'category'
+            counts = dict((categories.get(value)['name'], count)
+                          for value, count in counts.items()
+                          if categories.get(value))
+        facets[field] = dict((value, count) for value, count
+                             in counts.items() if value is not None)
+    return facets
 
 
 def _filter_reports_for_user(user_id, results):
@@ -409,6 +567,43 @@ def _filter_reports_for_user(user_id, results):
     return results
 
 
+@p.toolkit.side_effect_free
+@validate(schema.issue_similar_schema)
+def issue_similar(context, data_dict):
+    '''The open issues of a dataset most like a new one, to suggest them as
+    it is written
+
+    :param dataset_id: the name or id of the dataset
+    :type dataset_id: string
+    :param title: the title of the new issue (optional)
+    :type title: string
+    :param description: the description of the new issue (optional)
+    :type description: string
+    :param limit: the most issues to return (optional, default 5, at most 20)
+    :type limit: int
+
+    :returns: the issues, most similar first, with their number, title,
+        ckan_url and similarity (from 0 to 1)
+    :rtype: list of dictionaries
+    '''
+    p.toolkit.check_access('issue_similar', context, data_dict)
+    dataset = model.Package.get(data_dict['dataset_id'])
+    limit = min(data_dict.get('limit', similar.DEFAULT_LIMIT),
+                MAX_SIMILAR_LIMIT)
+    threshold = float(config.get('ckanext.issues.similar_threshold',
+                                 similar.DEFAULT_THRESHOLD))
+    text = u'{0}\n{1}'.format(data_dict.get('title', u''),
+                              data_dict.get('description', u''))
+    matches = similar.find_similar(context['session'], dataset.id, text,
+                                   threshold, limit)
+    return [{'number': number,
+             'title': title,
+             'ckan_url': h.url_for('issues_show', dataset_id=dataset.name,
+                                   issue_number=number),
+             'similarity': round(score, 2)}
+            for score, number, title in matches]
+
+
 @validate(schema.issue_comment_schema)
 def issue_comment_create(context, data_dict):
     '''Add a new issue comment.
@@ -426,6 +621,7 @@ def issue_comment_create(context, data_dict):
     :rtype: dictionary
     '''
     p.toolkit.check_access('issue_comment_create', context, data_dict)
+    rate_limit.check(context, 'comment')
     user = context['user']
     user_obj = model.User.get(user)
 
@@ -444,8 +640,14 @@ def issue_comment_create(context, data_dict):
     })
 
     issue_comment = issuemodel.IssueComment(**comment_dict)
+    issue.touch()
     model.Session.add(issue_comment)
+    model.Session.flush()
+    webhooks.queue_event(model.Session, 'comment.created', issue,
+                         issue_comment)
+    spam.queue_check(model.Session, issue_comment)
     model.Session.commit()
+    search.index_issue(context['session'], issue)
 
     notifications = p.toolkit.asbool(
         config.get('ckanext.issues.send_email_notifications')
@@ -453,17 +655,15 @@ def issue_comment_create(context, data_dict):
 
     if notifications:
         dataset = model.Package.get(data_dict['dataset_id'])
-        recipients = _get_recipients(context, dataset)
-        subject = get_issue_subject(issue.as_dict())
-        body = _get_comment_email_body(issue_comment, subject, user_obj)
-
-        for recipient in recipients:
-            user_obj = model.User.get(recipient)
-            try:
-                mailer.mail_user(user_obj, subject, body)
-            except (mailer.MailerException, TypeError), e:
-                # TypeError occurs when we're running command from ckanapi
-                log.debug(e.message)
+        recipients = queue_for_digests(
+            model.Session, _get_recipients(context, dataset),
+            dataset.owner_org, 'comment.created', issue, user_obj.id,
+            comment=issue_comment)
+        model.Session.commit()
+        if recipients:
+            subject = get_issue_subject(issue.as_dict())
+            body = _get_comment_email_body(issue_comment, subject, user_obj)
+            send_to_users(model.Session, recipients, subject, body)
 
     log.debug('Created issue comment %s' % (issue.id))
     return issue_comment.as_dict()
@@ -472,29 +672,22 @@ def issue_comment_create(context, data_dict):
 @p.toolkit.side_effect_free
 @validate(schema.organization_users_autocomplete_schema)
 def organization_users_autocomplete(context, data_dict):
-    session = context['session']
-    user = context['user']
+    '''Editors and admins of an organization whose user name, full name or
+    a word of their full name starts with q
+
+    :param q: the prefix to search for (case insensitive)
+    :type q: string
+    :param organization_id: the id of the organization
+    :type organization_id: string
+    :param limit: maximum number of users to return (default: 20)
+    :type limit: int
+
+    :rtype: list of dictionaries
+    '''
     q = data_dict['q']
     organization_id = data_dict['organization_id']
     limit = data_dict.get('limit', 20)
-    query = session.query(model.User.id, model.User.name,
-                          model.User.fullname)\
-        .filter(model.Member.group_id == organization_id)\
-        .filter(model.Member.table_name == 'user')\
-        .filter(model.Member.capacity.in_(['editor', 'admin']))\
-        .filter(model.Member.state == 'active')\
-        .filter(model.User.state != model.State.DELETED)\
-        .filter(model.User.id == model.Member.table_id)\
-        .filter(model.User.name.ilike('{0}%'.format(q)))\
-        .distinct()\
-        .limit(limit)
-
-    users = []
-    for user in query.all():
-        user_dict = dict(user.__dict__)
-        user_dict.pop('_labels', None)
-        users.append(user_dict)
-    return users
+    return autocomplete.search(context['session'], organization_id, q, limit)
 
 
 @validate(schema.issue_report_schema)
@@ -518,6 +711,7 @@ def issue_report(context, data_dict):
     :rtype: dict
     '''
     p.toolkit.check_access('issue_report', context, data_dict)
+    rate_limit.check(context, 'report')
     session = context['session']
 
     issue = issuemodel.Issue.get_by_name_or_id_and_number(
@@ -531,8 +725,9 @@ def issue_report(context, data_dict):
 
 def _comment_or_issue_report(issue_or_comment, user_ref, dataset_id, session):
     user_obj = model.User.get(user_ref)
+    was_visible = issue_or_comment.visibility != u'hidden'
     try:
-        issue_or_comment.report_abuse(session, user_obj.id)
+        report_count = issue_or_comment.report_abuse(session, user_obj.id)
     except IntegrityError:
         session.rollback()
         raise ReportAlreadyExists(
@@ -551,18 +746,27 @@ def _comment_or_issue_report(issue_or_comment, user_ref, dataset_id, session):
 
         issue_or_comment.change_visibility(session, u'hidden')
         issue_or_comment.abuse_status = issuemodel.AbuseStatus.abuse.value
+        # the spam retention period starts from now
+        if isinstance(issue_or_comment, issuemodel.Issue):
+            issue_or_comment.touch()
+        else:
+            issue_or_comment.moderated = datetime.now()
         return {'visibility': issue_or_comment.visibility,
                 'abuse_reports': issue_or_comment.abuse_reports,
                 'abuse_status': issue_or_comment.abuse_status}
     except p.toolkit.NotAuthorized:
         max_strikes = config.get('ckanext.issues.max_strikes')
         if (max_strikes
-           and len(issue_or_comment.abuse_reports) >=
-           p.toolkit.asint(max_strikes)):
+           and report_count >= p.toolkit.asint(max_strikes)):
                 issue_or_comment.change_visibility(session, u'hidden')
     finally:
+        if isinstance(issue_or_comment, issuemodel.Issue) and was_visible \
+                and issue_or_comment.visibility == u'hidden':
+            webhooks.queue_event(session, 'issue.hidden', issue_or_comment)
         # commit the IssueReport and changes to the Issue/Comment
         session.commit()
+        if isinstance(issue_or_comment, issuemodel.Issue):
+            search.index_issue(session, issue_or_comment)
 
 
 @validate(schema.issue_comment_report_schema)
@@ -583,6 +787,7 @@ def issue_comment_report(context, data_dict):
     :rtype: dict
     '''
     p.toolkit.check_access('issue_report', context, data_dict)
+    rate_limit.check(context, 'report')
     session = context['session']
 
     comment_id = data_dict['comment_id']
@@ -675,14 +880,16 @@ def issue_report_clear(context, data_dict):
                                data_dict={'id': dataset_id})
         issue.clear_all_abuse_reports(session)
         issue.abuse_status = issuemodel.AbuseStatus.not_abuse.value
+        issue.touch()
     except p.toolkit.NotAuthorized:
-        issue.clear_abuse_report(session, user_id)
+        report_count = issue.clear_abuse_report(session, user_id)
         max_strikes = config.get('ckanext.issues.max_strikes')
         if (max_strikes
-           and len(issue.abuse_reports) <= p.toolkit.asint(max_strikes)):
+           and report_count <= p.toolkit.asint(max_strikes)):
             issue.change_visibility(session, u'visible')
     finally:
         session.commit()
+        search.index_issue(session, issue)
     return True
 
 
@@ -716,11 +923,12 @@ def issue_comment_report_clear(context, data_dict):
                                data_dict={'id': dataset_id})
         comment.clear_all_abuse_reports(session)
         comment.abuse_status = issuemodel.AbuseStatus.not_abuse.value
+        comment.moderated = datetime.now()
     except p.toolkit.NotAuthorized:
-        comment.clear_abuse_report(session, user_id)
+        report_count = comment.clear_abuse_report(session, user_id)
         max_strikes = config.get('ckanext.issues.max_strikes')
         if (max_strikes and
-           len(comment.abuse_reports) <= p.toolkit.asint(max_strikes)):
+           report_count <= p.toolkit.asint(max_strikes)):
             comment.change_visibility(session, u'visible')
     finally:
         session.commit()
@@ -757,3 +965,365 @@ def issue_comment_search(context, data_dict):
         comments.append(comment_dict)
 
     return comments
+
+
+@p.toolkit.side_effect_free
+@validate(schema.issue_moderation_queue_schema)
+def issue_moderation_queue(context, data_dict):
+    '''The issues and comments that are hidden, pending moderation
+
+    Items are ordered with the most reported first, then the oldest first.
+
+    :param organization_id: the name or id of the organization to show the
+        queue for. Only sysadmins may see the queue for the whole site.
+    :type organization_id: string
+    :param include_sub_organizations: if filtering by organization_id, this
+        includes organizations below the specified one in the hierarchy.
+        (default=False)
+    :type include_sub_organizations: bool
+    :param type: only return items of this type - 'issue' or 'comment'
+        (optional)
+    :type type: string
+    :param limit: number of results to return
+    :type limit: int
+    :param offset: offset of the results to return
+    :type offset: int
+
+    :returns: the total count and the requested page of queue items
+    :rtype: dictionary
+    '''
+    p.toolkit.check_access('issue_moderation_queue', context, data_dict)
+    count, rows = issuemodel.moderation_queue(
+        context['session'],
+        organization_id=data_dict.get('organization_id'),
+        include_sub_organizations=p.toolkit.asbool(
+            data_dict.get('include_sub_organizations')),
+        item_type=data_dict.get('type'),
+        limit=data_dict.get('limit'),
+        offset=data_dict.get('offset'),
+    )
+    return {
+        'count': count,
+        'results': [_moderation_queue_item_dict(row) for row in rows],
+    }
+
+
+def _moderation_queue_item_dict(row):
+    email = (row.pop('user_email') or '').strip().lower().encode('utf8')
+    row['user'] = {
+        'id': row['user_id'],
+        'name': row.pop('user_name'),
+        'fullname': row.pop('user_fullname'),
+        'email_hash': hashlib.md5(email).hexdigest(),
+    }
+    if isinstance(row['created'], datetime):
+        row['created'] = row['created'].isoformat()
+    return row
+
+
+@p.toolkit.side_effect_free
+@validate(schema.issue_user_dashboard_schema)
+def issue_user_dashboard(context, data_dict):
+    '''The issues assigned to a user and the issues they opened, across all
+    datasets
+
+    :param user: the name or id of the user (optional, defaults to you)
+    :type user: string
+    :param list: 'assigned' or 'opened', to return the issues of only that
+        list (the counts of both are always returned) (optional)
+    :type list: string
+    :param status: only return issues with this status (default: 'open')
+    :type status: string
+    :param q: a query string, as for issue_search (optional)
+    :type q: string
+    :param sort: sorting method for the issues returned, as for
+        issue_search (default: 'newest')
+    :type sort: string
+    :param limit: number of issues to return from each list
+    :type limit: int
+    :param offset: offset of the issues to return from each list
+    :type offset: int
+
+    :returns: for 'assigned' and 'opened', the number of issues with each
+        status ('status_counts'), the number with the status asked for
+        ('count') and those issues ('results')
+    :rtype: dictionary
+    '''
+    p.toolkit.check_access('issue_user_dashboard', context, data_dict)
+    user_id = data_dict.get('user')
+    if not user_id:
+        user_obj = model.User.get(context['user'])
+        if not user_obj:
+            raise p.toolkit.ObjectNotFound(p.toolkit._('User not found'))
+        user_id = user_obj.id
+    status = data_dict.get('status', issuemodel.ISSUE_STATUS.open)
+    search_context = {
+        'user': context['user'],
+        'model': model,
+        'session': context['session'],
+    }
+    issue_search = p.toolkit.get_action('issue_search')
+
+    dashboard = {}
+    for list_name, field in zip(issuemodel.DASHBOARD_LISTS,
+                                ('assignee_id', 'user_id')):
+        search_dict = {
+            field: user_id,
+            'q': data_dict.get('q'),
+            'include_count': False,
+        }
+        # the status counts are of all the issues in the list, served by
+        # the (assignee_id, status, created) and (user_id, created) indexes
+        status_counts = issue_search(dict(search_context), dict(
+            search_dict, include_results=False, facets=['status'],
+        ))['facets']['status']
+        results = []
+        if data_dict.get('list') in (None, list_name):
+            results = issue_search(dict(search_context), dict(
+                search_dict,
+                status=status,
+                sort=data_dict.get('sort', 'newest'),
+                limit=data_dict.get('limit'),
+                offset=data_dict.get('offset'),
+                include_datasets=True,
+            ))['results']
+        dashboard[list_name] = {
+            'count': status_counts.get(status, 0),
+            'status_counts': status_counts,
+            'results': results,
+        }
+    return dashboard
+
+
+@p.toolkit.side_effect_free
+@validate(schema.issue_changes_schema)
+def issue_changes(context, data_dict):
+    '''The changes to issues and comments (including their reports and
+    deletions) since a position in the change log, for keeping a copy of
+    the issues up to date
+
+    Start with since=0, and then pass the next_since of each response. Each
+    object is returned once per batch, with its latest change and its
+    current state ('object', which is None if it has been deleted or
+    archived since). Issues and comments moved to the archive tables (see
+    `paster issues archive`) have the change 'archived'.
+    Changes are only returned once every change before them has been
+    committed, so none are skipped (see issuemodel.committed_change_id),
+    and after ckanext.issues.changes_settle_seconds (default 0).
+
+    :param since: the next_since of the previous batch (default: 0)
+    :type since: int
+    :param limit: the most changes to read from the log (default: 100,
+        maximum: 1000)
+    :type limit: int
+
+    :returns: 'changes', 'next_since' and whether there are 'more' changes
+        waiting
+    :rtype: dictionary
+    '''
+    p.toolkit.check_access('issue_changes', context, data_dict)
+    session = context['session']
+    since = data_dict.get('since', 0)
+    limit = min(data_dict.get('limit', DEFAULT_CHANGES_LIMIT),
+                MAX_CHANGES_LIMIT)
+    settle_seconds = p.toolkit.asint(config.get(
+        'ckanext.issues.changes_settle_seconds',
+        DEFAULT_CHANGES_SETTLE_SECONDS))
+
+    log_rows = issuemodel.changes_since(
+        session, since=since, limit=limit,
+        before=datetime.now() - timedelta(seconds=settle_seconds))
+
+    # only the latest change to each object, in log order
+    latest = {}
+    for row in log_rows:
+        latest[(row.object_type, row.object_id)] = row
+    rows = sorted(latest.values(), key=lambda row: row.id)
+
+    ids = dict((object_type, [row.object_id for row in rows
+                              if row.object_type == object_type and
+                              row.change not in (u'deleted',
+                                                 u'archived')])
+               for object_type in (u'issue', u'comment'))
+    objects = {}
+    if ids['issue']:
+        fields = issuemodel.ISSUE_SEARCH_FIELDS
+        issue_rows = issuemodel.Issue.get_issue_rows(
+            fields, session=session, issue_ids=ids['issue']).all()
+        for issue_dict in issuemodel.issue_rows_as_dicts(session, issue_rows,
+                                                         fields):
+            objects[('issue', issue_dict['id'])] = issue_dict
+    if ids['comment']:
+        user_dicts = {}
+        for comment in session.query(issuemodel.IssueComment)\
+                .filter(issuemodel.IssueComment.id.in_(ids['comment'])):
+            objects[('comment', comment.id)] = comment.as_dict(user_dicts)
+
+    return {
+        'changes': [{
+            'seq': row.id,
+            'object_type': row.object_type,
+            'object_id': row.object_id,
+            'issue_id': row.issue_id,
+            'change': row.change,
+            'created': row.created.isoformat(),
+            'object': objects.get((row.object_type, row.object_id)),
+        } for row in rows],
+        'next_since': log_rows[-1].id if log_rows else since,
+        'more': len(log_rows) == limit,
+    }
+
+
+@validate(schema.issue_webhook_create_schema)
+def issue_webhook_create(context, data_dict):
+    '''Register a webhook, to be sent issue events
+
+    The events are posted as JSON, signed with the secret returned (see
+    ckanext.issues.lib.webhooks).
+
+    :param url: the http or https url to post the events to. Unless you
+        are a sysadmin, its host must be on
+        ckanext.issues.webhooks.allowed_hosts, and it can't resolve to a
+        private address (see ckanext.issues.lib.webhooks).
+    :type url: string
+    :param organization_id: the organization whose events are sent
+        (optional, sysadmins only: defaults to all organizations)
+    :type organization_id: string
+    :param events: the events to send, out of 'issue.created',
+        'issue.closed', 'comment.created' and 'issue.hidden' (default: all)
+    :type events: list of strings
+
+    :returns: the webhook, including its secret
+    :rtype: dictionary
+    '''
+    p.toolkit.check_access('issue_webhook_create', context, data_dict)
+    session = context['session']
+    user_obj = model.User.get(context['user'])
+    webhook = issuemodel.IssueWebhook(
+        url=data_dict['url'],
+        secret=webhooks.new_secret(),
+        events=data_dict.get('events', issuemodel.WEBHOOK_EVENTS),
+        user_id=user_obj.id,
+        organization_id=data_dict.get('organization_id'),
+    )
+    session.add(webhook)
+    session.commit()
+    webhook_dict = webhook.as_dict()
+    webhook_dict['secret'] = webhook.secret
+    return webhook_dict
+
+
+@p.toolkit.side_effect_free
+@validate(schema.issue_webhook_list_schema)
+def issue_webhook_list(context, data_dict):
+    '''The webhooks of an organization, or (for sysadmins) all of them
+
+    :param organization_id: the organization (optional, sysadmins only:
+        defaults to all webhooks)
+    :type organization_id: string
+
+    :returns: the webhooks, without their secrets, with the number of events
+        waiting to be sent and given up on
+    :rtype: list of dictionaries
+    '''
+    p.toolkit.check_access('issue_webhook_list', context, data_dict)
+    session = context['session']
+    Webhook = issuemodel.IssueWebhook
+    Delivery = issuemodel.IssueWebhookDelivery
+    query = session.query(Webhook)
+    if data_dict.get('organization_id'):
+        query = query.filter(
+            Webhook.organization_id == data_dict['organization_id'])
+    webhook_list = query.order_by(Webhook.id).all()
+
+    counts = {}
+    if webhook_list:
+        counts = dict(
+            ((webhook_id, state), count) for webhook_id, state, count
+            in session.query(Delivery.webhook_id, Delivery.state,
+                             func.count(Delivery.id))
+            .filter(Delivery.webhook_id.in_([w.id for w in webhook_list]))
+            .group_by(Delivery.webhook_id, Delivery.state))
+    results = []
+    for webhook in webhook_list:
+        webhook_dict = webhook.as_dict()
+        webhook_dict['pending'] = counts.get((webhook.id, u'pending'), 0)
+        webhook_dict['failed'] = counts.get((webhook.id, u'failed'), 0)
+        results.append(webhook_dict)
+    return results
+
+
+@validate(schema.issue_webhook_delete_schema)
+def issue_webhook_delete(context, data_dict):
+    '''Delete a webhook, and any of its events waiting to be sent
+
+    :param id: the id of the webhook
+    :type id: int
+    '''
+    session = context['session']
+    webhook = issuemodel.IssueWebhook.get(data_dict['id'], session=session)
+    if not webhook:
+        raise p.toolkit.ObjectNotFound(p.toolkit._('Webhook not found'))
+    data_dict['organization_id'] = webhook.organization_id
+    p.toolkit.check_access('issue_webhook_delete', context, data_dict)
+    session.query(issuemodel.IssueWebhookDelivery)\
+        .filter(issuemodel.IssueWebhookDelivery.webhook_id == webhook.id)\
+        .delete(synchronize_session=False)
+    session.delete(webhook)
+    session.commit()
+
+
+@validate(schema.issue_notification_frequency_update_schema)
+def issue_notification_frequency_update(context, data_dict):
+    '''Set how often you are emailed about issues: 'immediate' (an email
+    for each new issue and comment), or an 'hourly' or 'daily' digest
+
+    Organization admins can instead set the default for the members of
+    their organization, which members' own settings override.
+
+    :param frequency: 'immediate', 'hourly' or 'daily'
+    :type frequency: string
+    :param organization_id: the organization to set the default of
+        (optional)
+    :type organization_id: string
+    '''
+    p.toolkit.check_access('issue_notification_frequency_update', context,
+                           data_dict)
+    session = context['session']
+    Frequency = issuemodel.IssueNotificationFrequency
+    organization_id = data_dict.get('organization_id')
+    if organization_id:
+        setting = Frequency.get_for_organization(session, organization_id)
+        if setting is None:
+            setting = Frequency(organization_id=organization_id)
+    else:
+        user_id = model.User.get(context['user']).id
+        setting = Frequency.get_for_user(session, user_id)
+        if setting is None:
+            setting = Frequency(user_id=user_id)
+    setting.frequency = data_dict['frequency']
+    session.add(setting)
+    session.commit()
+    return {'frequency': setting.frequency}
+
+
+@p.toolkit.side_effect_free
+@validate(schema.issue_notification_frequency_show_schema)
+def issue_notification_frequency_show(context, data_dict):
+    '''How often you are emailed about issues (of datasets in an
+    organization)
+
+    :param organization_id: the organization (optional). Without it, the
+        site default is used where you haven't set a frequency
+    :type organization_id: string
+
+    :returns: 'frequency'
+    :rtype: dictionary
+    '''
+    p.toolkit.check_access('issue_notification_frequency_show', context,
+                           data_dict)
+    user_id = model.User.get(context['user']).id
+    frequencies = issuemodel.IssueNotificationFrequency.frequencies(
+        context['session'], [user_id], data_dict.get('organization_id'),
+        default_frequency())
+    return {'frequency': frequencies[user_id]}
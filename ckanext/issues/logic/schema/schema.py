@@ -2,9 +2,20 @@ from ckan.plugins import toolkit
 from ckanext.issues.logic.validators import (
     as_package_id,
     as_org_id,
+    as_category_id,
+    as_category_ids,
+    as_user_id,
+    as_facet_fields,
+    as_issue_search_fields,
+    as_issue_show_fields,
+    as_webhook_events,
+    is_valid_webhook_url,
+    is_valid_notification_frequency,
+    is_valid_dashboard_list,
     is_valid_sort,
     is_valid_status,
     is_valid_abuse_status,
+    is_valid_moderation_item_type,
     issue_exists,
     issue_comment_exists,
     issue_number_exists_for_dataset,
@@ -25,7 +36,9 @@ def issue_show_schema():
     return {
         'dataset_id': [not_missing, unicode, package_exists, as_package_id],
         'include_reports': [ignore_missing, bool],
+        'include_archived': [ignore_missing, bool],
         'issue_number': [not_missing, is_positive_integer],
+        'fields': [ignore_missing, as_issue_show_fields],
         '__after': [issue_number_exists_for_dataset],
     }
 
@@ -35,12 +48,14 @@ def issue_create_schema():
         'title': [not_missing, unicode],
         'description': [ignore_missing, unicode],
         'dataset_id': [not_missing, unicode, package_exists, as_package_id],
+        'categories': [ignore_missing, as_category_ids],
     }
 
 
 def issue_update_schema():
     return {
         'assignee_id': [ignore_missing, unicode, user_exists],
+        'categories': [ignore_missing, as_category_ids],
         'dataset_id': [not_missing, unicode, package_exists, as_package_id],
         'description': [ignore_missing, unicode],
         'issue_number': [not_missing, is_positive_integer],
@@ -74,7 +89,84 @@ def issue_search_schema():
         'include_reports': [ignore_missing, bool],
         'include_results': [ignore_missing, bool],
         'include_sub_organizations': [ignore_missing, bool],
+        'include_archived': [ignore_missing, bool],
         'abuse_status': [ignore_missing, unicode, is_valid_abuse_status],
+        'category': [ignore_missing, unicode, as_category_id],
+        'assignee_id': [ignore_missing, unicode, as_user_id],
+        'user_id': [ignore_missing, unicode, as_user_id],
+        'facets': [ignore_missing, as_facet_fields],
+        'fields': [ignore_missing, as_issue_search_fields],
+    }
+
+
+def issue_similar_schema():
+    return {
+        'dataset_id': [not_missing, unicode, package_exists, as_package_id],
+        'title': [ignore_missing, unicode],
+        'description': [ignore_missing, unicode],
+        'limit': [ignore_missing, is_positive_integer],
+    }
+
+
+def issue_user_dashboard_schema():
+    return {
+        'user': [ignore_missing, unicode, as_user_id],
+        'list': [ignore_missing, unicode, is_valid_dashboard_list],
+        'status': [ignore_missing, unicode, is_valid_status],
+        'q': [ignore_missing, unicode],
+        'sort': [ignore_missing, unicode],
+        'limit': [ignore_missing, is_natural_number],
+        'offset': [ignore_missing, is_natural_number],
+    }
+
+
+def issue_moderation_queue_schema():
+    return {
+        'organization_id': [ignore_missing, unicode, as_org_id],
+        'include_sub_organizations': [ignore_missing, bool],
+        'type': [ignore_missing, unicode, is_valid_moderation_item_type],
+        'limit': [ignore_missing, is_natural_number],
+        'offset': [ignore_missing, is_natural_number],
+    }
+
+
+def issue_changes_schema():
+    return {
+        'since': [ignore_missing, is_natural_number],
+        'limit': [ignore_missing, is_positive_integer],
+    }
+
+
+def issue_webhook_create_schema():
+    return {
+        'url': [not_missing, unicode, is_valid_webhook_url],
+        'organization_id': [ignore_missing, unicode, as_org_id],
+        'events': [ignore_missing, as_webhook_events],
+    }
+
+
+def issue_webhook_list_schema():
+    return {
+        'organization_id': [ignore_missing, unicode, as_org_id],
+    }
+
+
+def issue_webhook_delete_schema():
+    return {
+        'id': [not_missing, is_positive_integer],
+    }
+
+
+def issue_notification_frequency_update_schema():
+    return {
+        'frequency': [not_missing, unicode, is_valid_notification_frequency],
+        'organization_id': [ignore_missing, unicode, as_org_id],
+    }
+
+
+def issue_notification_frequency_show_schema():
+    return {
+        'organization_id': [ignore_missing, unicode, as_org_id],
     }
 
 
@@ -125,9 +217,16 @@ def issue_dataset_controller_schema():
         'q': [ignore_missing, unicode],
         'visibility': [ignore_missing, unicode],
         'abuse_status': [ignore_missing, unicode],
+        'category': [ignore_missing, unicode],
     }
 
 
+def issue_dashboard_controller_schema():
+    schema = issue_dataset_controller_schema()
+    schema['list'] = [ignore_missing, unicode, is_valid_dashboard_list]
+    return schema
+
+
 def issue_show_controller_schema():
     return {
         'dataset_id': [not_missing, unicode, package_exists, as_package_id],
@@ -1,5 +1,10 @@
 from ckan.plugins import toolkit
+try:
+    import ckan.authz as authz
+except ImportError:
+    import ckan.new_authz as authz
 from ckanext.issues import model as issuemodel
+from ckanext.issues.lib import archive, categories, search, webhooks
 
 
 is_positive_integer = toolkit.get_validator('is_positive_integer')
@@ -36,6 +41,15 @@ def is_valid_abuse_status(filter_string, context):
         )
 
 
+def is_valid_moderation_item_type(value, context):
+    if value in issuemodel.MODERATION_ITEM_TYPES:
+        return value
+    else:
+        raise toolkit.Invalid(toolkit._(
+            '{0} is not a valid moderation item type'.format(value))
+        )
+
+
 def as_package_id(package_id_or_name, context):
     '''given a package_id_or_name, return just the package id'''
     model = context['model']
@@ -58,6 +72,131 @@ def as_org_id(org_id_or_name, context):
         return org.id
 
 
+def as_category_id(category_name_or_id, context):
+    '''given a category name or id, return just the category id'''
+    category = categories.get(category_name_or_id)
+    if category is None:
+        try:
+            category = categories.get(int(category_name_or_id))
+        except ValueError:
+            pass
+    if category is None:
+        raise toolkit.Invalid(toolkit._(
+            '{0} is not a valid category'.format(category_name_or_id))
+        )
+    return category['id']
+
+
+def as_category_ids(value, context):
+    '''given a list (or comma separated string) of category names or ids,
+    return a list of category ids'''
+    if isinstance(value, basestring):
+        value = [name.strip() for name in value.split(',') if name.strip()]
+    return [as_category_id(name_or_id, context) for name_or_id in value]
+
+
+def as_user_id(user_id_or_name, context):
+    '''given a user_id_or_name, return just the user id'''
+    model = context['model']
+    user = model.User.get(user_id_or_name)
+    if not user:
+        raise toolkit.Invalid('%s: %s' % (toolkit._('Not found'),
+                                          toolkit._('User')))
+    else:
+        return user.id
+
+
+def as_facet_fields(value, context):
+    '''takes true (for all the facets), or a list (or comma separated
+    string) of facet names, and returns the list of fields to facet on'''
+    if value in (True, 'true', 'True', '1'):
+        return list(search.FACET_FIELDS)
+    if value in (False, None, '', 'false', 'False', '0'):
+        return []
+    if isinstance(value, basestring):
+        value = value.split(',')
+    fields = []
+    for name in value:
+        name = name.strip()
+        field = 'category_id' if name == 'category' else name
+        if field not in search.FACET_FIELDS:
+            raise toolkit.Invalid(toolkit._(
+                '{0} is not a valid facet'.format(name))
+            )
+        fields.append(field)
+    return fields
+
+
+def _as_fields(value, valid_fields):
+    if isinstance(value, basestring):
+        value = value.split(',')
+    fields = []
+    for name in value:
+        name = name.strip()
+        if name not in valid_fields:
+            raise toolkit.Invalid(toolkit._(
+                '{0} is not a valid field'.format(name))
+            )
+        fields.append(name)
+    return fields
+
+
+def as_issue_search_fields(value, context):
+    '''takes a list (or comma separated string) of the keys wanted in the
+    issue_search results, and returns the list'''
+    return _as_fields(value, issuemodel.ISSUE_SEARCH_FIELDS)
+
+
+def as_issue_show_fields(value, context):
+    '''takes a list (or comma separated string) of the keys wanted in the
+    issue_show result, and returns the list'''
+    return _as_fields(value, issuemodel.ISSUE_SHOW_FIELDS)
+
+
+def is_valid_dashboard_list(value, context):
+    if value in issuemodel.DASHBOARD_LISTS:
+        return value
+    else:
+        raise toolkit.Invalid(toolkit._(
+            '{0} is not a valid list of issues'.format(value))
+        )
+
+
+def as_webhook_events(value, context):
+    '''takes a list (or space or comma separated string) of webhook events
+    and returns the list'''
+    if isinstance(value, basestring):
+        value = value.replace(',', ' ').split()
+    for event in value:
+        if event not in issuemodel.WEBHOOK_EVENTS:
+            raise toolkit.Invalid(toolkit._(
+                '{0} is not a valid webhook event'.format(event))
+            )
+    if not value:
+        raise toolkit.Invalid(toolkit._('Missing value'))
+    return list(value)
+
+
+def is_valid_notification_frequency(value, context):
+    if value in issuemodel.NOTIFICATION_FREQUENCIES:
+        return value
+    else:
+        raise toolkit.Invalid(toolkit._(
+            '{0} is not a valid notification frequency'.format(value))
+        )
+
+
+def is_valid_webhook_url(value, context):
+    '''Only sysadmins can post webhooks to hosts that are not on
+    ckanext.issues.webhooks.allowed_hosts'''
+    try:
+        webhooks.check_url(
+            value, check_host=not authz.is_sysadmin(context.get('user')))
+    except ValueError, e:
+        raise toolkit.Invalid(unicode(e))
+    return value
+
+
 def issue_exists(issue_id, context):
     issue_id = is_positive_integer(issue_id, context)
     result = issuemodel.Issue.get(issue_id, session=context['session'])
@@ -74,7 +213,9 @@ def issue_number_exists_for_dataset(key, data, errors, context):
         issue_number = data.get(('issue_number',))
         issue = issuemodel.Issue.get_by_number(dataset_id, issue_number,
                                                session)
-        if not issue:
+        if not issue and not (data.get(('include_archived',)) and
+                              archive.archived_issue_exists(
+                                  session, dataset_id, issue_number)):
             raise toolkit.ObjectNotFound(toolkit._('Issue not found'))
 
 
@@ -10,13 +10,17 @@ from ckan.lib.dictization import model_dictize
 
 from ckanext.issues.model.report import define_report_tables
 
-from datetime import datetime
+from datetime import date, datetime
 import logging
+import time
 
 import enum
-from sqlalchemy import func, types, Table, ForeignKey, Column, Index
+from sqlalchemy import (func, types, Table, ForeignKey, Column, Index, inspect,
+                        event)
 from sqlalchemy.orm import relation, backref, subqueryload, foreign, remote
-from sqlalchemy.sql.expression import or_
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.sql.expression import (or_, and_, case, select, literal,
+                                       text, union_all)
 
 log = logging.getLogger(__name__)
 
@@ -33,10 +37,20 @@ def setup():
         issue_category_table.create(checkfirst=True)
         issue_table.create(checkfirst=True)
         issue_comment_table.create(checkfirst=True)
+        issue_category_association_table.create(checkfirst=True)
+        issue_change_table.create(checkfirst=True)
+        issue_webhook_table.create(checkfirst=True)
+        issue_webhook_delivery_table.create(checkfirst=True)
+        issue_notification_frequency_table.create(checkfirst=True)
+        issue_notification_table.create(checkfirst=True)
+        issue_spam_check_table.create(checkfirst=True)
+        issue_rate_limit_table.create(checkfirst=True)
 
         if report_tables:
             for table in report_tables:
                 table.create(checkfirst=True)
+        for table in archive_tables.values():
+            table.create(checkfirst=True)
         log.debug('Issue tables created')
 
         # add default categories if they don't already exist
@@ -75,6 +89,177 @@ def upgrade():
               'core ckan tables now removed'
         model.Session.commit()
 
+    # Migration 2
+    for table in (issue_table, issue_comment_table):
+        if not _column_exists(table.name, 'report_count'):
+            model.Session.execute(
+                'ALTER TABLE {0} ADD COLUMN report_count INTEGER '
+                'NOT NULL DEFAULT 0;'.format(table.name))
+            model.Session.execute(
+                'UPDATE {0} SET report_count = ('
+                'SELECT count(*) FROM {0}_report '
+                'WHERE {0}_report.parent_id = {0}.id);'.format(table.name))
+            print 'Migration 2 done: {0}.report_count added and ' \
+                  'populated'.format(table.name)
+    model.Session.commit()
+
+    # Migration 3
+    for index in moderation_queue_indexes:
+        if not _index_exists(index.table.name, index.name):
+            index.create(model.Session.get_bind())
+            print 'Migration 3 done: {0} created'.format(index.name)
+
+    # Migration 4
+    if not issue_category_association_table.exists():
+        issue_category_association_table.create()
+        print 'Migration 4 done: issue_category_association created'
+
+    # Migration 5
+    for index in issue_table.indexes:
+        if index.name in USER_ISSUE_INDEXES and \
+                not _index_exists(issue_table.name, index.name):
+            index.create(model.Session.get_bind())
+            print 'Migration 5 done: {0} created'.format(index.name)
+
+    # Migration 6
+    if not _column_exists(issue_table.name, 'updated'):
+        model.Session.execute('ALTER TABLE issue ADD COLUMN updated '
+                              'TIMESTAMP WITHOUT TIME ZONE;')
+        # the best record of when an issue last changed is its latest comment
+        # or when it was closed
+        model.Session.execute(
+            'UPDATE issue SET updated = coalesce(('
+            'SELECT max(issue_comment.created) FROM issue_comment '
+            'WHERE issue_comment.issue_id = issue.id), issue.created);')
+        model.Session.execute('UPDATE issue SET updated = resolved '
+                              'WHERE resolved > updated;')
+        if model.Session.get_bind().dialect.name == 'postgresql':
+            model.Session.execute('ALTER TABLE issue ALTER COLUMN updated '
+                                  'SET NOT NULL;')
+        model.Session.commit()
+        print 'Migration 6 done: issue.updated added and populated'
+    for index in issue_table.indexes:
+        if index.name == 'idx_issue_updated' and \
+                not _index_exists(issue_table.name, index.name):
+            index.create(model.Session.get_bind())
+            print 'Migration 6 done: {0} created'.format(index.name)
+
+    # Migration 7
+    if not issue_change_table.exists():
+        issue_change_table.create()
+        print 'Migration 7 done: issue_change created'
+
+    # Migration 8
+    for table in (issue_webhook_table, issue_webhook_delivery_table):
+        if not table.exists():
+            table.create()
+            print 'Migration 8 done: {0} created'.format(table.name)
+
+    # Migration 9
+    for table in (issue_notification_frequency_table,
+                  issue_notification_table):
+        if not table.exists():
+            table.create()
+            print 'Migration 9 done: {0} created'.format(table.name)
+
+    # Migration 10
+    if model.Session.get_bind().dialect.name == 'postgresql':
+        for table, column, parent in CASCADING_FOREIGN_KEYS:
+            constraints = model.Session.execute(
+                "SELECT conname, confdeltype FROM pg_constraint "
+                "WHERE conrelid = '{0}'::regclass "
+                "AND confrelid = '{1}'::regclass "
+                "AND contype = 'f';".format(table, parent)).fetchall()
+            if constraints and all(deltype == 'c'
+                                   for name, deltype in constraints):
+                continue
+            for name, deltype in constraints:
+                model.Session.execute('ALTER TABLE {0} DROP CONSTRAINT {1};'
+                                      .format(table, name))
+            # rows left behind while there was no constraint
+            model.Session.execute(
+                'DELETE FROM {0} WHERE {1} NOT IN (SELECT id FROM {2});'
+                .format(table, column, parent))
+            model.Session.execute(
+                'ALTER TABLE {0} ADD CONSTRAINT {0}_{1}_fkey '
+                'FOREIGN KEY ({1}) REFERENCES {2} (id) '
+                'ON UPDATE CASCADE ON DELETE CASCADE;'
+                .format(table, column, parent))
+            model.Session.commit()
+            print 'Migration 10 done: {0}.{1} deletions cascade from ' \
+                  '{2}'.format(table, column, parent)
+
+    # Migration 11
+    for table in archive_tables.values():
+        if not table.exists():
+            table.create()
+            print 'Migration 11 done: {0} created'.format(table.name)
+
+    # Migration 12
+    if not issue_spam_check_table.exists():
+        issue_spam_check_table.create()
+        print 'Migration 12 done: issue_spam_check created'
+
+    # Migration 13
+    if not issue_rate_limit_table.exists():
+        issue_rate_limit_table.create()
+        print 'Migration 13 done: issue_rate_limit created'
+
+    # Migration 14
+    for table in (issue_table, archive_tables['issue']):
+        if not _column_exists(table.name, 'similarity_signature'):
+            model.Session.execute('ALTER TABLE {0} ADD COLUMN '
+                                  'similarity_signature TEXT;'
+                                  .format(table.name))
+            model.Session.commit()
+            print 'Migration 14 done: {0}.similarity_signature added ' \
+                  '(run "paster issues similar-index rebuild" to set it)' \
+                  .format(table.name)
+
+    # Migration 15
+    for table in (issue_comment_table, archive_tables['issue_comment']):
+        if not _column_exists(table.name, 'moderated'):
+            model.Session.execute('ALTER TABLE {0} ADD COLUMN '
+                                  'moderated TIMESTAMP;'.format(table.name))
+            # the comments already confirmed as spam get the full retention
+            # period from now
+            model.Session.execute(
+                table.update()
+                .where(table.c.abuse_status == AbuseStatus.abuse.value)
+                .values(moderated=datetime.now()))
+            model.Session.commit()
+            print 'Migration 15 done: {0}.moderated added'.format(table.name)
+
+
+def _column_exists(table_name, column_name):
+    columns = inspect(model.Session.get_bind()).get_columns(table_name)
+    return column_name in [column['name'] for column in columns]
+
+
+def _index_exists(table_name, index_name):
+    indexes = inspect(model.Session.get_bind()).get_indexes(table_name)
+    return index_name in [index['name'] for index in indexes]
+
+
+def _adjust_report_count(session, table, parent_id, delta):
+    '''Atomically adds delta to the report_count of a row and returns the new
+    value.
+
+    The UPDATE takes a row lock, so concurrent reports on the same issue or
+    comment are serialised and each caller sees a count that includes its own
+    report, rather than a stale len(abuse_reports).
+    '''
+    report_count = table.c.report_count
+    stmt = table.update()\
+        .where(table.c.id == parent_id)\
+        .values(report_count=case([(report_count + delta < 0, 0)],
+                                  else_=report_count + delta))
+    if session.get_bind().dialect.name == 'postgresql':
+        return session.execute(stmt.returning(report_count)).scalar()
+    session.execute(stmt)
+    return session.execute(
+        select([report_count]).where(table.c.id == parent_id)).scalar()
+
 
 ISSUE_CATEGORY_NAME_MAX_LENGTH = 100
 DEFAULT_CATEGORIES = {u"broken-resource-link": "Broken data link",
@@ -116,8 +301,103 @@ class IssueCategory(object):
         return query.filter(cls.name.ilike(qstr))
 
 
+class IssueWebhook(domain_object.DomainObject):
+    """An endpoint that issue events are posted to"""
+
+    def __init__(self, url, secret, events, user_id, organization_id=None):
+        self.url = url
+        self.secret = secret
+        self.events = u' '.join(events)
+        self.user_id = user_id
+        self.organization_id = organization_id
+
+    @classmethod
+    def get(cls, reference, session=Session):
+        return session.query(cls).filter(cls.id == reference).first()
+
+    @classmethod
+    def for_event(cls, session, event, organization_id):
+        '''Returns the webhooks subscribed to event in the organization'''
+        query = session.query(cls).filter(or_(
+            cls.organization_id == None,
+            cls.organization_id == organization_id))
+        return [webhook for webhook in query
+                if event in webhook.events.split()]
+
+    def as_dict(self):
+        out = super(IssueWebhook, self).as_dict()
+        out['events'] = self.events.split()
+        del out['secret']
+        return out
+
+
+class IssueWebhookDelivery(domain_object.DomainObject):
+    """An issue event waiting to be posted to a webhook"""
+
+    def __init__(self, webhook_id, event, payload):
+        self.webhook_id = webhook_id
+        self.event = event
+        self.payload = payload
+
+
+class IssueNotificationFrequency(domain_object.DomainObject):
+    """How often a user, or by default the members of an organization, are
+    emailed about issues"""
+
+    @classmethod
+    def get_for_user(cls, session, user_id):
+        return session.query(cls).filter(cls.user_id == user_id).first()
+
+    @classmethod
+    def get_for_organization(cls, session, organization_id):
+        return session.query(cls)\
+            .filter(cls.organization_id == organization_id)\
+            .filter(cls.user_id == None).first()
+
+    @classmethod
+    def frequencies(cls, session, user_ids, organization_id, default):
+        '''Returns {user id: frequency} for user_ids, from their own
+        settings, else the organization's, else default'''
+        organization_frequency = default
+        user_frequencies = {}
+        if user_ids:
+            query = session.query(cls.user_id, cls.organization_id,
+                                  cls.frequency).filter(or_(
+                                      cls.user_id.in_(user_ids),
+                                      and_(cls.user_id == None,
+                                           cls.organization_id ==
+                                           organization_id)))
+            for user_id, organization_id_, frequency in query:
+                if user_id:
+                    user_frequencies[user_id] = frequency
+                else:
+                    organization_frequency = frequency
+        return dict((user_id, user_frequencies.get(user_id,
+                                                   organization_frequency))
+                    for user_id in user_ids)
+
+
+class IssueNotification(domain_object.DomainObject):
+    """An issue event waiting to be emailed to a user in a digest"""
+
+    def __init__(self, user_id, frequency, event, issue_id, actor_id,
+                 comment_id=None):
+        self.user_id = user_id
+        self.frequency = frequency
+        self.event = event
+        self.issue_id = issue_id
+        self.actor_id = actor_id
+        self.comment_id = comment_id
+
+
 # make a nice user dict object
-def _user_dict(user):
+def _user_dict(user, user_dicts=None):
+    '''user_dicts is an optional cache of the dicts already made, by user id,
+    so that a user with many comments on an issue is only dictized once'''
+    if user_dicts is not None:
+        if user.id not in user_dicts:
+            user_dicts[user.id] = _user_dict(user)
+        return dict(user_dicts[user.id])
     out = model_dictize.user_dictize(user, context={'model': model})
     out['ckan_url'] = h.url_for('user_datasets', id=user.name)
     out['gravatar'] = h.gravatar(user.email_hash, size=48)
@@ -146,10 +426,9 @@ class IssueFilter(enum.Enum):
                 lambda q: q.order_by(func.count(IssueComment.id).asc()),
             cls.most_commented:
                 lambda q: q.order_by(func.count(IssueComment.id).desc()),
-            cls.recently_updated:
-                lambda q: q.order_by(func.max(IssueComment.created).asc()),
+            cls.recently_updated: lambda q: q.order_by(Issue.updated.desc()),
             cls.least_recently_updated:
-                lambda q: q.order_by(func.max(IssueComment.created).desc()),
+                lambda q: q.order_by(Issue.updated.asc()),
         }
         try:
             return sort_functions[issue_filter]
@@ -206,6 +485,9 @@ class Issue(domain_object.DomainObject):
                                         q=None,
                                         visibility=None,
                                         abuse_status=None,
+                                        category_id=None,
+                                        assignee_id=None,
+                                        user_id=None,
                                         include_sub_organizations=False):
         if dataset_id:
             query = query.filter(cls.dataset_id == dataset_id)
@@ -233,6 +515,15 @@ class Issue(domain_object.DomainObject):
             query = query.filter(cls.visibility == visibility)
         if abuse_status:
             query = query.filter(cls.abuse_status == abuse_status.value)
+        if assignee_id:
+            query = query.filter(cls.assignee_id == assignee_id)
+        if user_id:
+            query = query.filter(cls.user_id == user_id)
+        if category_id:
+            categorized = issue_category_association_table
+            query = query.filter(cls.id.in_(
+                select([categorized.c.issue_id])
+                .where(categorized.c.category_id == category_id)))
 
         return query
 
@@ -244,20 +535,23 @@ class Issue(domain_object.DomainObject):
                    limit=None,
                    status=None,
                    abuse_status=None,
+                   category_id=None,
+                   assignee_id=None,
+                   user_id=None,
                    sort=None,
                    q=None,
                    visibility=None,
                    include_sub_organizations=False,
                    include_datasets=False,
                    include_reports=False,
+                   issue_ids=None,
                    session=Session):
         comment_count = func.count(IssueComment.id).label('comment_count')
-        last_updated = func.max(IssueComment.created).label('updated')
         query = session.query(
             cls,
             model.User.name,
             comment_count,
-            last_updated,
+            cls.updated,
         )
         query = cls.apply_filters_to_an_issue_query(
             query,
@@ -265,9 +559,14 @@ class Issue(domain_object.DomainObject):
             dataset_id=dataset_id,
             status=status,
             abuse_status=abuse_status,
+            category_id=category_id,
+            assignee_id=assignee_id,
+            user_id=user_id,
             q=q,
             visibility=visibility,
             include_sub_organizations=include_sub_organizations)
+        if issue_ids is not None:
+            query = query.filter(cls.id.in_(issue_ids))
         if sort:
             try:
                 query = IssueFilter.get_filter(sort)(query)
@@ -283,56 +582,125 @@ class Issue(domain_object.DomainObject):
         if limit:
             query = query.limit(limit)
 
+        query = query.options(subqueryload('categories'))
         if include_reports:
             query = query.options(subqueryload('abuse_reports'))
 
         return query
 
+    @classmethod
+    def get_issue_rows(cls, fields, offset=None, limit=None, sort=None,
+                       issue_ids=None, session=Session, **filters):
+        '''Like get_issues, but selects just what the fields (of
+        ISSUE_SEARCH_FIELDS) of the issue_search results need, as named
+        tuples of columns, which always include the id
+
+        The user and comment count are only joined if asked for (or sorted
+        by), and no relationships are loaded (see issue_rows_as_dicts).
+        '''
+        column_names = set(field for field in fields
+                           if field in ISSUE_COLUMN_FIELDS)
+        if 'dataset' in fields:
+            column_names.add('dataset_id')
+        columns = [issue_table.c.id] + [
+            issue_table.c[name] for name in ISSUE_COLUMN_FIELDS
+            if name in column_names and name != 'id']
+        group_by = [issue_table.c.id]
+        if 'user' in fields:
+            columns.append(model.User.name.label('user'))
+            group_by.append(model.User.name)
+        if 'comment_count' in fields:
+            columns.append(
+                func.count(IssueComment.id).label('comment_count'))
+        query = session.query(*columns).select_from(cls)
+        query = cls.apply_filters_to_an_issue_query(query, **filters)
+        if issue_ids is not None:
+            query = query.filter(cls.id.in_(issue_ids))
+        if sort:
+            try:
+                query = IssueFilter.get_filter(sort)(query)
+            except InvalidIssueFilterException:
+                pass
+
+        if 'user' in fields:
+            query = query.join(User, Issue.user_id == User.id)
+        if 'comment_count' in fields or sort in (
+                IssueFilter.most_commented, IssueFilter.least_commented):
+            query = query.outerjoin(IssueComment,
+                                    Issue.id == IssueComment.issue_id)\
+                .group_by(*group_by)
+
+        if offset:
+            query = query.offset(offset)
+        if limit:
+            query = query.limit(limit)
+        return query
+
     @classmethod
     def get_count_for_dataset(cls, dataset_id=None, organization_id=None,
                               status=None, sort=None, q=None,
                               visibility=None, session=Session,
+                              category_id=None,
                               include_sub_organizations=False):
         query = session.query(func.count(cls.id))
         query = cls.apply_filters_to_an_issue_query(
             query,
             organization_id=organization_id, dataset_id=dataset_id,
-            status=status, q=q,
+            status=status, q=q, category_id=category_id,
             visibility=visibility,
             include_sub_organizations=include_sub_organizations)
         return query.one()[0]
 
     def report_abuse(self, session, user_id, **kwargs):
-        self.abuse_reports.append(self.Report(user_id, self.id))
-        session.add(self)
-        session.flush()
-        return self
+        '''Records a report by user_id and returns the new report_count'''
+        return _add_report(session, self, issue_table, user_id)
 
     def change_visibility(self, session, visibility):
+        if visibility != self.visibility:
+            self.touch()
         self.visibility = visibility
         session.add(self)
         session.flush()
         return self
 
     def clear_abuse_report(self, session, user_id):
-        report = self.Report.get_reports_for_user(
-            session,
-            user_id=user_id,
-            parent_id=self.id,
-        ).first()
-        if report:
-            session.delete(report)
-            session.flush()
-        return self
+        '''Removes the report by user_id and returns the new report_count'''
+        return _clear_report(session, self, issue_table, user_id)
 
     def clear_all_abuse_reports(self, session):
         self.change_visibility(session, u'visible')
-        for r in self.abuse_reports:
-            session.delete(r)
-        session.flush()
+        _clear_all_reports(session, self, issue_table)
         return self
 
-    def as_dict(self):
+    def touch(self):
+        '''Records that the issue, or its comments, changed just now'''
+        self.updated = datetime.now()
+
+    def set_categories(self, session, category_ids):
+        '''Replaces the categories of the issue'''
+        if category_ids:
+            self.categories = session.query(IssueCategory)\
+                .filter(IssueCategory.id.in_(category_ids)).all()
+        else:
+            self.categories = []
+
+    def as_dict(self, fields=None):
+        '''The issue_show dict of the issue, without comments. fields are the
+        keys wanted (of ISSUE_SHOW_FIELDS, by default all of them), so that
+        the others are not loaded or dictized.'''
+        if fields is not None:
+            out = dict((field, _plain_value(field, getattr(self, field)))
+                       for field in fields if field in ISSUE_COLUMN_FIELDS)
+            if 'categories' in fields:
+                out['categories'] = [category.name
+                                     for category in self.categories]
+            if 'user' in fields:
+                out['user'] = _user_dict(self.user)
+            if 'ckan_url' in fields and self.dataset:
+                out['ckan_url'] = h.url_for('issues_show',
+                                            dataset_id=self.dataset.name,
+                                            issue_number=self.number)
+            return out
         out = super(Issue, self).as_dict()
 
         # TODO: move this stuff to a schema
@@ -341,6 +709,8 @@ class Issue(domain_object.DomainObject):
         except ValueError:
             pass
 
+        del out['similarity_signature']
+        out['categories'] = [category.name for category in self.categories]
         out['user'] = _user_dict(self.user)
         # some cases dataset not yet set ...
         if self.dataset:
@@ -365,9 +735,11 @@ class Issue(domain_object.DomainObject):
             out['abuse_status'] = AbuseStatus(out['abuse_status']).name
         except ValueError:
             pass
+        del out['similarity_signature']
         out.update({
             'user': user,
             'comment_count': comment_count,
+            'categories': [category.name for category in self.categories],
         })
 
         if isinstance(updated, datetime):
@@ -378,10 +750,133 @@ class Issue(domain_object.DomainObject):
             context = {'model': model, 'session': model.Session}
             out['dataset'] = model_dictize.package_dictize(pkg, context)
         if include_reports:
-            out['abuse_reports'] = [i.user_id for i in self.abuse_reports]
+            # report_count saves loading the relation for unreported issues
+            out['abuse_reports'] = [i.user_id for i in self.abuse_reports] \
+                if self.report_count else []
         return out
 
 
+def _date_str(value):
+    # as DomainObject.as_dict
+    return str(value) if isinstance(value, date) else value
+
+
+def _isoformat(value):
+    # as Issue.as_plain_dict gives updated
+    return value.isoformat() if isinstance(value, datetime) \
+        else _date_str(value)
+
+
+ABUSE_STATUS_NAMES = dict((status.value, status.name)
+                          for status in AbuseStatus)
+
+
+def _abuse_status_name(value):
+    return ABUSE_STATUS_NAMES.get(value, value)
+
+
+# the functions making the values of the issue columns that are not used as
+# they are, as in Issue.as_dict and, for issue listings, Issue.as_plain_dict
+ISSUE_COLUMN_CONVERTERS = {
+    'resolved': _date_str,
+    'created': _date_str,
+    'updated': _date_str,
+    'abuse_status': _abuse_status_name,
+}
+ISSUE_LISTING_CONVERTERS = dict(ISSUE_COLUMN_CONVERTERS, updated=_isoformat)
+
+
+def _plain_value(field, value):
+    '''Returns the value of an issue column as in the issue dicts'''
+    converter = ISSUE_COLUMN_CONVERTERS.get(field)
+    return converter(value) if converter else value
+
+
+def _row_converter(keys, fields, converters=ISSUE_LISTING_CONVERTERS):
+    '''Returns a function making the dict of fields of a row with keys,
+    worked out once for all the rows rather than for each value: the values
+    that are used as they are are zipped with their keys, and only the others
+    are converted.'''
+    plain_keys, plain_indexes, converted = [], [], []
+    for index, key in enumerate(keys):
+        if key not in fields:
+            continue
+        converter = converters.get(key)
+        if converter:
+            converted.append((index, key, converter))
+        else:
+            plain_keys.append(key)
+            plain_indexes.append(index)
+
+    def convert(row):
+        out = dict(zip(plain_keys, [row[index] for index in plain_indexes]))
+        for index, key, converter in converted:
+            out[key] = converter(row[index])
+        return out
+    return convert
+
+
+def category_names(session, issue_ids, association_table=None):
+    '''Returns {issue id: [the names of its categories]}'''
+    if association_table is None:
+        association_table = issue_category_association_table
+    names = dict((issue_id, []) for issue_id in issue_ids)
+    if issue_ids:
+        for issue_id, name in session.execute(
+                select([association_table.c.issue_id,
+                        issue_category_table.c.name])
+                .where(association_table.c.category_id ==
+                       issue_category_table.c.id)
+                .where(association_table.c.issue_id.in_(issue_ids))
+                .order_by(issue_category_table.c.name)):
+            names[issue_id].append(name)
+    return names
+
+
+def report_user_ids(session, reports_table, parent_ids):
+    '''Returns {parent id: [the user ids of its reports]}'''
+    reports = dict((parent_id, []) for parent_id in parent_ids)
+    if parent_ids:
+        for parent_id, user_id in session.execute(
+                select([reports_table.c.parent_id, reports_table.c.user_id])
+                .where(reports_table.c.parent_id.in_(parent_ids))):
+            reports[parent_id].append(user_id)
+    return reports
+
+
+def issue_rows_as_dicts(session, rows, fields, include_datasets=False,
+                        include_reports=False):
+    '''Returns the issue_search result dicts, of just fields, of rows from
+    Issue.get_issue_rows, the same as Issue.as_plain_dict gives for those
+    fields. The categories, reports and datasets asked for are loaded with a
+    query each for all the rows.'''
+    if not rows:
+        return []
+    issue_ids = [row.id for row in rows]
+    if 'categories' in fields:
+        categories = category_names(session, issue_ids)
+    if include_reports and 'abuse_reports' in fields:
+        reports = report_user_ids(session, report_tables[0], issue_ids)
+    if include_datasets and 'dataset' in fields:
+        context = {'model': model, 'session': session}
+        datasets = dict(
+            (dataset.id, model_dictize.package_dictize(dataset, context))
+            for dataset in session.query(model.Package).filter(
+                model.Package.id.in_(set(row.dataset_id for row in rows))))
+    convert = _row_converter(rows[0].keys(), set(fields))
+    results = []
+    for row in rows:
+        out = convert(row)
+        if 'categories' in fields:
+            out['categories'] = categories[row.id]
+        if include_reports and 'abuse_reports' in fields:
+            out['abuse_reports'] = reports[row.id]
+        if include_datasets and 'dataset' in fields:
+            out['dataset'] = datasets.get(row.dataset_id)
+        results.append(out)
+    return results
+
+
 class IssueComment(domain_object.DomainObject):
     """A Issue Comment Object"""
     @classmethod
@@ -425,9 +920,9 @@ class IssueComment(domain_object.DomainObject):
 
         return query
 
-    def as_dict(self):
+    def as_dict(self, user_dicts=None):
         out = super(IssueComment, self).as_dict()
-        out['user'] = _user_dict(self.user)
+        out['user'] = _user_dict(self.user, user_dicts)
         try:
             out['abuse_status'] = AbuseStatus(out['abuse_status']).name
         except ValueError:
@@ -435,10 +930,8 @@ class IssueComment(domain_object.DomainObject):
         return out
 
     def report_abuse(self, session, user_id, **kwargs):
-        self.abuse_reports.append(IssueComment.Report(user_id, self.id))
-        session.add(self)
-        session.flush()
-        return self
+        '''Records a report by user_id and returns the new report_count'''
+        return _add_report(session, self, issue_comment_table, user_id)
 
     def change_visibility(self, session, visibility):
         self.visibility = visibility
@@ -447,21 +940,51 @@ class IssueComment(domain_object.DomainObject):
         return self
 
     def clear_abuse_report(self, session, user_id):
-        report = IssueComment.Report.get_reports_for_user(session, user_id,
-                                                          self.id).first()
-        if report:
-            session.delete(report)
-            session.flush()
-        return self
+        '''Removes the report by user_id and returns the new report_count'''
+        return _clear_report(session, self, issue_comment_table, user_id)
 
     def clear_all_abuse_reports(self, session):
         self.change_visibility(session, u'visible')
-        for r in self.abuse_reports:
-            session.delete(r)
-        session.flush()
+        _clear_all_reports(session, self, issue_comment_table)
         return self
 
 
+def _add_report(session, obj, table, user_id):
+    # raises IntegrityError if this user has already reported obj
+    session.add(obj.Report(user_id, obj.id))
+    session.flush()
+    report_count = _adjust_report_count(session, table, obj.id, 1)
+    record_changes(session, [(obj, u'updated')])
+    set_committed_value(obj, 'report_count', report_count)
+    session.expire(obj, ['abuse_reports'])
+    return report_count
+
+
+def _clear_report(session, obj, table, user_id):
+    deleted = obj.Report.get_reports_for_user(session, user_id=user_id,
+                                              parent_id=obj.id)\
+        .delete(synchronize_session=False)
+    if deleted:
+        report_count = _adjust_report_count(session, table, obj.id, -deleted)
+        record_changes(session, [(obj, u'updated')])
+    else:
+        report_count = obj.report_count
+    set_committed_value(obj, 'report_count', report_count)
+    session.expire(obj, ['abuse_reports'])
+    return report_count
+
+
+def _clear_all_reports(session, obj, table):
+    obj.Report.get_reports(session, parent_id=obj.id)\
+        .delete(synchronize_session=False)
+    session.execute(table.update()
+                    .where(table.c.id == obj.id)
+                    .values(report_count=0))
+    record_changes(session, [(obj, u'updated')])
+    set_committed_value(obj, 'report_count', 0)
+    session.expire(obj, ['abuse_reports'])
+
+
 issue_category_table = Table(
     'issue_category',
     meta.metadata,
@@ -472,6 +995,21 @@ issue_category_table = Table(
     Column('created', types.DateTime, default=datetime.now,
            nullable=False))
 
+issue_category_association_table = Table(
+    'issue_category_association',
+    meta.metadata,
+    Column('issue_id', types.Integer,
+           ForeignKey('issue.id', onupdate='CASCADE', ondelete='CASCADE'),
+           primary_key=True),
+    Column('category_id', types.Integer,
+           ForeignKey('issue_category.id', onupdate='CASCADE',
+                      ondelete='CASCADE'),
+           primary_key=True),
+    # the primary key serves lookups by issue, this one lookups by category
+    Index('idx_issue_category_association_category_id',
+          'category_id', 'issue_id'),
+)
+
 issue_table = Table(
     'issue',
     meta.metadata,
@@ -488,12 +1026,27 @@ issue_table = Table(
     Column('resolved', types.DateTime),
     Column('created', types.DateTime, default=datetime.now,
            nullable=False),
+    # when the issue was last edited, commented on, assigned or moderated
+    Column('updated', types.DateTime, default=datetime.now,
+           nullable=False),
     Column('visibility', types.Unicode, default=u'visible'),
     Column('abuse_status',
            types.Integer,
            default=AbuseStatus.unmoderated.value),
+    Column('report_count', types.Integer, default=0, server_default='0',
+           nullable=False),
+    # MinHash of the title and description, for finding similar issues (see
+    # ckanext.issues.lib.similar)
+    Column('similarity_signature', types.UnicodeText),
     Index('idx_issue_number_dataset_id', 'dataset_id', 'number',
           unique=True),
+    # for the user dashboard: "assigned to me" by status, newest first, and
+    # "opened by me", newest first
+    Index('idx_issue_assignee_id_status_created', 'assignee_id', 'status',
+          'created'),
+    Index('idx_issue_user_id_created', 'user_id', 'created'),
+    # for the recently_updated and least_recently_updated sorts
+    Index('idx_issue_updated', 'updated'),
 )
 
 issue_comment_table = Table(
@@ -511,39 +1064,191 @@ issue_comment_table = Table(
     Column('abuse_status',
            types.Integer,
            default=AbuseStatus.unmoderated.value),
+    Column('report_count', types.Integer, default=0, server_default='0',
+           nullable=False),
+    # when a moderator last decided whether the comment is abuse, from
+    # which confirmed spam is kept (see ckanext.issues.lib.retention)
+    Column('moderated', types.DateTime),
+)
+
+
+
+# The change log: a row for every change to an issue or comment (including
+# its reports), numbered in order, for issue_changes. There is deliberately
+# no foreign key, so that deletions are recorded too.
+issue_change_table = Table(
+    'issue_change',
+    meta.metadata,
+    Column('id', types.Integer, primary_key=True, autoincrement=True),
+    Column('object_type', types.Unicode(10), nullable=False),
+    Column('object_id', types.Integer, nullable=False),
+    Column('issue_id', types.Integer, nullable=False),
+    Column('change', types.Unicode(10), nullable=False),
+    Column('created', types.DateTime, default=datetime.now,
+           nullable=False),
+    # for compaction, which keeps the latest change of each object
+    Index('idx_issue_change_object', 'object_type', 'object_id', 'id'),
+)
+
+
+issue_webhook_table = Table(
+    'issue_webhook',
+    meta.metadata,
+    Column('id', types.Integer, primary_key=True, autoincrement=True),
+    # None for the webhooks of all organizations, which sysadmins add
+    Column('organization_id', types.UnicodeText),
+    Column('url', types.UnicodeText, nullable=False),
+    Column('secret', types.UnicodeText, nullable=False),
+    # space separated WEBHOOK_EVENTS
+    Column('events', types.UnicodeText, nullable=False),
+    Column('user_id', types.UnicodeText, nullable=False),
+    Column('created', types.DateTime, default=datetime.now,
+           nullable=False),
+    # consecutive failed deliveries, and when to try again after them
+    Column('failures', types.Integer, default=0, server_default='0',
+           nullable=False),
+    Column('retry_at', types.DateTime),
+    Index('idx_issue_webhook_organization_id', 'organization_id'),
+)
+
+issue_webhook_delivery_table = Table(
+    'issue_webhook_delivery',
+    meta.metadata,
+    Column('id', types.Integer, primary_key=True, autoincrement=True),
+    Column('webhook_id', types.Integer,
+           ForeignKey('issue_webhook.id', ondelete='CASCADE'),
+           nullable=False),
+    Column('event', types.Unicode(30), nullable=False),
+    # the JSON of the event data
+    Column('payload', types.UnicodeText, nullable=False),
+    Column('created', types.DateTime, default=datetime.now,
+           nullable=False),
+    # 'pending' until delivered (when the row is deleted), or 'failed' after
+    # ckanext.issues.webhooks.max_attempts
+    Column('state', types.Unicode(10), default=u'pending', nullable=False),
+    Column('attempts', types.Integer, default=0, nullable=False),
+    Column('last_error', types.UnicodeText),
+    Index('idx_issue_webhook_delivery_webhook_id', 'webhook_id', 'state',
+          'id'),
+)
+
+
+# a row with just a user_id is that user's setting, and one with just an
+# organization_id is the default for the organization's members
+issue_notification_frequency_table = Table(
+    'issue_notification_frequency',
+    meta.metadata,
+    Column('id', types.Integer, primary_key=True, autoincrement=True),
+    Column('user_id', types.UnicodeText, index=True),
+    Column('organization_id', types.UnicodeText, index=True),
+    Column('frequency', types.Unicode(10), nullable=False),
+)
+
+issue_notification_table = Table(
+    'issue_notification',
+    meta.metadata,
+    Column('id', types.Integer, primary_key=True, autoincrement=True),
+    # the recipient
+    Column('user_id', types.UnicodeText, nullable=False),
+    Column('frequency', types.Unicode(10), nullable=False),
+    Column('event', types.Unicode(30), nullable=False),
+    Column('issue_id', types.Integer, nullable=False),
+    Column('comment_id', types.Integer),
+    # the user who opened the issue or commented
+    Column('actor_id', types.UnicodeText, nullable=False),
+    Column('created', types.DateTime, default=datetime.now,
+           nullable=False),
+    # for send-digests, which takes the notifications of a frequency by user
+    Index('idx_issue_notification_frequency_user_id', 'frequency',
+          'user_id', 'id'),
+)
+
+
+# new issues and comments waiting to be scored by the spam worker (see
+# ckanext.issues.lib.spam)
+issue_spam_check_table = Table(
+    'issue_spam_check',
+    meta.metadata,
+    Column('id', types.Integer, primary_key=True, autoincrement=True),
+    Column('object_type', types.Unicode(10), nullable=False),
+    Column('object_id', types.Integer, nullable=False),
+    Column('created', types.DateTime, default=datetime.now,
+           nullable=False),
 )
 
+
+# the token buckets of the database rate limit backend (see
+# ckanext.issues.lib.rate_limit), keyed by action and user or IP address
+issue_rate_limit_table = Table(
+    'issue_rate_limit',
+    meta.metadata,
+    Column('key', types.Unicode(200), primary_key=True),
+    Column('tokens', types.Float, nullable=False),
+    # seconds since the epoch
+    Column('updated', types.Float, nullable=False),
+)
+
+
+def _moderation_queue_index(table):
+    '''Partial index over just the hidden, unmoderated rows of table
+
+    The moderation queue is a tiny fraction of all issues/comments, so on
+    PostgreSQL this stays small and is scanned in queue order. On other
+    databases (e.g. SQLite, for the tests) the index is created without the
+    WHERE clause, over all the rows. sqlite_where would need SQLAlchemy 1.2,
+    and older versions reject it.
+    '''
+    return Index(
+        'idx_{0}_moderation_queue'.format(table.name),
+        table.c.report_count.desc(),
+        table.c.created,
+        postgresql_where=and_(
+            table.c.visibility == u'hidden',
+            table.c.abuse_status == AbuseStatus.unmoderated.value),
+    )
+
+
+moderation_queue_indexes = [_moderation_queue_index(issue_table),
+                            _moderation_queue_index(issue_comment_table)]
+
+# Deleting a dataset, resource or user deletes its issues (and a user's
+# comments), and deleting an issue deletes its comments, reports and
+# categorizations. None of these are loaded to be deleted: delete_issues
+# and delete_comments delete the dependent rows with set-based statements
+# (the foreign keys also cascade them, where the database enforces that),
+# and _delete_dependents deletes the issues of the core objects, which have
+# no foreign keys to cascade them.
 meta.mapper(
     Issue,
     issue_table,
     properties={
         'user': relation(
             model.User,
-            backref=backref('issues',
-                            cascade='all, delete-orphan',
-                            single_parent=True),
+            backref=backref('issues', passive_deletes='all'),
             primaryjoin=foreign(issue_table.c.user_id) == remote(User.id),
             uselist=False
         ),
         'assignee': relation(
             model.User,
-            backref=backref('resolved_issues',
-                            cascade='all'),
+            backref=backref('resolved_issues', passive_deletes='all'),
             primaryjoin=foreign(issue_table.c.assignee_id) == remote(User.id)
         ),
         'dataset': relation(
             model.Package,
-            backref=backref('issues',
-                            cascade='all, delete-orphan',
-                            single_parent=True),
+            backref=backref('issues', passive_deletes='all'),
             primaryjoin=foreign(issue_table.c.dataset_id) == remote(Package.id),
             uselist=False
         ),
         'resource': relation(
             model.Resource,
-            backref=backref('issues', cascade='all'),
+            backref=backref('issues', passive_deletes='all'),
             primaryjoin=foreign(issue_table.c.resource_id) == remote(Resource.id)
         ),
+        'categories': relation(
+            IssueCategory,
+            secondary=issue_category_association_table,
+            order_by=issue_category_table.c.name,
+        ),
     }
 )
 
@@ -555,17 +1260,487 @@ meta.mapper(
     properties={
         'user': relation(
             model.User,
-            backref=backref('issue_comments',
-                            cascade='all, delete-orphan',
-                            single_parent=True),
+            backref=backref('issue_comments', passive_deletes='all'),
             primaryjoin=foreign(issue_comment_table.c.user_id) == remote(User.id)
         ),
         'issue': relation(
             Issue,
-            backref=backref('comments', cascade='all, delete-orphan'),
+            backref=backref('comments', cascade='all, delete-orphan',
+                            passive_deletes=True),
             primaryjoin=issue_comment_table.c.issue_id.__eq__(Issue.id)
         ),
     }
 )
 
+meta.mapper(IssueWebhook, issue_webhook_table)
+
+meta.mapper(IssueWebhookDelivery, issue_webhook_delivery_table)
+
+meta.mapper(IssueNotificationFrequency, issue_notification_frequency_table)
+
+meta.mapper(IssueNotification, issue_notification_table)
+
 report_tables = define_report_tables([Issue, IssueComment])
+
+
+def _archive_table(table, *indexes):
+    '''A table for the archived rows of table: the same columns, without the
+    foreign keys and defaults'''
+    return Table(
+        '{0}_archive'.format(table.name),
+        meta.metadata,
+        *([Column(column.name, column.type, primary_key=column.primary_key,
+                  autoincrement=False, nullable=column.nullable)
+           for column in table.columns] + list(indexes)))
+
+# Closed issues are moved here, with their comments, reports and categories,
+# by `paster issues archive` (see ckanext.issues.lib.archive). Each row keeps
+# its id. The keys are the names of the tables archived to each.
+archive_tables = {
+    'issue': _archive_table(
+        issue_table,
+        Index('idx_issue_archive_number_dataset_id', 'dataset_id', 'number',
+              unique=True)),
+    'issue_comment': _archive_table(
+        issue_comment_table,
+        Index('idx_issue_comment_archive_issue_id', 'issue_id')),
+    'issue_category_association': _archive_table(
+        issue_category_association_table,
+        Index('idx_issue_category_association_archive_category_id',
+              'category_id', 'issue_id')),
+}
+for _report_table in report_tables:
+    archive_tables[_report_table.name] = _archive_table(
+        _report_table,
+        Index('idx_{0}_archive_parent_id'.format(_report_table.name),
+              'parent_id'))
+
+
+MODERATION_ITEM_TYPES = ('issue', 'comment')
+# archived is logged when an issue or comment is moved to the archive tables
+CHANGE_TYPES = ('created', 'updated', 'deleted', 'archived')
+# the PostgreSQL advisory lock held, shared, by the transactions logging
+# changes (see committed_change_id)
+CHANGE_LOG_LOCK = 5793212601
+CHANGE_LOG_LOCK_WAIT = 2
+WEBHOOK_EVENTS = ('issue.created', 'issue.closed', 'comment.created',
+                  'issue.hidden')
+NOTIFICATION_FREQUENCIES = ('immediate', 'hourly', 'daily')
+# (table, column, parent table) of the foreign keys that cascade deletions
+CASCADING_FOREIGN_KEYS = (
+    ('issue_comment', 'issue_id', 'issue'),
+    ('issue_category_association', 'issue_id', 'issue'),
+    ('issue_report', 'parent_id', 'issue'),
+    ('issue_comment_report', 'parent_id', 'issue_comment'),
+)
+DELETE_BATCH_SIZE = 1000
+# session.info keys of the issues to update in the search index once the
+# session commits
+DELETED_ISSUE_IDS = 'ckanext.issues.deleted_issue_ids'
+CHANGED_ISSUE_IDS = 'ckanext.issues.changed_issue_ids'
+# the keys of the issue dicts that can be asked for with the `fields` of
+# issue_search and issue_show
+ISSUE_COLUMN_FIELDS = ('id', 'number', 'title', 'description', 'dataset_id',
+                       'resource_id', 'user_id', 'assignee_id', 'status',
+                       'resolved', 'created', 'updated', 'visibility',
+                       'abuse_status', 'report_count')
+ISSUE_SEARCH_FIELDS = ISSUE_COLUMN_FIELDS + (
+    'user', 'comment_count', 'categories', 'dataset', 'abuse_reports')
+ISSUE_SHOW_FIELDS = ISSUE_COLUMN_FIELDS + (
+    'user', 'categories', 'ckan_url', 'comments')
+# the indexes that serve the user dashboard's lists of issues
+USER_ISSUE_INDEXES = ('idx_issue_assignee_id_status_created',
+                      'idx_issue_user_id_created')
+DASHBOARD_LISTS = ('assigned', 'opened')
+
+
+def _lock_change_log(session):
+    '''Takes CHANGE_LOG_LOCK shared, until the transaction ends, before
+    changes are logged in it'''
+    if session.get_bind().dialect.name == 'postgresql':
+        session.execute(text('SELECT pg_advisory_xact_lock_shared(:key)'),
+                        {'key': CHANGE_LOG_LOCK})
+
+
+def record_changes(session, changes):
+    '''Adds (obj, change) pairs to the change log, in the current
+    transaction. obj is an Issue or IssueComment, change one of
+    CHANGE_TYPES.'''
+    rows = []
+    for obj, change in changes:
+        if isinstance(obj, Issue):
+            object_type, issue_id = u'issue', obj.id
+        else:
+            object_type, issue_id = u'comment', obj.issue_id
+        rows.append({
+            'object_type': object_type,
+            'object_id': obj.id,
+            'issue_id': issue_id,
+            'change': change,
+        })
+    if rows:
+        _lock_change_log(session)
+        session.execute(issue_change_table.insert(), rows)
+
+
+def _record_flushed_changes(session, flush_context):
+    '''Logs the issues and comments inserted, updated and deleted by a
+    flush. (Reports are changed with bulk statements, so are logged by
+    _add_report and friends.)'''
+    changes = []
+    for objects, change in ((session.new, u'created'),
+                            (session.dirty, u'updated'),
+                            (session.deleted, u'deleted')):
+        for obj in objects:
+            if not isinstance(obj, (Issue, IssueComment)):
+                continue
+            if change == u'updated' and not session.is_modified(obj):
+                continue
+            changes.append((obj, change))
+    record_changes(session, changes)
+
+event.listen(Session, 'after_flush', _record_flushed_changes)
+
+
+def _batches(ids):
+    ids = list(ids)
+    for start in range(0, len(ids), DELETE_BATCH_SIZE):
+        yield ids[start:start + DELETE_BATCH_SIZE]
+
+
+def _record_deletions(session, table, object_type, issue_id_column,
+                      where, change=u'deleted'):
+    '''Logs the deletion (or other change) of the rows of table matching
+    where, in a single INSERT ... SELECT'''
+    _lock_change_log(session)
+    session.execute(issue_change_table.insert().from_select(
+        ['object_type', 'object_id', 'issue_id', 'change', 'created'],
+        select([literal(object_type, types.Unicode), table.c.id,
+                issue_id_column, literal(change, types.Unicode),
+                literal(datetime.now(), types.DateTime)]).where(where)))
+
+
+def delete_issues(session, issue_ids):
+    '''Deletes the issues, and with them their comments, reports and
+    categorizations, without loading any of them, DELETE_BATCH_SIZE issues
+    at a time. The deletions are added to the change log. The caller
+    commits, and then removes the issues from the search index
+    (search.delete_issues).'''
+    for batch in _batches(issue_ids):
+        _record_deletions(session, issue_comment_table, u'comment',
+                          issue_comment_table.c.issue_id,
+                          issue_comment_table.c.issue_id.in_(batch))
+        _record_deletions(session, issue_table, u'issue', issue_table.c.id,
+                          issue_table.c.id.in_(batch))
+        session.execute(issue_notification_table.delete().where(
+            issue_notification_table.c.issue_id.in_(batch)))
+        _delete_comment_rows(session, select([issue_comment_table.c.id]).where(
+            issue_comment_table.c.issue_id.in_(batch)))
+        _delete_issue_rows(session, issue_table.c.id.in_(batch))
+
+
+def delete_comments(session, comment_ids):
+    '''Deletes the comments, and with them their reports, without loading
+    any of them, DELETE_BATCH_SIZE comments at a time. The deletions are
+    added to the change log. Returns the ids of their issues, to be
+    re-indexed once committed.'''
+    issue_ids = set()
+    for batch in _batches(comment_ids):
+        issue_ids.update(
+            row[0] for row in session.execute(
+                select([issue_comment_table.c.issue_id]).distinct()
+                .where(issue_comment_table.c.id.in_(batch))))
+        _record_deletions(session, issue_comment_table, u'comment',
+                          issue_comment_table.c.issue_id,
+                          issue_comment_table.c.id.in_(batch))
+        session.execute(issue_notification_table.delete().where(
+            issue_notification_table.c.comment_id.in_(batch)))
+        _delete_comment_rows(session, batch)
+    return issue_ids
+
+
+def _delete_comment_rows(session, comment_ids):
+    '''Deletes the comments with the ids (a list or a select) and their
+    reports. The dependent rows are deleted explicitly rather than left to
+    the foreign keys' ON DELETE CASCADE, which SQLite only enforces with
+    PRAGMA foreign_keys.'''
+    comment_reports = report_tables[1]
+    session.execute(comment_reports.delete().where(
+        comment_reports.c.parent_id.in_(comment_ids)))
+    session.execute(issue_comment_table.delete().where(
+        issue_comment_table.c.id.in_(comment_ids)))
+
+
+def _delete_issue_rows(session, where):
+    '''Deletes the issues matching where, with their reports and
+    categorizations. Their comments must have been deleted first
+    (_delete_comment_rows).'''
+    issue_ids = select([issue_table.c.id]).where(where)
+    issue_reports = report_tables[0]
+    session.execute(issue_reports.delete().where(
+        issue_reports.c.parent_id.in_(issue_ids)))
+    session.execute(issue_category_association_table.delete().where(
+        issue_category_association_table.c.issue_id.in_(issue_ids)))
+    session.execute(issue_table.delete().where(where))
+
+
+def _delete_archived(session, issue_where, comment_where=None):
+    '''Deletes the archived issues matching issue_where, and archived
+    comments matching comment_where, with their comments, reports and
+    categorizations (the archive tables have no foreign keys to cascade
+    them). The deletions are added to the change log.'''
+    issues = archive_tables['issue']
+    comments = archive_tables['issue_comment']
+    issue_ids = select([issues.c.id]).where(issue_where)
+    comment_clauses = [comments.c.issue_id.in_(issue_ids)]
+    if comment_where is not None:
+        comment_clauses.append(comment_where)
+    comment_ids = select([comments.c.id]).where(or_(*comment_clauses))
+    _record_deletions(session, comments, u'comment', comments.c.issue_id,
+                      or_(*comment_clauses))
+    _record_deletions(session, issues, u'issue', issues.c.id, issue_where)
+    for table_name, where in (
+            ('issue_comment_report',
+             lambda table: table.c.parent_id.in_(comment_ids)),
+            ('issue_report',
+             lambda table: table.c.parent_id.in_(issue_ids)),
+            ('issue_category_association',
+             lambda table: table.c.issue_id.in_(issue_ids))):
+        table = archive_tables[table_name]
+        session.execute(table.delete().where(where(table)))
+    session.execute(comments.delete().where(or_(*comment_clauses)))
+    session.execute(issues.delete().where(issue_where))
+
+
+def _issues_of(table, dataset_ids, resource_ids, user_ids):
+    '''Returns the condition for the issues in table of the datasets,
+    resources and users, or None'''
+    clauses = []
+    if dataset_ids:
+        clauses.append(table.c.dataset_id.in_(dataset_ids))
+    if resource_ids:
+        clauses.append(table.c.resource_id.in_(resource_ids))
+    if user_ids:
+        clauses.append(table.c.user_id.in_(user_ids))
+        clauses.append(table.c.assignee_id.in_(user_ids))
+    return or_(*clauses) if clauses else None
+
+
+def _delete_dependents(session, flush_context, instances):
+    '''Deletes the issues (including archived ones) of the datasets,
+    resources and users being deleted, and the users' comments, with
+    set-based statements. The issues are noted in session.info, for the
+    search index to be updated once committed.'''
+    dataset_ids = []
+    resource_ids = []
+    user_ids = []
+    orm_deleted_issue_ids = []
+    orm_deleted_comment_ids = []
+    for obj in session.deleted:
+        if isinstance(obj, Package):
+            dataset_ids.append(obj.id)
+        elif isinstance(obj, Resource):
+            resource_ids.append(obj.id)
+        elif isinstance(obj, User):
+            user_ids.append(obj.id)
+        elif isinstance(obj, Issue):
+            orm_deleted_issue_ids.append(obj.id)
+        elif isinstance(obj, IssueComment):
+            orm_deleted_comment_ids.append(obj.id)
+
+    deleted_issue_ids = set()
+    changed_issue_ids = set()
+    where = _issues_of(issue_table, dataset_ids, resource_ids, user_ids)
+    if where is not None:
+        issue_ids = [row[0] for row in session.execute(
+            select([issue_table.c.id]).where(where))]
+        delete_issues(session, issue_ids)
+        deleted_issue_ids.update(issue_ids)
+        _delete_archived(
+            session,
+            _issues_of(archive_tables['issue'], dataset_ids, resource_ids,
+                       user_ids),
+            archive_tables['issue_comment'].c.user_id.in_(user_ids)
+            if user_ids else None)
+    if user_ids:
+        comment_ids = [row[0] for row in session.execute(
+            select([issue_comment_table.c.id])
+            .where(issue_comment_table.c.user_id.in_(user_ids)))]
+        changed_issue_ids.update(delete_comments(session, comment_ids))
+    for batch in _batches(orm_deleted_issue_ids):
+        # an issue deleted with session.delete: the flush deletes it and
+        # any comments loaded with it, and the database the rest, which are
+        # logged here
+        where = issue_comment_table.c.issue_id.in_(batch)
+        if orm_deleted_comment_ids:
+            where = and_(where, ~issue_comment_table.c.id.in_(
+                orm_deleted_comment_ids))
+        _record_deletions(session, issue_comment_table, u'comment',
+                          issue_comment_table.c.issue_id, where)
+        session.execute(issue_notification_table.delete().where(
+            issue_notification_table.c.issue_id.in_(batch)))
+        deleted_issue_ids.update(batch)
+
+    if deleted_issue_ids:
+        session.info.setdefault(DELETED_ISSUE_IDS, set())\
+            .update(deleted_issue_ids)
+    if changed_issue_ids - deleted_issue_ids:
+        session.info.setdefault(CHANGED_ISSUE_IDS, set())\
+            .update(changed_issue_ids - deleted_issue_ids)
+
+event.listen(Session, 'before_flush', _delete_dependents)
+
+
+def committed_change_id(session, wait=CHANGE_LOG_LOCK_WAIT):
+    '''Returns the change id up to which every change has been committed (or
+    rolled back), so that a reader that has read up to it never misses one
+    committed later, or None if that isn't known within wait seconds
+
+    Ids are given out when the changes are logged, not when they are
+    committed, so on PostgreSQL a long transaction can commit a change with
+    a lower id than one already read. The transactions logging changes hold
+    CHANGE_LOG_LOCK shared until they end, so the lock is taken exclusively,
+    on a connection of its own and only while reading the highest id: then
+    no change below that is still to be committed. It is only tried for, so
+    that the writers never queue behind a reader. SQLite has one writer at
+    a time, so its changes are committed in id order anyway.
+    '''
+    bind = session.get_bind()
+    last_id = select([func.max(issue_change_table.c.id)])
+    if bind.dialect.name != 'postgresql':
+        return session.execute(last_id).scalar() or 0
+    deadline = time.time() + wait
+    connection = bind.connect()
+    try:
+        while not connection.execute(
+                text('SELECT pg_try_advisory_lock(:key)'),
+                key=CHANGE_LOG_LOCK).scalar():
+            if time.time() > deadline:
+                log.warning('Changes are still being logged after %ss',
+                            wait)
+                return None
+            time.sleep(0.05)
+        try:
+            return connection.execute(last_id).scalar() or 0
+        finally:
+            connection.execute(text('SELECT pg_advisory_unlock(:key)'),
+                               key=CHANGE_LOG_LOCK)
+    finally:
+        connection.close()
+
+
+def changes_since(session, since=0, limit=None, before=None):
+    '''Returns the change log rows after since, oldest first, up to
+    committed_change_id
+
+    :param before: only return changes logged before this datetime
+    '''
+    until = committed_change_id(session)
+    if until is None:
+        return []
+    query = session.query(issue_change_table)\
+        .filter(issue_change_table.c.id > since)\
+        .filter(issue_change_table.c.id <= until)
+    if before is not None:
+        query = query.filter(issue_change_table.c.created < before)
+    query = query.order_by(issue_change_table.c.id)
+    if limit:
+        query = query.limit(limit)
+    return query.all()
+
+
+def compact_changes(session):
+    '''Deletes the changes superseded by a later change to the same object,
+    and returns how many were deleted. Readers still see the latest change
+    to each object, whatever their position in the log.'''
+    later = issue_change_table.alias('later')
+    result = session.execute(issue_change_table.delete().where(
+        select([later.c.id]).where(and_(
+            later.c.object_type == issue_change_table.c.object_type,
+            later.c.object_id == issue_change_table.c.object_id,
+            later.c.id > issue_change_table.c.id,
+        )).exists()))
+    return result.rowcount
+
+
+def moderation_queue(session, organization_id=None,
+                     include_sub_organizations=False, item_type=None,
+                     limit=None, offset=None):
+    '''Returns the hidden, unmoderated issues and comments awaiting moderation
+
+    Both kinds of item are returned from a single UNION query, served by the
+    partial moderation queue indexes, most reported first and then oldest
+    first.
+
+    :param item_type: 'issue' or 'comment' to only return one kind of item
+    :returns: (count, list of row dicts)
+    '''
+    selects = []
+    if item_type in (None, 'issue'):
+        selects.append(
+            select([literal('issue').label('type'),
+                    issue_table.c.id,
+                    issue_table.c.id.label('issue_id'),
+                    issue_table.c.number.label('issue_number'),
+                    issue_table.c.dataset_id,
+                    issue_table.c.title,
+                    issue_table.c.description.label('text'),
+                    issue_table.c.user_id,
+                    issue_table.c.created,
+                    issue_table.c.report_count])
+            .where(issue_table.c.visibility == u'hidden')
+            .where(issue_table.c.abuse_status ==
+                   AbuseStatus.unmoderated.value)
+        )
+    if item_type in (None, 'comment'):
+        selects.append(
+            select([literal('comment').label('type'),
+                    issue_comment_table.c.id,
+                    issue_comment_table.c.issue_id,
+                    issue_table.c.number.label('issue_number'),
+                    issue_table.c.dataset_id,
+                    issue_table.c.title,
+                    issue_comment_table.c.comment.label('text'),
+                    issue_comment_table.c.user_id,
+                    issue_comment_table.c.created,
+                    issue_comment_table.c.report_count])
+            .select_from(issue_comment_table.join(
+                issue_table,
+                issue_comment_table.c.issue_id == issue_table.c.id))
+            .where(issue_comment_table.c.visibility == u'hidden')
+            .where(issue_comment_table.c.abuse_status ==
+                   AbuseStatus.unmoderated.value)
+        )
+
+    if organization_id:
+        org = model.Group.get(organization_id)
+        assert org
+        if include_sub_organizations:
+            org_ids = [org_.id for org_
+                       in org.get_children_groups(type='organization')]
+            org_ids.append(org.id)
+        else:
+            org_ids = [org.id]
+        dataset_ids = select([model.package_table.c.id])\
+            .where(model.package_table.c.owner_org.in_(org_ids))
+        selects = [select_.where(issue_table.c.dataset_id.in_(dataset_ids))
+                   for select_ in selects]
+
+    queue = union_all(*selects).alias('moderation_queue')
+    count = session.execute(select([func.count()]).select_from(queue))\
+        .scalar()
+
+    user_table = model.user_table
+    query = select([queue, user_table.c.name.label('user_name'),
+                    user_table.c.fullname.label('user_fullname'),
+                    user_table.c.email.label('user_email')])\
+        .select_from(queue.outerjoin(user_table,
+                                     queue.c.user_id == user_table.c.id))\
+        .order_by(queue.c.report_count.desc(), queue.c.created.asc(),
+                  queue.c.id.asc())
+    if offset:
+        query = query.offset(offset)
+    if limit:
+        query = query.limit(limit)
+    return count, [dict(row) for row in session.execute(query)]
+
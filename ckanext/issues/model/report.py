@@ -61,7 +61,8 @@ def define_report_tables(models):
             properties={
                 table_name: relation(
                     model_,
-                    backref=backref('abuse_reports'),
+                    # the database deletes the reports with their parent
+                    backref=backref('abuse_reports', passive_deletes='all'),
                     primaryjoin=report_table.c.parent_id == model_.id
                 ),
             }
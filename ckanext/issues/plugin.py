@@ -19,6 +19,7 @@ class IssuesPlugin(p.SingletonPlugin):
     implements(p.IRoutes, inherit=True)
     implements(p.IActions)
     implements(p.IAuthFunctions)
+    implements(p.IMiddleware, inherit=True)
 
     # IConfigurer
 
@@ -95,6 +96,8 @@ class IssuesPlugin(p.SingletonPlugin):
                       '/dataset/:dataset_id/issues/:issue_number',
                       action='show')
             m.connect('all_issues_page', '/issues', action='all_issues_page')
+            m.connect('issues_dashboard', '/dashboard/issues',
+                      action='dashboard')
             m.connect('issues_for_organization',
                       '/organization/:org_id/issues',
                       action='issues_for_organization')
@@ -108,6 +111,10 @@ class IssuesPlugin(p.SingletonPlugin):
                       '/organization/:organization_id/issues/moderate',
                       action='moderate')
 
+        metrics = 'ckanext.issues.controller:MetricsController'
+        with SubMapper(map, controller=metrics) as m:
+            m.connect('issues_metrics', '/issues/metrics', action='metrics')
+
         moderation = 'ckanext.issues.controller:CommentModerationController'
         with SubMapper(map, controller=moderation) as m:
             m.connect('issues_moderate_reported_comments',
@@ -119,14 +126,32 @@ class IssuesPlugin(p.SingletonPlugin):
 
         return map
 
+    # IMiddleware
+
+    def make_middleware(self, app, config):
+        from ckanext.issues.lib.rate_limit import RateLimitMiddleware
+        return RateLimitMiddleware(app)
+
     # IActions
 
     def get_actions(self):
         import ckanext.issues.logic.action as action
-
-        return dict((name, function) for name, function
-                    in action.__dict__.items()
-                    if callable(function))
+        from ckanext.issues.lib import instrumentation, metrics, replica
+
+        actions = dict((name, function) for name, function
+                       in action.__dict__.items()
+                       if callable(function))
+        if replica.enabled():
+            actions = replica.route_actions(actions)
+        if metrics.enabled():
+            actions = dict(
+                (name, metrics.instrument_action(name, function))
+                for name, function in actions.items())
+        if instrumentation.enabled():
+            actions = dict(
+                (name, instrumentation.instrument_action(name, function))
+                for name, function in actions.items())
+        return actions
 
     # IAuthFunctions
 
@@ -136,6 +161,7 @@ class IssuesPlugin(p.SingletonPlugin):
             'issue_admin': auth.issue_admin,
             'issue_search': auth.issue_search,
             'issue_show': auth.issue_show,
+            'issue_similar': auth.issue_similar,
             'issue_create': auth.issue_create,
             'issue_comment_create': auth.issue_comment_create,
             'issue_update': auth.issue_update,
@@ -143,4 +169,14 @@ class IssuesPlugin(p.SingletonPlugin):
             'issue_report': auth.issue_report,
             'issue_report_clear': auth.issue_report_clear,
             'issue_comment_search': auth.issue_comment_search,
+            'issue_moderation_queue': auth.issue_moderation_queue,
+            'issue_user_dashboard': auth.issue_user_dashboard,
+            'issue_changes': auth.issue_changes,
+            'issue_webhook_create': auth.issue_webhook_create,
+            'issue_webhook_list': auth.issue_webhook_list,
+            'issue_webhook_delete': auth.issue_webhook_delete,
+            'issue_notification_frequency_update':
+                auth.issue_notification_frequency_update,
+            'issue_notification_frequency_show':
+                auth.issue_notification_frequency_show,
         }
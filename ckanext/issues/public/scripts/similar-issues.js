@@ -0,0 +1,77 @@
+/* Lists the open issues of the dataset that are like the one being written,
+ * as its title is typed, so that the user can add to one of those instead.
+ *
+ * dataset  - The id of the dataset.
+ * target   - A selector for the element to list the issues in.
+ * interval - The pause in typing before looking them up, in milliseconds
+ *            (default: 300).
+ *
+ * Examples
+ *
+ *   <input name="title" data-module="issues-similar"
+ *          data-module-dataset="..." data-module-target="#similar-issues" />
+ *
+ */
+this.ckan.module('issues-similar', function (jQuery, _) {
+  return {
+    options: {
+      dataset: null,
+      target: null,
+      interval: 300,
+      i18n: {
+        heading: _('Is it one of these open issues?')
+      }
+    },
+
+    initialize: function () {
+      jQuery.proxyAll(this, /_on/);
+      this.target = jQuery(this.options.target);
+      this.lookup = 0;
+      this.el.on('keyup', this._onKeyUp);
+    },
+
+    _onKeyUp: function () {
+      clearTimeout(this.timer);
+      this.timer = setTimeout(this._onPause, this.options.interval);
+    },
+
+    _onPause: function () {
+      var title = jQuery.trim(this.el.val());
+      if (title === this.title) {
+        return;
+      }
+      this.title = title;
+      var lookup = this.lookup += 1;
+      if (!title) {
+        this.target.empty().hide();
+        return;
+      }
+      var url = this.sandbox.client.url('/api/3/action/issue_similar');
+      var module = this;
+      jQuery.getJSON(url, {dataset_id: this.options.dataset, title: title},
+        function (data) {
+          // ignore the answers to earlier lookups
+          if (lookup === module.lookup) {
+            module._onResults(data.result);
+          }
+        });
+    },
+
+    _onResults: function (issues) {
+      this.target.empty();
+      if (!issues.length) {
+        this.target.hide();
+        return;
+      }
+      var list = jQuery('<ul/>');
+      jQuery.each(issues, function (i, issue) {
+        jQuery('<li/>').append(
+          jQuery('<a/>').attr('href', issue.ckan_url)
+            .text('#' + issue.number + ' ' + issue.title)
+        ).appendTo(list);
+      });
+      this.target.append(jQuery('<p/>').text(this.i18n('heading')))
+        .append(list).show();
+    }
+  };
+});
@@ -0,0 +1,130 @@
+'''Helpers for the issues benchmark suite
+
+The benchmarks are skipped unless ISSUES_BENCHMARK is set, e.g.
+
+    ISSUES_BENCHMARK=1 ISSUES_BENCHMARK_VOLUMES=small,medium \
+    nosetests --ckan --with-pylons=test.ini ckanext/issues/tests/benchmarks
+
+Results are written as JSON to ISSUES_BENCHMARK_OUTPUT (default
+issues-benchmark.json). Two result files can be compared with:
+
+    python -m ckanext.issues.tests.benchmarks.benchmark old.json new.json
+'''
+import datetime
+import json
+import os
+import subprocess
+import sys
+import time
+
+# Volumes of data seeded for each benchmark run
+VOLUMES = {
+    'small': {'datasets': 2, 'issues_per_dataset': 20,
+              'comments_per_issue': 3, 'reports_per_issue': 1},
+    'medium': {'datasets': 5, 'issues_per_dataset': 100,
+               'comments_per_issue': 10, 'reports_per_issue': 2},
+    'large': {'datasets': 10, 'issues_per_dataset': 500,
+              'comments_per_issue': 20, 'reports_per_issue': 3},
+}
+DEFAULT_REPEAT = 5
+
+
+def enabled():
+    return bool(os.environ.get('ISSUES_BENCHMARK'))
+
+
+def selected_volumes():
+    names = os.environ.get('ISSUES_BENCHMARK_VOLUMES', 'small').split(',')
+    return [(name.strip(), VOLUMES[name.strip()]) for name in names
+            if name.strip()]
+
+
+def repeat():
+    return int(os.environ.get('ISSUES_BENCHMARK_REPEAT', DEFAULT_REPEAT))
+
+
+def output_path():
+    return os.environ.get('ISSUES_BENCHMARK_OUTPUT', 'issues-benchmark.json')
+
+
+def measure(function, repeat=DEFAULT_REPEAT):
+    '''Calls function repeat times (after one warm-up call) and returns
+    timing stats in milliseconds, plus the number of SQL queries run by the
+    warm-up call'''
+    from ckanext.issues.lib import instrumentation
+    with instrumentation.record('benchmark') as stats:
+        function()
+    timings = []
+    for i in range(repeat):
+        start = time.time()
+        function()
+        timings.append((time.time() - start) * 1000)
+    timings.sort()
+    return {
+        'queries': stats.count,
+        'repeat': repeat,
+        'min_ms': round(timings[0], 3),
+        'median_ms': round(timings[len(timings) // 2], 3),
+        'mean_ms': round(sum(timings) / len(timings), 3),
+        'max_ms': round(timings[-1], 3),
+    }
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Results(object):
+    '''Collects the results of one benchmark run and saves them as JSON'''
+
+    def __init__(self, database):
+        self.data = {
+            'commit': _git_commit(),
+            'created': datetime.datetime.now().isoformat(),
+            'database': database,
+            'volumes': {},
+        }
+
+    def add(self, volume_name, volume, seed_seconds, timings):
+        self.data['volumes'][volume_name] = {
+            'volume': volume,
+            'seed_seconds': round(seed_seconds, 3),
+            'timings': timings,
+        }
+
+    def save(self, path=None):
+        path = path or output_path()
+        with open(path, 'w') as f:
+            json.dump(self.data, f, indent=2, sort_keys=True)
+        return path
+
+
+def compare(old, new):
+    '''Returns lines comparing the median timings of two result dicts'''
+    lines = ['{0} -> {1}'.format(old.get('commit'), new.get('commit'))]
+    for volume_name, volume in sorted(new['volumes'].items()):
+        old_timings = old['volumes'].get(volume_name, {}).get('timings', {})
+        for name, timing in sorted(volume['timings'].items()):
+            before = old_timings.get(name, {}).get('median_ms')
+            after = timing['median_ms']
+            if before:
+                change = '{0:+.1f}%'.format((after - before) / before * 100)
+            else:
+                change = 'new'
+            lines.append('{0:8} {1:50} {2:>10} {3:>10} {4:>8}'.format(
+                volume_name, name, before, after, change))
+    return lines
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        print __doc__
+        sys.exit(1)
+    with open(sys.argv[1]) as old, open(sys.argv[2]) as new:
+        for line in compare(json.load(old), json.load(new)):
+            print line
@@ -0,0 +1,197 @@
+'''Benchmarks of the issue hot paths
+
+See benchmark.py for how to run these and compare the results.
+'''
+import time
+
+from nose.plugins.skip import SkipTest
+from pylons import config
+
+from ckan import model
+from ckan.plugins import toolkit
+try:
+    from ckan.tests import factories, helpers
+except ImportError:
+    from ckan.new_tests import factories, helpers
+
+from ckanext.issues import model as issuemodel
+from ckanext.issues.tests import factories as issue_factories
+from ckanext.issues.tests.benchmarks import benchmark
+
+SEARCHES = [
+    ('open', {'status': 'open'}),
+    ('closed', {'status': 'closed'}),
+    ('visible', {'visibility': 'visible'}),
+    ('hidden', {'visibility': 'hidden'}),
+    ('unmoderated', {'abuse_status': 'unmoderated'}),
+    ('q', {'q': 'Issue'}),
+    ('include_reports', {'include_reports': True}),
+    ('include_datasets', {'include_datasets': True}),
+    ('count_only', {'include_results': False}),
+]
+# the sizes of the pages of issues serialized for the per-row timings
+PAGE_SIZES = (50, 500)
+
+
+def _seed(volume):
+    '''Creates an organization with the given volume of datasets, issues,
+    comments and abuse reports using the test factories'''
+    owner = factories.User()
+    organization = factories.Organization(user=owner)
+    reporters = [factories.User()
+                 for i in range(volume['reports_per_issue'])]
+    datasets = []
+    for i in range(volume['datasets']):
+        dataset = factories.Dataset(owner_org=organization['name'])
+        datasets.append(dataset)
+        for j in range(volume['issues_per_dataset']):
+            issue = issue_factories.Issue(user=owner,
+                                          user_id=owner['id'],
+                                          dataset_id=dataset['id'])
+            for k in range(volume['comments_per_issue']):
+                issue_factories.IssueComment(user=owner,
+                                             user_id=owner['id'],
+                                             dataset_id=dataset['id'],
+                                             issue_number=issue['number'])
+            # report and hide one issue in ten, for the moderation queue
+            if j % 10 == 0:
+                for reporter in reporters:
+                    helpers.call_action('issue_report',
+                                        context={'user': reporter['name'],
+                                                 'model': model},
+                                        dataset_id=dataset['id'],
+                                        issue_number=issue['number'])
+                issue_obj = issuemodel.Issue.get(issue['id'])
+                issue_obj.visibility = u'hidden'
+                model.Session.commit()
+            # close one issue in four
+            elif j % 4 == 0:
+                helpers.call_action('issue_update',
+                                    context={'user': owner['name'],
+                                             'model': model},
+                                    dataset_id=dataset['id'],
+                                    issue_number=issue['number'],
+                                    status='closed')
+    return owner, organization, datasets
+
+
+def _action(name, user, **data_dict):
+    return lambda: helpers.call_action(
+        name, context={'user': user['name'], 'model': model}, **data_dict)
+
+
+def _entity_page(limit):
+    '''Serializes a page of issues loaded as Issue objects, as issue_search
+    did before it used just their columns'''
+    model.Session.expunge_all()
+    return [issue.as_plain_dict(user, comment_count, updated)
+            for issue, user, comment_count, updated
+            in issuemodel.Issue.get_issues(limit=limit)]
+
+
+def _column_page(limit):
+    '''Serializes a page of issues as issue_search does'''
+    model.Session.expunge_all()
+    fields = issuemodel.ISSUE_SEARCH_FIELDS
+    rows = issuemodel.Issue.get_issue_rows(fields, limit=limit).all()
+    return issuemodel.issue_rows_as_dicts(model.Session, rows, fields)
+
+
+def _run_benchmarks(volume, repeat):
+    start = time.time()
+    owner, organization, datasets = _seed(volume)
+    seed_seconds = time.time() - start
+
+    dataset = datasets[0]
+    timings = {}
+
+    def measure(name, function):
+        timings[name] = benchmark.measure(function, repeat)
+
+    for sort in issuemodel.IssueFilter.__members__:
+        measure('issue_search.dataset.sort.{0}'.format(sort),
+                _action('issue_search', owner, dataset_id=dataset['id'],
+                        sort=sort, limit=50))
+        measure('issue_search.organization.sort.{0}'.format(sort),
+                _action('issue_search', owner,
+                        organization_id=organization['id'],
+                        sort=sort, limit=50))
+    for name, filters in SEARCHES:
+        measure('issue_search.organization.{0}'.format(name),
+                _action('issue_search', owner,
+                        organization_id=organization['id'], limit=50,
+                        **filters))
+    measure('issue_search.organization.include_sub_organizations',
+            _action('issue_search', owner,
+                    organization_id=organization['id'],
+                    include_sub_organizations=True, limit=50))
+    measure('issue_search.site', _action('issue_search', owner, limit=50))
+
+    measure('issue_show',
+            _action('issue_show', owner, dataset_id=dataset['id'],
+                    issue_number=1))
+    measure('issue_show.include_reports',
+            _action('issue_show', owner, dataset_id=dataset['id'],
+                    issue_number=1, include_reports=True))
+
+    measure('issue_comment_search.organization',
+            _action('issue_comment_search', owner,
+                    organization_id=organization['id']))
+    measure('issue_comment_search.only_hidden',
+            _action('issue_comment_search', owner,
+                    organization_id=organization['id'], only_hidden=True))
+    measure('issue_moderation_queue',
+            _action('issue_moderation_queue', owner,
+                    organization_id=organization['id'], limit=50))
+
+    for limit in PAGE_SIZES:
+        rows = len(_column_page(limit))
+        for name, page in [('entities', _entity_page),
+                           ('columns', _column_page)]:
+            timing = benchmark.measure(lambda: page(limit), repeat)
+            timing['rows'] = rows
+            timing['per_row_us'] = round(
+                timing['median_ms'] * 1000 / max(rows, 1), 3)
+            timings['serialize.{0}.{1}'.format(name, limit)] = timing
+
+    app = helpers._get_test_app()
+    env = {'REMOTE_USER': owner['name'].encode('ascii')}
+    for name, url in [
+            ('controller.dataset',
+             toolkit.url_for('issues_dataset', dataset_id=dataset['name'])),
+            ('controller.issues_for_organization',
+             toolkit.url_for('issues_for_organization',
+                             org_id=organization['name'])),
+            ('controller.show',
+             toolkit.url_for('issues_show', dataset_id=dataset['name'],
+                             issue_number=1)),
+            ('controller.reported_issues',
+             toolkit.url_for('issues_moderate_reported_issues',
+                             organization_id=organization['name'])),
+            ]:
+        measure(name, lambda: app.get(url, extra_environ=env))
+
+    return seed_seconds, timings
+
+
+class TestBenchmarks(object):
+    @classmethod
+    def setupClass(cls):
+        if not benchmark.enabled():
+            raise SkipTest('Set ISSUES_BENCHMARK=1 to run the benchmarks')
+        cls.results = benchmark.Results(
+            database=config.get('sqlalchemy.url', '').split(':')[0])
+
+    @classmethod
+    def teardownClass(cls):
+        path = cls.results.save()
+        print 'Benchmark results written to {0}'.format(path)
+
+    def test_volumes(self):
+        for volume_name, volume in benchmark.selected_volumes():
+            yield self._check_volume, volume_name, volume
+
+    def _check_volume(self, volume_name, volume):
+        helpers.reset_db()
+        seed_seconds, timings = _run_benchmarks(volume, benchmark.repeat())
+        self.results.add(volume_name, volume, seed_seconds, timings)
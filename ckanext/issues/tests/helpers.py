@@ -1,3 +1,5 @@
+from contextlib import contextmanager
+
 try:
     from ckan.lib.search import clear_all
 except ImportError:
@@ -20,3 +22,15 @@ class ClearOnTearDownMixin(object):
     def teardown(self):
         helpers.reset_db()
         clear_all()
+
+
+@contextmanager
+def assert_max_queries(max_queries):
+    '''Fails if the code in the with block runs more than max_queries SQL
+    statements. Yields the QueryStats, for comparing counts between runs.'''
+    from ckanext.issues.lib import instrumentation
+    with instrumentation.record('assert_max_queries') as stats:
+        yield stats
+    assert stats.count <= max_queries, \
+        '{0} queries run, expected at most {1}. Slowest: {2}'.format(
+            stats.count, max_queries, stats.as_dict()['slowest'])
@@ -0,0 +1,144 @@
+from datetime import datetime, timedelta
+
+from sqlalchemy import func
+from sqlalchemy.sql.expression import select
+
+from ckan import model
+from ckan.plugins import toolkit
+try:
+    from ckan.tests import factories, helpers
+except ImportError:
+    from ckan.new_tests import factories, helpers
+
+from ckanext.issues import model as issuemodel
+from ckanext.issues.lib import archive
+from ckanext.issues.tests import factories as issue_factories
+from ckanext.issues.tests.helpers import ClearOnTearDownMixin
+
+from nose.tools import assert_equals, assert_raises, assert_true
+
+
+class TestArchive(ClearOnTearDownMixin):
+    def setup(self):
+        self.owner = factories.User()
+        self.org = factories.Organization(user=self.owner)
+        self.dataset = factories.Dataset(owner_org=self.org['name'])
+
+    def _issue(self, closed_days_ago=None, **kwargs):
+        issue = issue_factories.Issue(user=self.owner,
+                                      user_id=self.owner['id'],
+                                      dataset_id=self.dataset['id'], **kwargs)
+        if closed_days_ago is not None:
+            self._close(issue, closed_days_ago)
+        return issue
+
+    def _close(self, issue, days_ago):
+        issue_obj = issuemodel.Issue.get(issue['id'])
+        issue_obj.status = u'closed'
+        issue_obj.updated = datetime.now() - timedelta(days=days_ago)
+        model.Session.commit()
+
+    def _count(self, table):
+        return model.Session.execute(
+            select([func.count()]).select_from(table)).scalar()
+
+    def _archive(self):
+        return archive.archive_issues(model.Session,
+                                      before=datetime.now() -
+                                      timedelta(days=30))
+
+    def test_old_closed_issues_are_archived(self):
+        old = self._issue(closed_days_ago=60)
+        issue_factories.IssueComment(user_id=self.owner['id'],
+                                     dataset_id=self.dataset['id'],
+                                     issue_number=old['number'])
+        recent = self._issue(closed_days_ago=1)
+        open_ = self._issue()
+
+        assert_equals(self._archive(), 1)
+
+        assert_equals(sorted(issue.id for issue
+                             in model.Session.query(issuemodel.Issue)),
+                      sorted([recent['id'], open_['id']]))
+        assert_equals(model.Session.query(issuemodel.IssueComment).count(),
+                      0)
+        # and only once
+        assert_equals(self._archive(), 0)
+
+    def test_comments_and_reports_are_moved(self):
+        user = factories.User()
+        issue = self._issue()
+        comment = issue_factories.IssueComment(user_id=self.owner['id'],
+                                               dataset_id=self.dataset['id'],
+                                               issue_number=issue['number'])
+        helpers.call_action('issue_report', context={'user': user['name']},
+                            dataset_id=self.dataset['id'],
+                            issue_number=issue['number'])
+        helpers.call_action('issue_comment_report',
+                            context={'user': user['name']},
+                            dataset_id=self.dataset['id'],
+                            issue_number=issue['number'],
+                            comment_id=comment['id'])
+        self._close(issue, 60)
+
+        assert_equals(self._archive(), 1)
+
+        for table in [issuemodel.issue_comment_table] + \
+                list(issuemodel.report_tables):
+            assert_equals(self._count(table), 0)
+            assert_equals(self._count(archive._archive(table.name)), 1)
+
+    def test_show_archived_issue(self):
+        issue = self._issue(closed_days_ago=60)
+        comment = issue_factories.IssueComment(user_id=self.owner['id'],
+                                               dataset_id=self.dataset['id'],
+                                               issue_number=issue['number'])
+        self._archive()
+
+        assert_raises(toolkit.ObjectNotFound, helpers.call_action,
+                      'issue_show', dataset_id=self.dataset['id'],
+                      issue_number=issue['number'])
+        archived = helpers.call_action(
+            'issue_show', dataset_id=self.dataset['id'],
+            issue_number=issue['number'], include_archived=True)
+        assert_equals(archived['id'], issue['id'])
+        assert_equals(archived['title'], issue['title'])
+        assert_true(archived['archived'])
+        assert_equals([c['id'] for c in archived['comments']],
+                      [comment['id']])
+
+    def test_search_archived_issues(self):
+        old = self._issue(closed_days_ago=60)
+        older = self._issue(closed_days_ago=90)
+        new = self._issue()
+        self._archive()
+
+        result = helpers.call_action('issue_search',
+                                     dataset_id=self.dataset['id'])
+        assert_equals([i['id'] for i in result['results']], [new['id']])
+
+        result = helpers.call_action('issue_search',
+                                     dataset_id=self.dataset['id'],
+                                     include_archived=True, sort='oldest',
+                                     offset=1, limit=2, facets=['status'])
+        assert_equals(result['count'], 3)
+        assert_equals([i['id'] for i in result['results']],
+                      [older['id'], new['id']])
+        assert_equals(result['facets']['status'], {'open': 1, 'closed': 2})
+
+    def test_archived_issue_numbers_are_not_reused(self):
+        issue = self._issue(closed_days_ago=60)
+        self._archive()
+        assert_equals(self._issue()['number'], issue['number'] + 1)
+
+    def test_archiving_is_logged(self):
+        issue = self._issue(closed_days_ago=60)
+        comment = issue_factories.IssueComment(user_id=self.owner['id'],
+                                               dataset_id=self.dataset['id'],
+                                               issue_number=issue['number'])
+        self._archive()
+        assert_equals(
+            sorted((row.object_type, row.object_id)
+                   for row in issuemodel.changes_since(model.Session)
+                   if row.change == u'archived'),
+            [('comment', comment['id']), ('issue', issue['id'])])
@@ -0,0 +1,32 @@
+import inspect
+
+import mock
+from nose.tools import assert_equals
+
+from ckanext.issues.lib import instrumentation
+
+
+class Controller(object):
+    def show(self, dataset_id, issue_number=None):
+        return dataset_id, issue_number
+
+instrumentation.instrument_controller(Controller)
+
+
+class TestInstrumentController(object):
+    def test_signature_is_kept(self):
+        # Pylons picks the routing variables to pass by the signature
+        assert_equals(inspect.getargspec(Controller.show)[0],
+                      ['self', 'dataset_id', 'issue_number'])
+
+    def test_disabled(self):
+        with mock.patch.object(instrumentation, '_log') as log:
+            assert_equals(Controller().show('a', issue_number=1), ('a', 1))
+        assert_equals(log.call_count, 0)
+
+    @mock.patch.dict('ckanext.issues.lib.instrumentation.config',
+                     {'ckanext.issues.instrumentation': 'true'})
+    def test_enabled(self):
+        with mock.patch.object(instrumentation, '_log') as log:
+            assert_equals(Controller().show('a'), ('a', None))
+        assert_equals(log.call_args[0][0].name, 'controller.Controller.show')
@@ -0,0 +1,119 @@
+import asyncore
+import email
+import smtpd
+import threading
+
+import mock
+from ckan import model
+try:
+    from ckan.tests import factories
+except ImportError:
+    from ckan.new_tests import factories
+
+from ckanext.issues.lib import mail
+from ckanext.issues.tests import factories as issue_factories
+from ckanext.issues.tests.helpers import ClearOnTearDownMixin
+
+from nose.tools import assert_equals, assert_true
+
+
+class StubSMTPServer(smtpd.SMTPServer):
+    '''Records the messages sent to it and the connections made to it'''
+
+    def __init__(self):
+        smtpd.SMTPServer.__init__(self, ('127.0.0.1', 0), None)
+        self.messages = []
+        self.connections = 0
+
+    def handle_accept(self):
+        self.connections += 1
+        smtpd.SMTPServer.handle_accept(self)
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        self.messages.append((rcpttos, email.message_from_string(data)))
+
+
+class TestSendMessages(ClearOnTearDownMixin):
+    def setup(self):
+        self.server = StubSMTPServer()
+        self.thread = threading.Thread(target=asyncore.loop,
+                                       kwargs={'timeout': 0.05})
+        self.thread.daemon = True
+        self.thread.start()
+        address = '127.0.0.1:{0}'.format(self.server.socket.getsockname()[1])
+        self.config = mock.patch.dict('ckanext.issues.lib.mail.config', {
+            'smtp.test_server': address,
+            'smtp.server': address,
+            'smtp.mail_from': 'issues@example.com',
+            'ckanext.issues.smtp_pool_size': 2,
+        })
+        self.config.start()
+
+    def teardown(self):
+        mail.get_pool().close()
+        self.config.stop()
+        asyncore.close_all()
+        self.thread.join()
+        super(TestSendMessages, self).teardown()
+
+    def _users(self, count):
+        return [model.User.get(factories.User()['id']) for i in range(count)]
+
+    def test_connections_are_reused(self):
+        users = self._users(10)
+        outcomes = mail.send_messages([(user_obj, u'Subject', u'Body')
+                                       for user_obj in users])
+        assert_equals([outcome['status'] for outcome in outcomes],
+                      ['sent'] * 10)
+        outcomes = mail.send_messages([(users[0], u'Subject', u'Body')])
+        assert_equals(outcomes[0]['status'], 'sent')
+
+        assert_equals(sorted(rcpttos[0] for rcpttos, message
+                             in self.server.messages),
+                      sorted([user_obj.email for user_obj in users] +
+                             [users[0].email]))
+        assert_true(self.server.connections <= 2)
+
+    def test_message(self):
+        user_obj, = self._users(1)
+        mail.send_messages([(user_obj, u'Issue \xfc', u'Body \xfc')])
+        rcpttos, message = self.server.messages[0]
+        assert_equals(rcpttos, [user_obj.email])
+        assert_true(user_obj.email in message['To'])
+        assert_equals(email.header.decode_header(message['Subject']),
+                      [('Issue \xc3\xbc', 'utf-8')])
+        assert_equals(message.get_payload(decode=True), 'Body \xc3\xbc')
+
+    def test_outcome_of_each_message(self):
+        user_obj, no_email = self._users(2)
+        no_email.email = None
+        outcomes = mail.send_messages([(user_obj, u'Subject', u'Body'),
+                                       (no_email, u'Subject', u'Body')])
+        assert_equals([(outcome['user_id'], outcome['status'])
+                       for outcome in outcomes],
+                      [(user_obj.id, 'sent'), (no_email.id, 'failed')])
+        assert_true(outcomes[1]['error'])
+        assert_equals(len(self.server.messages), 1)
+
+    def test_reconnects_when_the_server_has_disconnected(self):
+        user_obj, = self._users(1)
+        mail.send_messages([(user_obj, u'Subject', u'Body')])
+        # the server drops the idle connection
+        for channel in asyncore.socket_map.values():
+            if channel is not self.server:
+                channel.close()
+        outcomes = mail.send_messages([(user_obj, u'Subject', u'Body')])
+        assert_equals(outcomes[0]['status'], 'sent')
+        assert_equals(len(self.server.messages), 2)
+
+    def test_issue_notifications(self):
+        admin = factories.User()
+        org = factories.Organization(user=admin)
+        dataset = factories.Dataset(owner_org=org['name'])
+        with mock.patch.dict('ckanext.issues.logic.action.action.config',
+                             {'ckanext.issues.send_email_notifications':
+                              True}):
+            issue_factories.Issue(user_id=factories.User()['id'],
+                                  dataset_id=dataset['id'])
+        assert_equals([rcpttos for rcpttos, message in self.server.messages],
+                      [[model.User.get(admin['id']).email]])
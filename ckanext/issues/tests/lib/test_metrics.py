@@ -0,0 +1,92 @@
+import json
+import os
+import shutil
+import tempfile
+
+import mock
+from nose.tools import assert_equals, assert_in, assert_not_in
+
+from ckanext.issues.lib import metrics
+
+
+@mock.patch.dict('ckanext.issues.lib.metrics.config',
+                 {'ckanext.issues.metrics': 'true'})
+class TestMetrics(object):
+    def setup(self):
+        metrics.reset()
+
+    def teardown(self):
+        metrics.reset()
+
+    def test_counter(self):
+        metrics.inc('issues_action_requests_total', action='issue_show',
+                    status='ok')
+        metrics.inc('issues_action_requests_total', action='issue_show',
+                    status='ok')
+        assert_in('# TYPE issues_action_requests_total counter',
+                  metrics.exposition())
+        assert_in('issues_action_requests_total{action="issue_show",'
+                  'status="ok"} 2', metrics.exposition())
+
+    def test_histogram(self):
+        metrics.observe('issues_action_duration_seconds', 0.02,
+                        action='issue_search')
+        metrics.observe('issues_action_duration_seconds', 3,
+                        action='issue_search')
+        text = metrics.exposition()
+        assert_in('issues_action_duration_seconds_bucket{'
+                  'action="issue_search",le="0.01"} 0', text)
+        assert_in('issues_action_duration_seconds_bucket{'
+                  'action="issue_search",le="0.025"} 1', text)
+        assert_in('issues_action_duration_seconds_bucket{'
+                  'action="issue_search",le="+Inf"} 2', text)
+        assert_in('issues_action_duration_seconds_count{'
+                  'action="issue_search"} 2', text)
+
+    def test_instrument_action(self):
+        action = metrics.instrument_action('issue_show',
+                                           lambda context, data_dict: {})
+        action({}, {})
+        assert_in('issues_action_requests_total{action="issue_show",'
+                  'status="ok"} 1', metrics.exposition())
+
+    def test_processes_are_added_up(self):
+        metrics_dir = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(metrics_dir,
+                                   'issues-metrics-1-a.json'), 'w') as f:
+                json.dump({'counters': [['issues_notifications_total',
+                                         [['status', 'sent']], 5]],
+                           'histograms': []}, f)
+            with mock.patch.dict('ckanext.issues.lib.metrics.config',
+                                 {'ckanext.issues.metrics_dir': metrics_dir}):
+                metrics.inc('issues_notifications_total', status='sent')
+                text = metrics.exposition()
+            assert_in('issues_notifications_total{status="sent"} 6', text)
+        finally:
+            shutil.rmtree(metrics_dir)
+            metrics._process_file = None
+
+
+class TestMetricsAccess(object):
+    @mock.patch.dict('ckanext.issues.lib.metrics.config',
+                     {'ckanext.issues.metrics_token': 'secret',
+                      'ckanext.issues.metrics_allowed_ips': '10.0.0.5'})
+    def test_authorized(self):
+        environ = {'REMOTE_ADDR': '10.0.0.6'}
+        assert_equals(metrics.authorized(environ), False)
+        assert_equals(metrics.authorized(environ, is_sysadmin=True), True)
+        assert_equals(metrics.authorized(
+            dict(environ, HTTP_AUTHORIZATION='Bearer secret')), True)
+        assert_equals(metrics.authorized(
+            dict(environ, HTTP_AUTHORIZATION='Bearer wrong')), False)
+        assert_equals(metrics.authorized({'REMOTE_ADDR': '10.0.0.5'}), True)
+
+
+class TestMetricsDisabled(object):
+    @mock.patch.dict('ckanext.issues.lib.metrics.config',
+                     {'ckanext.issues.metrics': 'false'})
+    def test_nothing_recorded(self):
+        metrics.reset()
+        metrics.inc('issues_notifications_total', status='sent')
+        assert_not_in('issues_notifications_total', metrics.exposition())
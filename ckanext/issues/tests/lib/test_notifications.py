@@ -0,0 +1,109 @@
+import mock
+from ckan import model
+try:
+    from ckan.tests import factories, helpers
+except ImportError:
+    from ckan.new_tests import factories, helpers
+
+from ckanext.issues import model as issuemodel
+from ckanext.issues.lib import notifications
+from ckanext.issues.tests import factories as issue_factories
+from ckanext.issues.tests.helpers import ClearOnTearDownMixin
+
+from nose.tools import assert_equals, assert_in, assert_not_in
+
+
+class TestDigests(ClearOnTearDownMixin):
+    def setup(self):
+        self.config = mock.patch.dict(
+            'ckanext.issues.logic.action.action.config',
+            {'ckanext.issues.send_email_notifications': True})
+        self.config.start()
+        self.mailer = mock.patch(
+            'ckanext.issues.lib.notifications.mailer.mail_user')
+        self.mail_user = self.mailer.start()
+
+        self.admin = factories.User()
+        self.editor = factories.User()
+        self.org = factories.Organization(
+            user=self.admin,
+            users=[{'name': self.editor['name'], 'capacity': 'editor'}])
+        self.dataset = factories.Dataset(owner_org=self.org['name'])
+        self.reporter = factories.User()
+
+    def teardown(self):
+        self.mailer.stop()
+        self.config.stop()
+        super(TestDigests, self).teardown()
+
+    def _set_frequency(self, user, frequency, **kwargs):
+        helpers.call_action('issue_notification_frequency_update',
+                            context={'user': user['name']},
+                            frequency=frequency, **kwargs)
+
+    def _recipients(self):
+        return sorted(call[0][0].name
+                      for call in self.mail_user.call_args_list)
+
+    def test_immediate_by_default(self):
+        issue_factories.Issue(user_id=self.reporter['id'],
+                              dataset_id=self.dataset['id'])
+        assert_equals(self._recipients(),
+                      sorted([self.admin['name'], self.editor['name']]))
+        assert_equals(model.Session.query(issuemodel.IssueNotification)
+                      .count(), 0)
+
+    def test_events_are_sent_in_one_digest(self):
+        self._set_frequency(self.editor, 'daily')
+        issue = issue_factories.Issue(user_id=self.reporter['id'],
+                                      dataset_id=self.dataset['id'])
+        for i in range(3):
+            issue_factories.IssueComment(user_id=self.reporter['id'],
+                                         dataset_id=self.dataset['id'],
+                                         issue_number=issue['number'])
+        # the admin is still emailed about each event
+        assert_equals(self._recipients(), [self.admin['name']] * 4)
+        self.mail_user.reset_mock()
+
+        assert_equals(notifications.send_digests(model.Session, 'hourly'), 0)
+        assert_equals(notifications.send_digests(model.Session, 'daily'), 1)
+        assert_equals(self._recipients(), [self.editor['name']])
+        user_obj, subject, body = self.mail_user.call_args[0]
+        assert_in('4 new issue updates', subject)
+        assert_in(issue['title'], body)
+
+        # and only once
+        assert_equals(notifications.send_digests(model.Session, 'daily'), 0)
+
+    def test_hidden_issues_and_comments_are_left_out(self):
+        self._set_frequency(self.editor, 'daily')
+        issue = issue_factories.Issue(user_id=self.reporter['id'],
+                                      dataset_id=self.dataset['id'])
+        comments = [issue_factories.IssueComment(
+            user_id=self.reporter['id'], dataset_id=self.dataset['id'],
+            issue_number=issue['number'], comment=text)
+            for text in ('Spam', 'Useful')]
+        hidden = issue_factories.Issue(user_id=self.reporter['id'],
+                                       dataset_id=self.dataset['id'],
+                                       title='Hidden issue')
+        issuemodel.IssueComment.get(comments[0]['id']).visibility = u'hidden'
+        issuemodel.Issue.get(hidden['id']).visibility = u'hidden'
+        model.Session.commit()
+        self.mail_user.reset_mock()
+
+        assert_equals(notifications.send_digests(model.Session, 'daily'), 1)
+        user_obj, subject, body = self.mail_user.call_args[0]
+        assert_in('2 new issue updates', subject)
+        assert_in('Useful', body)
+        assert_not_in('Spam', body)
+        assert_not_in('Hidden issue', body)
+
+    def test_organization_default(self):
+        self._set_frequency(self.admin, 'hourly',
+                            organization_id=self.org['id'])
+        # a user's own setting wins over the organization's
+        self._set_frequency(self.editor, 'immediate')
+        issue_factories.Issue(user_id=self.reporter['id'],
+                              dataset_id=self.dataset['id'])
+        assert_equals(self._recipients(), [self.editor['name']])
+        assert_equals(notifications.send_digests(model.Session, 'hourly'), 1)
@@ -0,0 +1,92 @@
+import json
+
+try:
+    from ckan.tests import factories, helpers
+except ImportError:
+    from ckan.new_tests import factories, helpers
+
+from ckanext.issues.exception import RateLimited
+from ckanext.issues.lib import rate_limit
+from ckanext.issues.tests import factories as issue_factories
+from ckanext.issues.tests.helpers import ClearOnTearDownMixin
+
+from nose.tools import assert_equals, assert_raises, assert_true
+import mock
+
+
+class TestMemoryBackend(object):
+    def test_bucket(self):
+        backend = rate_limit.MemoryBackend()
+        limits = {'issue:user:a': (2, 60)}
+        assert_equals(backend.take(limits, 0), 0)
+        assert_equals(backend.take(limits, 0), 0)
+        assert_equals(backend.take(limits, 0), 30)
+        assert_equals(backend.take(limits, 15), 15)
+        assert_equals(backend.take(limits, 30), 0)
+        assert_equals(backend.take({'issue:user:b': (2, 60)}, 30), 0)
+
+    def test_no_token_is_taken_when_one_bucket_is_empty(self):
+        backend = rate_limit.MemoryBackend()
+        backend.take({'ip': (1, 60)}, 0)
+        assert_equals(backend.take({'user': (1, 60), 'ip': (1, 60)}, 0), 60)
+        assert_equals(backend.take({'user': (1, 60)}, 0), 0)
+
+    def test_parse_limit(self):
+        assert_equals(rate_limit.parse_limit('10/3600'), (10, 3600))
+        assert_raises(ValueError, rate_limit.parse_limit, '10')
+        assert_raises(ValueError, rate_limit.parse_limit, '0/60')
+
+
+class TestRateLimit(ClearOnTearDownMixin):
+    config = {'ckanext.issues.rate_limit.issue.user': '2/3600',
+              'ckanext.issues.rate_limit.comment.user': '1/3600'}
+
+    def setup(self):
+        self.user = factories.User()
+        self.dataset = factories.Dataset()
+        rate_limit._backends.clear()
+
+    def _create_issues(self, count):
+        for i in range(count):
+            helpers.call_action('issue_create',
+                                context={'user': self.user['name']},
+                                title='Issue', dataset_id=self.dataset['id'])
+
+    def _test_issue_limit(self):
+        with mock.patch.dict('ckanext.issues.lib.rate_limit.config',
+                             self.config):
+            self._create_issues(2)
+            with assert_raises(RateLimited) as cm:
+                self._create_issues(1)
+        assert_equals(cm.exception.retry_after, 1800)
+
+    def test_issue_limit(self):
+        self._test_issue_limit()
+
+    def test_issue_limit_in_database(self):
+        self.config = dict(self.config,
+                           **{'ckanext.issues.rate_limit.backend': 'database'})
+        self._test_issue_limit()
+
+    def test_sysadmins_are_not_limited(self):
+        self.user = factories.Sysadmin()
+        with mock.patch.dict('ckanext.issues.lib.rate_limit.config',
+                             self.config):
+            self._create_issues(3)
+
+    def test_comment_api_returns_429(self):
+        issue = issue_factories.Issue(user_id=self.user['id'],
+                                      dataset_id=self.dataset['id'])
+        app = helpers._get_test_app()
+        env = {'REMOTE_USER': self.user['name'].encode('ascii')}
+        params = json.dumps({'dataset_id': self.dataset['id'],
+                             'issue_number': issue['number'],
+                             'comment': 'Comment'})
+        with mock.patch.dict('ckanext.issues.lib.rate_limit.config',
+                             self.config):
+            app.post('/api/action/issue_comment_create', params,
+                     extra_environ=env)
+            response = app.post('/api/action/issue_comment_create', params,
+                                extra_environ=env, status=429)
+        assert_equals(response.headers['Retry-After'], '3600')
+        assert_true(not response.json['success'])
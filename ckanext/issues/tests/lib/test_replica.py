@@ -0,0 +1,74 @@
+import mock
+from ckan import model
+from ckan.plugins import toolkit
+
+from ckanext.issues.lib import replica
+
+from nose.tools import assert_equals, assert_is, assert_is_not
+
+
+def _session_used(context, data_dict=None):
+    return context['session']
+
+
+@toolkit.side_effect_free
+def _side_effect_free_action(context, data_dict=None):
+    return context['session']
+
+
+@mock.patch.dict('ckanext.issues.lib.replica.config',
+                 {'ckanext.issues.read_replica_url': 'sqlite://'})
+class TestReplicaRouting(object):
+    def setup(self):
+        replica._writes.clear()
+        self.actions = replica.route_actions({
+            'issue_search': _session_used,
+            'issue_create': lambda context, data_dict: None,
+            'issue_other_read': _side_effect_free_action,
+            'issue_changes': _side_effect_free_action,
+        })
+
+    def teardown(self):
+        replica._writes.clear()
+
+    def test_read_uses_replica(self):
+        session = self.actions['issue_search']({'user': 'bob'}, {})
+        assert_is(session, replica.get_session())
+
+    def test_read_after_write_uses_primary(self):
+        self.actions['issue_create']({'user': 'bob'}, {})
+        session = self.actions['issue_search']({'user': 'bob'}, {})
+        assert_is(session, model.Session)
+
+    def test_other_users_still_use_replica(self):
+        self.actions['issue_create']({'user': 'bob'}, {})
+        session = self.actions['issue_search']({'user': 'alice'}, {})
+        assert_is(session, replica.get_session())
+
+    @mock.patch('ckanext.issues.lib.replica.time')
+    def test_read_your_writes_window_expires(self, mock_time):
+        mock_time.time.return_value = 1000
+        self.actions['issue_create']({'user': 'bob'}, {})
+        mock_time.time.return_value = 1000 + \
+            replica.DEFAULT_READ_YOUR_WRITES_SECONDS + 1
+        session = self.actions['issue_search']({'user': 'bob'}, {})
+        assert_is(session, replica.get_session())
+
+    def test_session_given_by_caller_is_kept(self):
+        session = mock.Mock()
+        assert_is(self.actions['issue_search']({'user': 'bob',
+                                                'session': session}, {}),
+                  session)
+
+    def test_unlisted_side_effect_free_action_untouched(self):
+        assert_is(self.actions['issue_other_read'], _side_effect_free_action)
+        assert_equals(replica._writes, {})
+
+    def test_context_session_restored(self):
+        context = {'user': 'bob'}
+        session = self.actions['issue_search'](context, {})
+        assert_is_not(context['session'], session)
+
+    def test_changes_feed_uses_primary(self):
+        session = self.actions['issue_changes']({'user': 'bob'}, {})
+        assert_is(session, model.Session)
@@ -0,0 +1,88 @@
+from datetime import datetime, timedelta
+
+from ckan import model
+try:
+    from ckan.tests import factories, helpers
+except ImportError:
+    from ckan.new_tests import factories, helpers
+
+from ckanext.issues import model as issuemodel
+from ckanext.issues.lib import retention
+from ckanext.issues.tests import factories as issue_factories
+from ckanext.issues.tests.helpers import ClearOnTearDownMixin
+
+from nose.tools import assert_equals
+
+
+class TestPurgeSpam(ClearOnTearDownMixin):
+    def setup(self):
+        self.user = factories.User()
+        self.dataset = factories.Dataset()
+        self.long_ago = datetime.now() - timedelta(days=60)
+
+    def _issue(self, spam=False):
+        issue = issue_factories.Issue(user_id=self.user['id'],
+                                      dataset_id=self.dataset['id'])
+        if spam:
+            issue_obj = issuemodel.Issue.get(issue['id'])
+            issue_obj.abuse_status = issuemodel.AbuseStatus.abuse.value
+            issue_obj.updated = self.long_ago
+            model.Session.commit()
+        return issue
+
+    def _comment(self, issue, spam=False):
+        comment = issue_factories.IssueComment(user_id=self.user['id'],
+                                               dataset_id=self.dataset['id'],
+                                               issue_number=issue['number'])
+        if spam:
+            comment_obj = issuemodel.IssueComment.get(comment['id'])
+            comment_obj.abuse_status = issuemodel.AbuseStatus.abuse.value
+            comment_obj.moderated = self.long_ago
+            model.Session.commit()
+        return comment
+
+    def test_purge(self):
+        spam_issue = self._issue(spam=True)
+        self._comment(spam_issue)
+        issue = self._issue()
+        comment = self._comment(issue)
+        self._comment(issue, spam=True)
+        self._comment(issue, spam=True)
+        before = datetime.now() - timedelta(days=30)
+
+        assert_equals(retention.count_spam(model.Session, before),
+                      {'issues': 1, 'comments': 3, 'reports': 0})
+        assert_equals(retention.purge_spam(model.Session, before,
+                                           batch_size=1, pause=0), (1, 2))
+
+        assert_equals([i.id for i in model.Session.query(issuemodel.Issue)],
+                      [issue['id']])
+        assert_equals([c.id for c
+                       in model.Session.query(issuemodel.IssueComment)],
+                      [comment['id']])
+        assert_equals(retention.count_spam(model.Session, before),
+                      {'issues': 0, 'comments': 0, 'reports': 0})
+
+    def test_recent_spam_is_kept(self):
+        issue = self._issue(spam=True)
+        assert_equals(retention.purge_spam(
+            model.Session, self.long_ago - timedelta(days=1), pause=0),
+            (0, 0))
+        assert_equals(issuemodel.Issue.get(issue['id']).id, issue['id'])
+
+    def test_retention_starts_when_confirmed(self):
+        issue = self._issue()
+        comment = self._comment(issue)
+        comment_obj = issuemodel.IssueComment.get(comment['id'])
+        comment_obj.created = self.long_ago
+        model.Session.commit()
+        helpers.call_action('issue_comment_report',
+                            context={'user': factories.Sysadmin()['name']},
+                            dataset_id=self.dataset['id'],
+                            issue_number=issue['number'],
+                            comment_id=comment['id'])
+        assert_equals(retention.purge_spam(
+            model.Session, datetime.now() - timedelta(days=30), pause=0),
+            (0, 0))
+        assert_equals(issuemodel.IssueComment.get(comment['id']).abuse_status,
+                      issuemodel.AbuseStatus.abuse.value)
@@ -0,0 +1,118 @@
+import os
+import shutil
+import tempfile
+
+import mock
+from ckan import model
+try:
+    from ckan.tests import factories, helpers
+except ImportError:
+    from ckan.new_tests import factories, helpers
+
+from ckanext.issues.lib import search
+from ckanext.issues.tests import factories as issue_factories
+from ckanext.issues.tests.helpers import ClearOnTearDownMixin
+
+from nose.tools import assert_equals
+
+
+class TestSqliteFtsSearch(ClearOnTearDownMixin):
+    def setup(self):
+        self.index_dir = tempfile.mkdtemp()
+        self.config = mock.patch.dict('ckanext.issues.lib.search.config', {
+            'ckanext.issues.search_backend': 'sqlite_fts',
+            'ckanext.issues.search_index_path':
+                os.path.join(self.index_dir, 'issues.sqlite'),
+        })
+        self.config.start()
+        self.owner = factories.User()
+        self.org = factories.Organization(user=self.owner)
+        self.dataset = factories.Dataset(owner_org=self.org['name'])
+
+    def teardown(self):
+        self.config.stop()
+        shutil.rmtree(self.index_dir)
+
+    def _issue(self, **kwargs):
+        return issue_factories.Issue(user=self.owner, user_id=self.owner['id'],
+                                     dataset_id=self.dataset['id'], **kwargs)
+
+    def _search(self, **kwargs):
+        return helpers.call_action('issue_search',
+                                   context={'user': self.owner['name'],
+                                            'model': model},
+                                   **kwargs)
+
+    def test_text_search(self):
+        self._issue(title='Broken resource link')
+        self._issue(title='Wrong licence', description='Links to nowhere')
+        self._issue(title='Typo')
+        result = self._search(dataset_id=self.dataset['id'], q='link',
+                              sort='oldest')
+        assert_equals(result['count'], 2)
+        assert_equals([issue['title'] for issue in result['results']],
+                      ['Broken resource link', 'Wrong licence'])
+
+    def test_organization_and_status(self):
+        issue = self._issue()
+        self._issue()
+        helpers.call_action('issue_update',
+                            context={'user': self.owner['name']},
+                            dataset_id=self.dataset['id'],
+                            issue_number=issue['number'], status='closed')
+        result = self._search(organization_id=self.org['id'],
+                              status='closed')
+        assert_equals([i['id'] for i in result['results']], [issue['id']])
+
+    def test_sort_by_comments(self):
+        few = self._issue()
+        many = self._issue()
+        for i in range(2):
+            issue_factories.IssueComment(user_id=self.owner['id'],
+                                         dataset_id=self.dataset['id'],
+                                         issue_number=many['number'])
+        result = self._search(dataset_id=self.dataset['id'],
+                              sort='most_commented')
+        assert_equals([i['id'] for i in result['results']],
+                      [many['id'], few['id']])
+        assert_equals(result['results'][0]['comment_count'], 2)
+
+    def test_paging(self):
+        issues = [self._issue() for i in range(3)]
+        result = self._search(dataset_id=self.dataset['id'], sort='oldest',
+                              offset=1, limit=1)
+        assert_equals(result['count'], 3)
+        assert_equals([i['id'] for i in result['results']], [issues[1]['id']])
+
+    def test_deleted_issue_removed(self):
+        issue = self._issue()
+        helpers.call_action('issue_delete',
+                            context={'user': self.owner['name']},
+                            dataset_id=self.dataset['id'],
+                            issue_number=issue['number'])
+        assert_equals(self._search(dataset_id=self.dataset['id'])['count'],
+                      0)
+
+    def test_purged_dataset_issues_removed(self):
+        self._issue()
+        self._issue()
+        helpers.call_action('dataset_purge', id=self.dataset['id'])
+        assert_equals(self._search(organization_id=self.org['id'])['count'],
+                      0)
+
+    def test_facet_counts(self):
+        self._issue()
+        self._issue()
+        facets = search.get_backend().facet_counts(
+            model.Session, {'dataset_id': self.dataset['id']})
+        assert_equals(facets['status'], {'open': 2})
+        assert_equals(facets['dataset_id'], {self.dataset['id']: 2})
+
+    def test_rebuild(self):
+        issue = self._issue(title='Broken resource link')
+        search.get_backend().delete_issue(issue['id'])
+        assert_equals(self._search(dataset_id=self.dataset['id'])['count'],
+                      0)
+        assert_equals(search.get_backend().rebuild(model.Session), 1)
+        result = self._search(dataset_id=self.dataset['id'], q='broken')
+        assert_equals(result['count'], 1)
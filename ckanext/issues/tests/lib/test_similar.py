@@ -0,0 +1,76 @@
+from ckan import model
+try:
+    from ckan.tests import factories, helpers
+except ImportError:
+    from ckan.new_tests import factories, helpers
+
+from ckanext.issues import model as issuemodel
+from ckanext.issues.lib import similar
+from ckanext.issues.tests import factories as issue_factories
+from ckanext.issues.tests.helpers import ClearOnTearDownMixin
+
+from nose.tools import assert_equals, assert_true
+
+
+class TestSignature(object):
+    def test_similarity(self):
+        link = similar.signature(u'The download link is broken')
+        assert_true(similar.similarity(
+            link, similar.signature(u'Broken download link')) > 0.3)
+        assert_equals(similar.similarity(
+            link, similar.signature(u'Dates in the wrong format')), 0)
+        assert_equals(similar.similarity(link, link), 1)
+
+    def test_no_words(self):
+        assert_equals(similar.signature(u'The', u'...'), None)
+
+
+class TestIssueSimilar(ClearOnTearDownMixin):
+    def setup(self):
+        self.user = factories.User()
+        self.dataset = factories.Dataset()
+
+    def _issue(self, title, **kwargs):
+        return issue_factories.Issue(user_id=self.user['id'],
+                                     dataset_id=self.dataset['id'],
+                                     title=title, description=u'', **kwargs)
+
+    def _similar(self, title):
+        return [issue['number'] for issue in helpers.call_action(
+            'issue_similar', dataset_id=self.dataset['name'], title=title)]
+
+    def test_similar_open_issues(self):
+        link = self._issue(u'The download link is broken')
+        other_link = self._issue(u'Download link broken')
+        self._issue(u'Dates in the wrong format')
+        closed = self._issue(u'Broken download link')
+        issuemodel.Issue.get(closed['id']).status = u'closed'
+        model.Session.commit()
+        issue_factories.Issue(user_id=self.user['id'],
+                              dataset_id=factories.Dataset()['id'],
+                              title=u'Download link broken')
+
+        assert_equals(self._similar(u'download link broken'),
+                      [other_link['number'], link['number']])
+
+    def test_signature_follows_updates(self):
+        issue = self._issue(u'Dates in the wrong format')
+        helpers.call_action('issue_update', dataset_id=self.dataset['id'],
+                            issue_number=issue['number'],
+                            title=u'Download link broken')
+        assert_equals(self._similar(u'download link broken'),
+                      [issue['number']])
+        assert_true('similarity_signature' not in helpers.call_action(
+            'issue_show', dataset_id=self.dataset['id'],
+            issue_number=issue['number']))
+
+    def test_rebuild(self):
+        issue = self._issue(u'Download link broken')
+        issue_obj = issuemodel.Issue.get(issue['id'])
+        issue_obj.similarity_signature = None
+        model.Session.commit()
+        assert_equals(self._similar(u'download link broken'), [])
+
+        assert_equals(similar.rebuild(model.Session), 1)
+        assert_equals(self._similar(u'download link broken'),
+                      [issue['number']])
@@ -0,0 +1,72 @@
+import json
+
+import mock
+from ckan import model
+try:
+    from ckan.tests import factories, helpers
+except ImportError:
+    from ckan.new_tests import factories, helpers
+
+from ckanext.issues.lib import slow_queries
+from ckanext.issues.tests import factories as issue_factories
+from ckanext.issues.tests.helpers import ClearOnTearDownMixin
+
+from nose.tools import assert_equals, assert_in
+
+
+class TestSlowQueries(ClearOnTearDownMixin):
+    def setup(self):
+        slow_queries.reset()
+        self.owner = factories.User()
+        self.org = factories.Organization(user=self.owner)
+        self.dataset = factories.Dataset(owner_org=self.org['name'])
+        issue_factories.Issue(user=self.owner, user_id=self.owner['id'],
+                              dataset_id=self.dataset['id'])
+
+    def teardown(self):
+        slow_queries.reset()
+
+    def _search(self):
+        helpers.call_action('issue_search',
+                            context={'user': self.owner['name'],
+                                     'model': model},
+                            dataset_id=self.dataset['id'],
+                            q='title')
+
+    def _logged(self, log):
+        return [json.loads(call[0][1]) for call in log.warning.call_args_list]
+
+    @mock.patch('ckanext.issues.lib.slow_queries.log')
+    @mock.patch.dict('ckanext.issues.lib.slow_queries.config',
+                     {'ckanext.issues.slow_query.threshold_ms': '0'})
+    def test_slow_search_is_logged_with_plan(self, log):
+        self._search()
+        entries = self._logged(log)
+        assert entries
+        entry = entries[0]
+        assert_equals(entry['name'], 'issue_search')
+        assert_equals(entry['details']['q'], 'title')
+        assert_in('SELECT', entry['statement'])
+        assert entry['plan']
+
+    @mock.patch('ckanext.issues.lib.slow_queries.log')
+    @mock.patch.dict('ckanext.issues.lib.slow_queries.config',
+                     {'ckanext.issues.slow_query.threshold_ms': '0',
+                      'ckanext.issues.slow_query.max_per_minute': '1'})
+    def test_rate_limited(self, log):
+        self._search()
+        self._search()
+        assert_equals(len(self._logged(log)), 1)
+
+    @mock.patch('ckanext.issues.lib.slow_queries.log')
+    @mock.patch.dict('ckanext.issues.lib.slow_queries.config',
+                     {'ckanext.issues.slow_query.threshold_ms': '0',
+                      'ckanext.issues.slow_query.sample_rate': '0'})
+    def test_sampled(self, log):
+        self._search()
+        assert_equals(self._logged(log), [])
+
+    @mock.patch('ckanext.issues.lib.slow_queries.log')
+    def test_off_by_default(self, log):
+        self._search()
+        assert_equals(self._logged(log), [])
@@ -0,0 +1,120 @@
+import os
+import shutil
+import tempfile
+
+from ckan import model
+try:
+    from ckan.tests import factories
+except ImportError:
+    from ckan.new_tests import factories
+
+from ckanext.issues import model as issuemodel
+from ckanext.issues.lib import spam
+from ckanext.issues.tests import factories as issue_factories
+from ckanext.issues.tests.helpers import ClearOnTearDownMixin
+
+from nose.tools import assert_equals, assert_true
+import mock
+
+SPAM = [u'Cheap pills, buy now at http://pills.example.com',
+        u'Buy cheap watches now http://watches.example.com',
+        u'Win money now, click http://casino.example.com']
+HAM = [u'The CSV file for March is missing',
+       u'The dates in the spreadsheet are in the wrong format',
+       u'Could you publish the data for 2015 as well?']
+
+
+class TestSpamClassifier(object):
+    def setup(self):
+        self.classifier = spam.SpamClassifier()
+        self.classifier.train([(text, True) for text in SPAM] +
+                              [(text, False) for text in HAM])
+
+    def test_score(self):
+        assert_true(self.classifier.score(
+            u'Buy cheap pills now http://example.com') > 0.95)
+        assert_true(self.classifier.score(
+            u'The CSV file has the wrong dates') < 0.05)
+
+    def test_untrained(self):
+        assert_equals(spam.SpamClassifier().score(u'Buy cheap pills'), 0.0)
+
+    def test_save_and_load(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'model.json')
+            self.classifier.save(path)
+            loaded = spam.SpamClassifier.load(path)
+            text = u'Cheap watches http://example.com'
+            assert_equals(loaded.score(text), self.classifier.score(text))
+        finally:
+            shutil.rmtree(directory)
+
+
+class TestSpamWorker(ClearOnTearDownMixin):
+    def setup(self):
+        self.user = factories.User()
+        self.dataset = factories.Dataset()
+        self.directory = tempfile.mkdtemp()
+        self.config = {'ckanext.issues.spam.enabled': 'true',
+                       'ckanext.issues.spam.model_path':
+                       os.path.join(self.directory, 'model.json')}
+
+    def teardown(self):
+        shutil.rmtree(self.directory)
+
+    def _issue(self, title, abuse_status=None):
+        issue = issue_factories.Issue(user_id=self.user['id'],
+                                      dataset_id=self.dataset['id'],
+                                      title=title, description=title)
+        if abuse_status:
+            issue_obj = issuemodel.Issue.get(issue['id'])
+            issue_obj.abuse_status = abuse_status.value
+            model.Session.commit()
+        return issue
+
+    def test_spam_is_hidden(self):
+        with mock.patch.dict('ckanext.issues.lib.spam.config', self.config):
+            for text in SPAM:
+                self._issue(text, issuemodel.AbuseStatus.abuse)
+            for text in HAM:
+                self._issue(text, issuemodel.AbuseStatus.not_abuse)
+            model.Session.execute(
+                issuemodel.issue_spam_check_table.delete())
+            model.Session.commit()
+            classifier = spam.train(model.Session)
+            assert_equals(classifier.docs, [3, 3])
+            assert_true(spam.get_classifier() is not None)
+
+            spam_issue = self._issue(u'Buy cheap pills now http://x.example')
+            issue = self._issue(u'The CSV file has the wrong dates')
+            comment = issue_factories.IssueComment(
+                user_id=self.user['id'], dataset_id=self.dataset['id'],
+                issue_number=issue['number'],
+                comment=u'Win money, buy cheap watches http://y.example')
+
+            assert_equals(spam.score_pending(model.Session,
+                                             spam.get_classifier()), (3, 2))
+
+        assert_equals(issuemodel.Issue.get(spam_issue['id']).visibility,
+                      u'hidden')
+        assert_equals(issuemodel.Issue.get(issue['id']).visibility,
+                      u'visible')
+        assert_equals(issuemodel.IssueComment.get(comment['id']).visibility,
+                      u'hidden')
+        assert_equals(model.Session.query(
+            issuemodel.issue_spam_check_table).count(), 0)
+
+    def test_checks_are_claimed_once(self):
+        with mock.patch.dict('ckanext.issues.lib.spam.config', self.config):
+            issues = [self._issue(u'One'), self._issue(u'Two')]
+        claimed = spam._claim(model.Session, 1) + \
+            spam._claim(model.Session, 1)
+        assert_equals([row.object_id for row in claimed],
+                      [issue['id'] for issue in issues])
+        assert_equals(spam._claim(model.Session, 1), [])
+
+    def test_not_queued_unless_enabled(self):
+        self._issue(u'Buy cheap pills now')
+        assert_equals(model.Session.query(
+            issuemodel.issue_spam_check_table).count(), 0)
@@ -0,0 +1,209 @@
+import BaseHTTPServer
+from datetime import datetime, timedelta
+import json
+import socket
+import threading
+
+import mock
+from ckan import model
+from ckan.plugins import toolkit
+try:
+    from ckan.tests import factories, helpers
+except ImportError:
+    from ckan.new_tests import factories, helpers
+
+from ckanext.issues import model as issuemodel
+from ckanext.issues.lib import webhooks
+from ckanext.issues.tests import factories as issue_factories
+from ckanext.issues.tests.helpers import ClearOnTearDownMixin
+
+from nose.tools import assert_equals, assert_raises, assert_true
+
+
+class StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    '''Records the requests posted to it, replying with the server's
+    status'''
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        self.server.requests.append((dict(self.headers), body))
+        self.send_response(self.server.status)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class TestWebhooks(ClearOnTearDownMixin):
+    def setup(self):
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), StubHandler)
+        self.server.requests = []
+        self.server.status = 200
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.url = 'http://127.0.0.1:{0}/hook'.format(self.server.server_port)
+        self.config = mock.patch.dict(
+            'ckanext.issues.lib.webhooks.config',
+            {'ckanext.issues.webhooks.allowed_hosts': '127.0.0.1',
+             'ckanext.issues.webhooks.allow_private_addresses': 'true'})
+        self.config.start()
+
+        self.owner = factories.User()
+        self.org = factories.Organization(user=self.owner)
+        self.dataset = factories.Dataset(owner_org=self.org['name'])
+        self.webhook = helpers.call_action(
+            'issue_webhook_create', context={'user': self.owner['name']},
+            url=self.url, organization_id=self.org['id'],
+            events=['issue.created', 'comment.created'])
+
+    def teardown(self):
+        self.config.stop()
+        self.server.shutdown()
+        self.server.server_close()
+        super(TestWebhooks, self).teardown()
+
+    def _issue(self):
+        return issue_factories.Issue(user_id=self.owner['id'],
+                                     dataset_id=self.dataset['id'])
+
+    def test_events_are_batched_and_signed(self):
+        issue = self._issue()
+        issue_factories.IssueComment(user_id=self.owner['id'],
+                                     dataset_id=self.dataset['id'],
+                                     issue_number=issue['number'])
+        # not subscribed to
+        helpers.call_action('issue_update',
+                            context={'user': self.owner['name']},
+                            dataset_id=self.dataset['id'],
+                            issue_number=issue['number'], status='closed')
+
+        assert_equals(webhooks.deliver_pending(model.Session), (2, 0))
+        assert_equals(len(self.server.requests), 1)
+        headers, body = self.server.requests[0]
+        assert_equals(headers['x-issues-signature'],
+                      webhooks.sign(self.webhook['secret'],
+                                    headers['x-issues-timestamp'], body))
+        events = json.loads(body)['events']
+        assert_equals([event['event'] for event in events],
+                      ['issue.created', 'comment.created'])
+        assert_equals(events[1]['data']['issue']['id'], issue['id'])
+
+        # delivered events are not sent again
+        assert_equals(webhooks.deliver_pending(model.Session), (0, 0))
+
+    def test_failures_are_retried_with_backoff(self):
+        self.server.status = 500
+        self._issue()
+        assert_equals(webhooks.deliver_pending(model.Session), (0, 0))
+        webhook = issuemodel.IssueWebhook.get(self.webhook['id'])
+        assert_equals(webhook.failures, 1)
+        assert_true(webhook.retry_at > datetime.now())
+
+        # not retried until retry_at
+        self.server.status = 200
+        assert_equals(webhooks.deliver_pending(model.Session), (0, 0))
+        assert_equals(len(self.server.requests), 1)
+
+        webhook.retry_at = datetime.now()
+        model.Session.commit()
+        assert_equals(webhooks.deliver_pending(model.Session), (1, 0))
+        assert_equals(issuemodel.IssueWebhook.get(self.webhook['id'])
+                      .failures, 0)
+
+    def test_events_are_given_up_on(self):
+        self.server.status = 500
+        self._issue()
+        with mock.patch.dict('ckanext.issues.lib.webhooks.config',
+                             {'ckanext.issues.webhooks.max_attempts': 1}):
+            assert_equals(webhooks.deliver_pending(model.Session), (0, 1))
+        webhook_list = helpers.call_action(
+            'issue_webhook_list', context={'user': self.owner['name']},
+            organization_id=self.org['id'])
+        assert_equals([(w['pending'], w['failed']) for w in webhook_list],
+                      [(0, 1)])
+
+    def test_webhooks_being_posted_to_are_leased(self):
+        self._issue()
+        now = datetime.now()
+        lease_until = now + timedelta(minutes=1)
+        assert_true(webhooks._claim(model.Session, self.webhook['id'], now,
+                                    lease_until))
+        model.Session.commit()
+
+        # so another worker leaves it
+        assert_true(not webhooks._claim(model.Session, self.webhook['id'],
+                                        now, lease_until))
+        assert_equals(webhooks.deliver_pending(model.Session), (0, 0))
+        assert_equals(self.server.requests, [])
+
+    def test_other_organizations_events_are_not_sent(self):
+        other_dataset = factories.Dataset(
+            owner_org=factories.Organization()['name'])
+        issue_factories.Issue(user_id=self.owner['id'],
+                              dataset_id=other_dataset['id'])
+        assert_equals(webhooks.deliver_pending(model.Session), (0, 0))
+        assert_equals(self.server.requests, [])
+
+    def test_only_organization_admins_can_add_webhooks(self):
+        user = factories.User()
+        assert_raises(toolkit.NotAuthorized, helpers.call_action,
+                      'issue_webhook_create',
+                      context={'user': user['name'], 'ignore_auth': False},
+                      url=self.url, organization_id=self.org['id'])
+
+    def test_hosts_must_be_allowed(self):
+        assert_raises(toolkit.ValidationError, helpers.call_action,
+                      'issue_webhook_create',
+                      context={'user': self.owner['name']},
+                      url='http://hooks.example.com/',
+                      organization_id=self.org['id'])
+        with mock.patch.dict('ckanext.issues.lib.webhooks.config',
+                             {'ckanext.issues.webhooks.allowed_hosts':
+                              '.example.com'}):
+            helpers.call_action('issue_webhook_create',
+                                context={'user': self.owner['name']},
+                                url='http://hooks.example.com/',
+                                organization_id=self.org['id'])
+
+    def test_private_addresses_are_not_posted_to(self):
+        self._issue()
+        with mock.patch.dict(
+                'ckanext.issues.lib.webhooks.config',
+                {'ckanext.issues.webhooks.allow_private_addresses': 'false'}):
+            assert_raises(ValueError, webhooks.check_url, self.url)
+            assert_equals(webhooks.deliver_pending(model.Session), (0, 0))
+        assert_equals(self.server.requests, [])
+
+    def test_the_checked_address_is_posted_to(self):
+        # the host resolves to the stub server when checked, and to an
+        # unreachable address after that, as when its DNS is rebound
+        answers = ['127.0.0.1', '192.0.2.1']
+        getaddrinfo = socket.getaddrinfo
+
+        def rebinding_getaddrinfo(host, *args):
+            if host == 'hooks.example.com':
+                host = answers.pop(0)
+            return getaddrinfo(host, *args)
+
+        webhook = issuemodel.IssueWebhook.get(self.webhook['id'])
+        webhook.url = self.url.replace('127.0.0.1', 'hooks.example.com')
+        model.Session.commit()
+        self._issue()
+        with mock.patch('socket.getaddrinfo', rebinding_getaddrinfo), \
+                mock.patch.dict('ckanext.issues.lib.webhooks.config',
+                                {'ckanext.issues.webhooks.timeout': 1}):
+            assert_equals(webhooks.deliver_pending(model.Session), (1, 0))
+        headers, body = self.server.requests[0]
+        assert_equals(headers['host'], 'hooks.example.com:{0}'.format(
+            self.server.server_port))
+
+
+class TestAddresses(object):
+    def test_is_public_address(self):
+        for address in ('127.0.0.1', '10.1.2.3', '172.16.0.1',
+                        '192.168.1.1', '169.254.169.254', '0.0.0.0', '::1',
+                        'fe80::1', 'fd00::1', '::ffff:127.0.0.1'):
+            assert_true(not webhooks.is_public_address(address), address)
+        for address in ('8.8.8.8', '172.32.0.1', '2001:4860::8888'):
+            assert_true(webhooks.is_public_address(address), address)
@@ -0,0 +1,122 @@
+import mock
+from ckan import model
+from ckan.plugins import toolkit
+try:
+    from ckan.tests import factories, helpers
+except ImportError:
+    from ckan.new_tests import factories, helpers
+
+from ckanext.issues import model as issuemodel
+from ckanext.issues.tests import factories as issue_factories
+from ckanext.issues.tests.helpers import ClearOnTearDownMixin
+
+from nose.tools import assert_equals, assert_raises
+
+
+class TestIssueChanges(ClearOnTearDownMixin):
+    def setup(self):
+        self.config = mock.patch.dict(
+            'ckanext.issues.logic.action.action.config',
+            {'ckanext.issues.changes_settle_seconds': 0})
+        self.config.start()
+        self.sysadmin = factories.Sysadmin()
+        self.owner = factories.User()
+        self.org = factories.Organization(user=self.owner)
+        self.dataset = factories.Dataset(owner_org=self.org['name'])
+
+    def teardown(self):
+        self.config.stop()
+        super(TestIssueChanges, self).teardown()
+
+    def _changes(self, **kwargs):
+        return helpers.call_action('issue_changes',
+                                   context={'user': self.sysadmin['name']},
+                                   **kwargs)
+
+    def _summary(self, changes):
+        return [(change['object_type'], change['object_id'], change['change'])
+                for change in changes['changes']]
+
+    def test_changes_to_issues_and_comments(self):
+        issue = issue_factories.Issue(user_id=self.owner['id'],
+                                      dataset_id=self.dataset['id'])
+        comment = issue_factories.IssueComment(
+            user_id=self.owner['id'], dataset_id=self.dataset['id'],
+            issue_number=issue['number'])
+        changes = self._changes()
+        # commenting updates the issue too, after the issue was created
+        assert_equals(self._summary(changes),
+                      [('comment', comment['id'], 'created'),
+                       ('issue', issue['id'], 'updated')])
+        assert_equals(changes['changes'][1]['object']['comment_count'], 1)
+        assert_equals(changes['more'], False)
+
+        # nothing more until something changes
+        assert_equals(self._changes(since=changes['next_since'])['changes'],
+                      [])
+
+        helpers.call_action('issue_delete',
+                            context={'user': self.owner['name']},
+                            dataset_id=self.dataset['id'],
+                            issue_number=issue['number'])
+        deleted = self._changes(since=changes['next_since'])
+        assert_equals(sorted(self._summary(deleted)),
+                      [('comment', comment['id'], 'deleted'),
+                       ('issue', issue['id'], 'deleted')])
+        assert_equals([change['object'] for change in deleted['changes']],
+                      [None, None])
+
+    def test_reports_are_changes(self):
+        user = factories.User()
+        issue = issue_factories.Issue(user_id=self.owner['id'],
+                                      dataset_id=self.dataset['id'])
+        since = self._changes()['next_since']
+        helpers.call_action('issue_report', context={'user': user['name']},
+                            dataset_id=self.dataset['id'],
+                            issue_number=issue['number'])
+        assert_equals(self._summary(self._changes(since=since)),
+                      [('issue', issue['id'], 'updated')])
+
+    def test_batches(self):
+        issues = [issue_factories.Issue(user_id=self.owner['id'],
+                                        dataset_id=self.dataset['id'])
+                  for i in range(3)]
+        first = self._changes(limit=2)
+        assert_equals([change['object_id'] for change in first['changes']],
+                      [issues[0]['id'], issues[1]['id']])
+        assert_equals(first['more'], True)
+        second = self._changes(since=first['next_since'], limit=2)
+        assert_equals([change['object_id'] for change in second['changes']],
+                      [issues[2]['id']])
+        assert_equals(second['more'], False)
+
+    def test_changes_are_read_up_to_the_committed_ones(self):
+        issue = issue_factories.Issue(user_id=self.owner['id'],
+                                      dataset_id=self.dataset['id'])
+        last_id = self._changes()['next_since']
+        assert_equals(issuemodel.committed_change_id(model.Session), last_id)
+        with mock.patch.object(issuemodel, 'committed_change_id',
+                               return_value=None):
+            # still being committed
+            changes = self._changes()
+        assert_equals(changes['changes'], [])
+        assert_equals(changes['next_since'], 0)
+
+    def test_compaction_keeps_the_latest_changes(self):
+        issue = issue_factories.Issue(user_id=self.owner['id'],
+                                      dataset_id=self.dataset['id'])
+        for title in ('one', 'two'):
+            helpers.call_action('issue_update',
+                                context={'user': self.owner['name']},
+                                dataset_id=self.dataset['id'],
+                                issue_number=issue['number'], title=title)
+        before = self._changes()
+        assert_equals(issuemodel.compact_changes(model.Session), 2)
+        model.Session.commit()
+        assert_equals(self._changes(), before)
+
+    def test_only_sysadmins_can_read_changes(self):
+        assert_raises(toolkit.NotAuthorized, helpers.call_action,
+                      'issue_changes',
+                      context={'user': self.owner['name'],
+                               'ignore_auth': False})
@@ -5,7 +5,8 @@ except ImportError:
 from ckan.plugins import toolkit
 
 from ckanext.issues.tests import factories as issue_factories
-from ckanext.issues.model import Issue, IssueComment, AbuseStatus
+from ckanext.issues.model import (Issue, IssueComment, IssueCategory,
+                                  AbuseStatus, IssueFilter)
 from ckanext.issues.tests.helpers import ClearOnTearDownMixin
 
 from ckan import model
@@ -38,6 +39,23 @@ class TestIssueShow(ClearOnTearDownMixin):
         assert_not_in('reset_key', user.keys())
         assert_not_in('password', user.keys())
 
+    def test_issue_show_fields(self):
+        issue = helpers.call_action(
+            'issue_show',
+            dataset_id=self.issue['dataset_id'],
+            issue_number=self.issue['number'],
+            fields='number,title,status,created',
+        )
+        assert_equals(issue, {'number': self.issue['number'],
+                              'title': 'Test Issue',
+                              'status': 'open',
+                              'created': self.issue['created']})
+
+    def test_issue_show_invalid_field(self):
+        assert_raises(toolkit.ValidationError, helpers.call_action,
+                      'issue_show', dataset_id=self.issue['dataset_id'],
+                      issue_number=self.issue['number'], fields='password')
+
 
 class TestIssueNew(ClearOnTearDownMixin):
     def setup(self):
@@ -416,6 +434,34 @@ class TestIssueSearch(ClearOnTearDownMixin):
         assert_equals(reordered_ids, [i['id'] for i in issues_list])
         assert_equals([3, 2, 1, 0], [i['comment_count'] for i in issues_list])
 
+    def test_sort_by_recently_updated(self):
+        user = factories.User()
+        dataset = factories.Dataset()
+        issues = [issue_factories.Issue(user_id=user['id'],
+                                        dataset_id=dataset['id'])
+                  for i in range(4)]
+        # commenting on, editing and closing an issue all update it
+        issue_factories.IssueComment(user_id=user['id'],
+                                     issue_number=issues[0]['number'],
+                                     dataset_id=dataset['id'])
+        helpers.call_action('issue_update', context={'user': user['name']},
+                            dataset_id=dataset['id'],
+                            issue_number=issues[2]['number'],
+                            title='new title')
+        helpers.call_action('issue_update', context={'user': user['name']},
+                            dataset_id=dataset['id'],
+                            issue_number=issues[1]['number'],
+                            status='closed')
+        search = lambda sort: [
+            i['id'] for i in helpers.call_action(
+                'issue_search', context={'user': user['name']},
+                dataset_id=dataset['id'], sort=sort)['results']]
+
+        expected = [issues[1]['id'], issues[2]['id'], issues[0]['id'],
+                    issues[3]['id']]
+        assert_equals(search('recently_updated'), expected)
+        assert_equals(search('least_recently_updated'), expected[::-1])
+
     def test_filter_by_title_string_search(self):
         user = factories.User()
         dataset = factories.Dataset()
@@ -434,6 +480,236 @@ class TestIssueSearch(ClearOnTearDownMixin):
         assert_equals(expected_issue_ids,
                       set([i['id'] for i in filtered_issues]))
 
+    def test_fields(self):
+        category = IssueCategory('other')
+        category.description = 'Other'
+        model.Session.add(category)
+        model.Session.commit()
+        user = factories.User()
+        dataset = factories.Dataset()
+        for i in range(3):
+            issue = issue_factories.Issue(user_id=user['id'],
+                                          dataset_id=dataset['id'],
+                                          categories=['other'])
+            for j in range(i):
+                issue_factories.IssueComment(user_id=user['id'],
+                                             issue_number=issue['number'],
+                                             dataset_id=dataset['id'])
+        search = lambda **kwargs: helpers.call_action(
+            'issue_search', context={'user': user['name']},
+            dataset_id=dataset['id'], sort='most_commented',
+            include_datasets=True, **kwargs)['results']
+
+        fields = ['number', 'title', 'status', 'updated', 'user',
+                  'comment_count', 'categories']
+        expected = [dict((field, result[field]) for field in fields)
+                    for result in search()]
+        assert_equals(search(fields=fields), expected)
+        assert_equals(search(fields='number,dataset')[0]['dataset']['id'],
+                      dataset['id'])
+        # sorted by the comment count, without returning it
+        assert_equals(search(fields=['number']),
+                      [{'number': result['number']} for result in expected])
+
+    def test_results_as_plain_dict(self):
+        user = factories.User()
+        reporter = factories.User()
+        dataset = factories.Dataset()
+        for i in range(2):
+            issue = issue_factories.Issue(user_id=user['id'],
+                                          dataset_id=dataset['id'])
+            issue_factories.IssueComment(user_id=user['id'],
+                                         issue_number=issue['number'],
+                                         dataset_id=dataset['id'])
+        helpers.call_action('issue_report',
+                            context={'user': reporter['name']},
+                            dataset_id=dataset['id'],
+                            issue_number=issue['number'])
+        results = helpers.call_action(
+            'issue_search', context={'user': user['name']},
+            dataset_id=dataset['id'], sort='oldest', include_datasets=True,
+            include_reports=True)['results']
+
+        expected = [
+            issue.as_plain_dict(user_name, comment_count, updated,
+                                include_dataset=True, include_reports=True)
+            for issue, user_name, comment_count, updated in Issue.get_issues(
+                dataset_id=dataset['id'], sort=IssueFilter.oldest,
+                include_reports=True)
+        ]
+        assert_equals(results, expected)
+        assert_equals(results[1]['abuse_reports'], [reporter['id']])
+
+
+class TestIssueSearchFacets(ClearOnTearDownMixin):
+    def setup(self):
+        self.owner = factories.User()
+        self.org = factories.Organization(user=self.owner)
+        self.datasets = [factories.Dataset(owner_org=self.org['name'])
+                         for i in range(2)]
+        self.issues = [issue_factories.Issue(user_id=self.owner['id'],
+                                             dataset_id=dataset['id'])
+                       for dataset in self.datasets + self.datasets[:1]]
+        helpers.call_action('issue_update',
+                            context={'user': self.owner['name']},
+                            dataset_id=self.datasets[0]['id'],
+                            issue_number=self.issues[0]['number'],
+                            status='closed')
+
+    def test_facets_for_organization(self):
+        result = helpers.call_action('issue_search',
+                                     context={'user': self.owner['name']},
+                                     organization_id=self.org['id'],
+                                     facets=True)
+        facets = result['facets']
+        assert_equals(facets['status'], {'open': 2, 'closed': 1})
+        assert_equals(facets['visibility'], {'visible': 3})
+        assert_equals(facets['abuse_status'], {'unmoderated': 3})
+        # closing an issue assigns it to whoever closed it
+        assert_equals(facets['assignee_id'], {self.owner['id']: 1})
+        assert_equals(facets['dataset_id'], {self.datasets[0]['id']: 2,
+                                             self.datasets[1]['id']: 1})
+
+    def test_facets_follow_filters(self):
+        result = helpers.call_action('issue_search',
+                                     context={'user': self.owner['name']},
+                                     dataset_id=self.datasets[0]['id'],
+                                     status='open',
+                                     facets=True)
+        assert_equals(result['facets']['status'], {'open': 1})
+        assert_not_in('dataset_id', result['facets'])
+
+    def test_no_facets_by_default(self):
+        result = helpers.call_action('issue_search',
+                                     context={'user': self.owner['name']},
+                                     organization_id=self.org['id'])
+        assert_not_in('facets', result)
+
+
+class TestIssueCategories(ClearOnTearDownMixin):
+    def setup(self):
+        for name in ('broken-resource-link', 'bad-format'):
+            category = IssueCategory(name)
+            category.description = name
+            model.Session.add(category)
+        model.Session.commit()
+        self.owner = factories.User()
+        self.org = factories.Organization(user=self.owner)
+        self.dataset = factories.Dataset(owner_org=self.org['name'])
+
+    def _issue(self, **kwargs):
+        return issue_factories.Issue(user_id=self.owner['id'],
+                                     dataset_id=self.dataset['id'], **kwargs)
+
+    def test_create_with_categories(self):
+        issue = self._issue(categories=['broken-resource-link', 'bad-format'])
+        assert_equals(issue['categories'],
+                      ['bad-format', 'broken-resource-link'])
+
+    def test_create_with_unknown_category(self):
+        assert_raises(toolkit.ValidationError, self._issue,
+                      categories=['no-such-category'])
+
+    def test_update_categories(self):
+        issue = self._issue(categories=['bad-format'])
+        updated = helpers.call_action('issue_update',
+                                      context={'user': self.owner['name']},
+                                      dataset_id=self.dataset['id'],
+                                      issue_number=issue['number'],
+                                      categories=['broken-resource-link'])
+        assert_equals(updated['categories'], ['broken-resource-link'])
+
+    def test_search_by_category(self):
+        broken = self._issue(categories=['broken-resource-link'])
+        self._issue(categories=['bad-format'])
+        self._issue()
+        result = helpers.call_action('issue_search',
+                                     context={'user': self.owner['name']},
+                                     organization_id=self.org['id'],
+                                     category='broken-resource-link',
+                                     facets=True)
+        assert_equals([i['id'] for i in result['results']], [broken['id']])
+        assert_equals(result['results'][0]['categories'],
+                      ['broken-resource-link'])
+        assert_equals(result['facets']['category'],
+                      {'broken-resource-link': 1})
+
+    def test_category_facet(self):
+        self._issue(categories=['broken-resource-link', 'bad-format'])
+        self._issue(categories=['bad-format'])
+        self._issue()
+        result = helpers.call_action('issue_search',
+                                     context={'user': self.owner['name']},
+                                     dataset_id=self.dataset['id'],
+                                     facets=True)
+        assert_equals(result['facets']['category'],
+                      {'broken-resource-link': 1, 'bad-format': 2})
+
+
+class TestIssueUserDashboard(ClearOnTearDownMixin):
+    def setup(self):
+        self.owner = factories.User()
+        self.user = factories.User()
+        self.org = factories.Organization(user=self.owner)
+        self.dataset = factories.Dataset(owner_org=self.org['name'])
+
+    def _assign(self, issue, user):
+        helpers.call_action('issue_update',
+                            context={'user': self.owner['name']},
+                            dataset_id=self.dataset['id'],
+                            issue_number=issue['number'],
+                            assignee_id=user['id'])
+
+    def test_search_by_assignee_and_reporter(self):
+        opened = issue_factories.Issue(user_id=self.user['id'],
+                                       dataset_id=self.dataset['id'])
+        assigned = issue_factories.Issue(user_id=self.owner['id'],
+                                         dataset_id=self.dataset['id'])
+        self._assign(assigned, self.user)
+        search = lambda **kwargs: [
+            i['id'] for i in helpers.call_action(
+                'issue_search', context={'user': self.owner['name']},
+                **kwargs)['results']]
+        assert_equals(search(assignee_id=self.user['name']),
+                      [assigned['id']])
+        assert_equals(search(user_id=self.user['name']), [opened['id']])
+
+    def test_dashboard(self):
+        opened = issue_factories.Issue(user_id=self.user['id'],
+                                       dataset_id=self.dataset['id'])
+        closed = issue_factories.Issue(user_id=self.user['id'],
+                                       dataset_id=self.dataset['id'])
+        helpers.call_action('issue_update',
+                            context={'user': self.owner['name']},
+                            dataset_id=self.dataset['id'],
+                            issue_number=closed['number'],
+                            status='closed')
+        assigned = issue_factories.Issue(user_id=self.owner['id'],
+                                         dataset_id=self.dataset['id'])
+        self._assign(assigned, self.user)
+        issue_factories.Issue(user_id=self.owner['id'],
+                              dataset_id=self.dataset['id'])
+
+        dashboard = helpers.call_action('issue_user_dashboard',
+                                        context={'user': self.user['name']})
+        assert_equals([i['id'] for i in dashboard['assigned']['results']],
+                      [assigned['id']])
+        assert_equals(dashboard['assigned']['count'], 1)
+        assert_equals([i['id'] for i in dashboard['opened']['results']],
+                      [opened['id']])
+        assert_equals(dashboard['opened']['count'], 1)
+        assert_equals(dashboard['opened']['status_counts'],
+                      {'open': 1, 'closed': 1})
+
+    def test_dashboard_of_one_list(self):
+        issue_factories.Issue(user_id=self.user['id'],
+                              dataset_id=self.dataset['id'])
+        dashboard = helpers.call_action('issue_user_dashboard',
+                                        context={'user': self.user['name']},
+                                        list='assigned')
+        assert_equals(dashboard['opened']['results'], [])
+        assert_equals(dashboard['opened']['count'], 1)
+
 
 class TestIssueUpdate(ClearOnTearDownMixin):
     def test_update_an_issue(self):
@@ -565,6 +841,81 @@ class TestIssueDelete(ClearOnTearDownMixin):
                       dataset_id=dataset['id'],
                       issue_number=issue['number'])
 
+    def test_deletion_deletes_comments_and_reports(self):
+        user = factories.User()
+        dataset = factories.Dataset()
+        issue = issue_factories.Issue(user=user, user_id=user['id'],
+                                      dataset_id=dataset['id'])
+        comment = issue_factories.IssueComment(user_id=user['id'],
+                                               dataset_id=dataset['id'],
+                                               issue_number=issue['number'])
+        helpers.call_action('issue_report', context={'user': user['name']},
+                            dataset_id=dataset['id'],
+                            issue_number=issue['number'])
+        helpers.call_action('issue_comment_report',
+                            context={'user': user['name']},
+                            dataset_id=dataset['id'],
+                            issue_number=issue['number'],
+                            comment_id=comment['id'])
+
+        helpers.call_action('issue_delete',
+                            context={'user': user['name']},
+                            dataset_id=dataset['id'],
+                            issue_number=issue['number'])
+
+        assert_equals(model.Session.query(IssueComment).count(), 0)
+        assert_equals(model.Session.query(Issue.Report).count(), 0)
+        assert_equals(model.Session.query(IssueComment.Report).count(), 0)
+
+    def test_purging_a_dataset_deletes_its_issues(self):
+        user = factories.User()
+        dataset = factories.Dataset()
+        other_dataset = factories.Dataset()
+        issue = issue_factories.Issue(user=user, user_id=user['id'],
+                                      dataset_id=dataset['id'])
+        issue_factories.IssueComment(user_id=user['id'],
+                                     dataset_id=dataset['id'],
+                                     issue_number=issue['number'])
+        other_issue = issue_factories.Issue(user=user, user_id=user['id'],
+                                            dataset_id=other_dataset['id'])
+
+        helpers.call_action('dataset_purge', id=dataset['id'])
+
+        assert_equals([i.id for i in model.Session.query(Issue)],
+                      [other_issue['id']])
+        assert_equals(model.Session.query(IssueComment).count(), 0)
+
+    def test_deleting_a_user_deletes_their_issues_and_comments(self):
+        user = factories.User()
+        other_user = factories.User()
+        dataset = factories.Dataset()
+        issue = issue_factories.Issue(user=user, user_id=user['id'],
+                                      dataset_id=dataset['id'])
+        other_issue = issue_factories.Issue(user=other_user,
+                                            user_id=other_user['id'],
+                                            dataset_id=dataset['id'])
+        for issue_ in (issue, other_issue):
+            comment = issue_factories.IssueComment(
+                user_id=user['id'], dataset_id=dataset['id'],
+                issue_number=issue_['number'])
+        other_comment = issue_factories.IssueComment(
+            user_id=other_user['id'], dataset_id=dataset['id'],
+            issue_number=other_issue['number'])
+        helpers.call_action('issue_comment_report',
+                            context={'user': other_user['name']},
+                            dataset_id=dataset['id'],
+                            issue_number=other_issue['number'],
+                            comment_id=comment['id'])
+
+        model.Session.delete(model.User.get(user['id']))
+        model.Session.commit()
+
+        assert_equals([i.id for i in model.Session.query(Issue)],
+                      [other_issue['id']])
+        assert_equals([c.id for c in model.Session.query(IssueComment)],
+                      [other_comment['id']])
+        assert_equals(model.Session.query(IssueComment.Report).count(), 0)
+
     def test_delete_nonexistent_issue_raises_not_found(self):
         user = factories.User()
         dataset = factories.Dataset()
@@ -607,6 +958,35 @@ class TestOrganizationUsersAutocomplete(ClearOnTearDownMixin):
             set([i['name'] for i in result])
         )
 
+    def test_fetch_by_fullname(self):
+        owner = factories.User(name='owner', fullname='Jane Smith')
+        factories.User(name='other', fullname='Jane Doe')
+        organization = factories.Organization(user=owner)
+
+        for q in ('jane', 'smi', 'Jane S', 'own'):
+            result = helpers.call_action('organization_users_autocomplete',
+                                         q=q,
+                                         organization_id=organization['id'])
+            assert_equals(['owner'], [i['name'] for i in result])
+
+    def test_new_member_is_found(self):
+        owner = factories.User(name='test_owner')
+        organization = factories.Organization(user=owner)
+        helpers.call_action('organization_users_autocomplete',
+                            q='test', organization_id=organization['id'])
+
+        editor = factories.User(name='test_editor')
+        helpers.call_action('organization_member_create',
+                            id=organization['id'],
+                            username=editor['name'],
+                            role='editor')
+
+        result = helpers.call_action('organization_users_autocomplete',
+                                     q='test',
+                                     organization_id=organization['id'])
+        assert_equals(set(['test_owner', 'test_editor']),
+                      set([i['name'] for i in result]))
+
 
 class TestCommentSearch(ClearOnTearDownMixin):
     def setup(self):
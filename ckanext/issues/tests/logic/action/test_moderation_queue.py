@@ -0,0 +1,88 @@
+from ckan import model
+from ckan.plugins import toolkit
+try:
+    from ckan.tests import factories, helpers
+except ImportError:
+    from ckan.new_tests import factories, helpers
+
+from ckanext.issues.tests import factories as issue_factories
+from ckanext.issues.model import Issue, IssueComment, AbuseStatus
+from ckanext.issues.tests.helpers import ClearOnTearDownMixin
+
+from nose.tools import assert_equals, assert_raises
+
+
+class TestModerationQueue(ClearOnTearDownMixin):
+    def setup(self):
+        self.owner = factories.User()
+        self.org = factories.Organization(user=self.owner)
+        self.dataset = factories.Dataset(owner_org=self.org['name'])
+        self.issues = [issue_factories.Issue(user_id=self.owner['id'],
+                                             dataset_id=self.dataset['id'])
+                       for i in range(3)]
+        self.comment = issue_factories.IssueComment(
+            user_id=self.owner['id'],
+            dataset_id=self.dataset['id'],
+            issue_number=self.issues[0]['number'],
+        )
+        # issues[0] reported by one user, issues[1] by two users
+        # and the comment by one user
+        reporters = [factories.User() for i in range(2)]
+        for issue, reporters_ in ((self.issues[0], reporters[:1]),
+                                  (self.issues[1], reporters)):
+            issue_obj = Issue.get(issue['id'])
+            for reporter in reporters_:
+                issue_obj.report_abuse(model.Session, reporter['id'])
+            issue_obj.visibility = u'hidden'
+        comment_obj = IssueComment.get(self.comment['id'])
+        comment_obj.report_abuse(model.Session, reporters[0]['id'])
+        comment_obj.visibility = u'hidden'
+        model.Session.commit()
+
+    def _queue(self, **kwargs):
+        return helpers.call_action(
+            'issue_moderation_queue',
+            context={'user': self.owner['name'], 'model': model},
+            organization_id=self.org['id'],
+            **kwargs)
+
+    def test_queue_order(self):
+        result = self._queue()
+        assert_equals(3, result['count'])
+        assert_equals(
+            [('issue', self.issues[1]['id'], 2),
+             ('issue', self.issues[0]['id'], 1),
+             ('comment', self.comment['id'], 1)],
+            [(i['type'], i['id'], i['report_count'])
+             for i in result['results']])
+
+    def test_queue_paging(self):
+        result = self._queue(limit=1, offset=1)
+        assert_equals(3, result['count'])
+        assert_equals([self.issues[0]['id']],
+                      [i['id'] for i in result['results']])
+
+    def test_queue_filtered_by_type(self):
+        result = self._queue(type='comment')
+        assert_equals(1, result['count'])
+        item = result['results'][0]
+        assert_equals(self.comment['id'], item['id'])
+        assert_equals(self.issues[0]['number'], item['issue_number'])
+        assert_equals(self.owner['name'], item['user']['name'])
+
+    def test_moderated_items_leave_the_queue(self):
+        issue_obj = Issue.get(self.issues[1]['id'])
+        issue_obj.abuse_status = AbuseStatus.abuse.value
+        model.Session.commit()
+        result = self._queue(type='issue')
+        assert_equals([self.issues[0]['id']],
+                      [i['id'] for i in result['results']])
+
+    def test_queue_not_available_to_other_users(self):
+        assert_raises(
+            toolkit.NotAuthorized,
+            helpers.call_action,
+            'issue_moderation_queue',
+            context={'user': factories.User()['name'], 'model': model},
+            organization_id=self.org['id'],
+        )
@@ -0,0 +1,78 @@
+'''Checks that the number of SQL queries run by the actions does not grow
+with the number of issues or comments returned'''
+from ckan import model
+try:
+    from ckan.tests import factories, helpers
+except ImportError:
+    from ckan.new_tests import factories, helpers
+
+from ckanext.issues.tests import factories as issue_factories
+from ckanext.issues.tests.helpers import (
+    ClearOnTearDownMixin,
+    assert_max_queries,
+)
+
+from nose.tools import assert_equals
+
+
+class TestIssueSearchQueries(ClearOnTearDownMixin):
+    def setup(self):
+        self.owner = factories.User()
+        self.org = factories.Organization(user=self.owner)
+        self.dataset = factories.Dataset(owner_org=self.org['name'])
+
+    def _search_query_count(self):
+        with assert_max_queries(20) as stats:
+            helpers.call_action('issue_search',
+                                context={'user': self.owner['name'],
+                                         'model': model},
+                                dataset_id=self.dataset['id'],
+                                include_reports=True)
+        return stats.count
+
+    def test_query_count_independent_of_results(self):
+        for i in range(2):
+            issue_factories.Issue(user=self.owner, user_id=self.owner['id'],
+                                  dataset_id=self.dataset['id'])
+        few = self._search_query_count()
+
+        for i in range(6):
+            issue_factories.Issue(user=self.owner, user_id=self.owner['id'],
+                                  dataset_id=self.dataset['id'])
+        many = self._search_query_count()
+        assert_equals(few, many)
+
+
+class TestIssueShowQueries(ClearOnTearDownMixin):
+    def setup(self):
+        self.owner = factories.User()
+        self.org = factories.Organization(user=self.owner)
+        self.dataset = factories.Dataset(owner_org=self.org['name'])
+        self.issue = issue_factories.Issue(user=self.owner,
+                                           user_id=self.owner['id'],
+                                           dataset_id=self.dataset['id'])
+
+    def _add_comments(self, number):
+        for i in range(number):
+            issue_factories.IssueComment(user=self.owner,
+                                         user_id=self.owner['id'],
+                                         dataset_id=self.dataset['id'],
+                                         issue_number=self.issue['number'])
+
+    def _show_query_count(self):
+        model.Session.expunge_all()
+        with assert_max_queries(40) as stats:
+            helpers.call_action('issue_show',
+                                context={'user': self.owner['name'],
+                                         'model': model},
+                                dataset_id=self.dataset['id'],
+                                issue_number=self.issue['number'],
+                                include_reports=True)
+        return stats.count
+
+    def test_query_count_independent_of_comments(self):
+        self._add_comments(2)
+        few = self._show_query_count()
+        self._add_comments(6)
+        many = self._show_query_count()
+        assert_equals(few, many)
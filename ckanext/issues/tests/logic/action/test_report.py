@@ -42,6 +42,7 @@ class TestReportAnIssue(ClearOnTearDownMixin):
 
         issue_obj = Issue.get(issue['id'])
         assert_equals(len(issue_obj.abuse_reports), 1)
+        assert_equals(issue_obj.report_count, 1)
         assert_equals(issue_obj.visibility, 'visible')
 
     def test_publisher_reports_an_issue(self):
@@ -105,6 +106,7 @@ class TestReportAnIssue(ClearOnTearDownMixin):
 
             issue_obj = Issue.get(issue['id'])
             assert_equals(len(issue_obj.abuse_reports), 2)
+            assert_equals(issue_obj.report_count, 2)
             assert_equals('hidden', issue_obj.visibility)
 
 
@@ -172,6 +174,7 @@ class TestIssueReportClear(ClearOnTearDownMixin):
 
         issue_obj = Issue.get(issue['id'])
         assert_equals(len(issue_obj.abuse_reports), 0)
+        assert_equals(issue_obj.report_count, 0)
 
     def test_clear_as_user(self):
         owner = factories.User()
@@ -202,6 +205,48 @@ class TestIssueReportClear(ClearOnTearDownMixin):
         assert_equals(len(issue_obj.abuse_reports), 0)
 
 
+class TestReportCount(ClearOnTearDownMixin):
+    def test_report_and_clear_keep_count(self):
+        owner = factories.User()
+        org = factories.Organization(user=owner)
+        dataset = factories.Dataset(owner_org=org['name'])
+        issue = issue_factories.Issue(user_id=owner['id'],
+                                      dataset_id=dataset['id'])
+        users = [factories.User() for i in range(2)]
+        for user in users:
+            helpers.call_action('issue_report',
+                                context={'user': user['name'],
+                                         'model': model},
+                                dataset_id=dataset['id'],
+                                issue_number=issue['number'])
+        helpers.call_action('issue_report_clear',
+                            context={'user': users[0]['name'],
+                                     'model': model},
+                            dataset_id=dataset['id'],
+                            issue_number=issue['number'])
+
+        issue_obj = Issue.get(issue['id'])
+        assert_equals(issue_obj.report_count, 1)
+        assert_equals([users[1]['id']],
+                      [r.user_id for r in issue_obj.abuse_reports])
+
+    def test_report_count_in_search_results(self):
+        owner = factories.User()
+        org = factories.Organization(user=owner)
+        dataset = factories.Dataset(owner_org=org['name'])
+        issue = issue_factories.Issue(user_id=owner['id'],
+                                      dataset_id=dataset['id'])
+        helpers.call_action('issue_report',
+                            context={'user': factories.User()['name'],
+                                     'model': model},
+                            dataset_id=dataset['id'],
+                            issue_number=issue['number'])
+
+        result = helpers.call_action('issue_search',
+                                     dataset_id=dataset['id'])
+        assert_equals(1, result['results'][0]['report_count'])
+
+
 class TestIssueReportShow(ClearOnTearDownMixin, ClearOnSetupClassMixin):
     def setup(self):
         self.owner = factories.User()
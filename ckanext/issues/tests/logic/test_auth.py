@@ -206,3 +206,32 @@ class TestReport(object):
         }
         assert_raises(toolkit.NotAuthorized, helpers.call_auth,
             'issue_report', context=context)
+
+
+class TestUserDashboard(ClearOnTearDownMixin):
+    def test_user_can_see_their_own_dashboard(self):
+        user = factories.User()
+        context = {
+            'user': user['name'],
+            'model': model,
+        }
+        assert_true(helpers.call_auth('issue_user_dashboard', context,
+                                      user=user['id']))
+
+    def test_user_cannot_see_the_dashboard_of_another_user(self):
+        user = factories.User()
+        other = factories.User()
+        context = {
+            'user': user['name'],
+            'model': model,
+        }
+        assert_raises(toolkit.NotAuthorized, helpers.call_auth,
+                      'issue_user_dashboard', context, user=other['id'])
+
+    def test_anon_users_have_no_dashboard(self):
+        context = {
+            'user': None,
+            'model': model,
+        }
+        assert_raises(toolkit.NotAuthorized, helpers.call_auth,
+                      'issue_user_dashboard', context=context)